@@ -0,0 +1,571 @@
+# This script reads alignments from SAM and BAM files in independent ranges, so that large files can be processed by
+# a pool of worker processes instead of being decompressed and parsed on a single core.
+# BGZF-compressed files (BAM files and bgzipped SAM files) are indexed by reading just the header and footer of each
+# compressed block, which gives both the compressed and uncompressed offset of every block. The uncompressed data is
+# then split into ranges at block boundaries, and each alignment belongs to the range containing its first byte.
+# Workers decompress their own blocks (reading past the end of their range to finish the last alignment), and find
+# the first alignment in their range by looking for the next line (SAM) or by validating candidate records (BAM).
+# When the ranges are merged, each range must pick up exactly where the previous one left off.
+# Uncompressed SAM files are split the same way, with fixed-size chunks in place of blocks. Plain gzip files
+# cannot be split and can only be read sequentially.
+# This script also provides a BGZF writer that compresses blocks on multiple threads.
+import gzip, os, re, struct, zlib
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+from benbiohelpers.CustomErrors import UserInputError
+
+GZIP_MAGIC = b"\x1f\x8b"
+BAM_MAGIC = b"BAM\x01"
+
+# The size of the chunks uncompressed SAM files are read and split in.
+RAW_CHUNK_SIZE = 16*1024*1024
+# Ranges are made no smaller than this many uncompressed bytes, and there are up to this many ranges per worker
+# (so that workers that finish early can pick up more work).
+MIN_RANGE_SIZE = 64*1024*1024
+RANGES_PER_WORKER = 4
+# The number of consecutive records that must be valid for a candidate position to be accepted as the start of
+# a BAM record (unless the end of the file is reached first).
+BAM_RECORDS_TO_VALIDATE = 4
+
+BAM_CIGAR_OPERATIONS = "MIDNSHP=X"
+BAM_SEQUENCE_CODES = "=ACMGRSVTWYHKDBN"
+# CIGAR operations that consume the reference.
+REFERENCE_CIGAR_OPERATIONS = frozenset("MDN=X")
+SAM_CIGAR_PATTERN = re.compile(r"(\d+)([MIDNSHP=X])")
+
+# The struct formats for each BAM optional field type, and the SAM type they are written as.
+BAM_TAG_FORMATS = {'A': ('c', 'A'), 'c': ('b', 'i'), 'C': ('B', 'i'), 's': ('h', 'i'), 'S': ('H', 'i'),
+                   'i': ('i', 'i'), 'I': ('I', 'i'), 'f': ('f', 'f')}
+
+# The maximum amount of data in each BGZF block written (as in htslib), the number of blocks compressed together,
+# and the empty block marking the end of a BGZF file.
+BGZF_BLOCK_DATA_SIZE = 0xff00
+BGZF_BLOCKS_PER_TASK = 16
+BGZF_EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+UNALIGNED_FLAG = 0x4
+REVERSE_STRAND_FLAG = 0x10
+
+SAM = "SAM"
+BAM = "BAM"
+
+
+class AlignmentRecord:
+    """
+    The fields of a single alignment needed to pair and compare reads. startPos and endPos are 1-based and inclusive,
+    as in the SAM format. The original SAM line (or BAM record) is kept so that the full alignment can be displayed.
+    """
+
+    __slots__ = ("readName", "flag", "chromosome", "startPos", "endPos", "strand", "fileType", "source",
+                 "referenceNames")
+
+    def __init__(self, readName, flag, chromosome, startPos, endPos, fileType, source: bytes, referenceNames = None):
+        self.readName = readName
+        self.flag = flag
+        self.chromosome = chromosome
+        self.startPos = startPos
+        self.endPos = endPos
+        self.strand = '-' if flag & REVERSE_STRAND_FLAG else '+'
+        self.fileType = fileType
+        self.source = source
+        self.referenceNames = referenceNames
+
+    def __getstate__(self): return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state): setattr(self, slot, value)
+
+    def getAlignmentString(self):
+        """
+        Returns the alignment as a SAM line.
+        """
+        if self.fileType == SAM: return self.source.decode().rstrip('\r\n')
+
+        (_, refID, pos, nameLength, mapq, _, cigarCount, flag, sequenceLength,
+         nextRefID, nextPos, templateLength) = struct.unpack_from("<iiiBBHHHiiii", self.source)
+        position = 36 + nameLength
+        cigar = struct.unpack_from(f"<{cigarCount}I", self.source, position)
+        position += 4*cigarCount
+        packedSequence = self.source[position:position + (sequenceLength+1)//2]
+        sequence = ''.join(BAM_SEQUENCE_CODES[base >> 4] + BAM_SEQUENCE_CODES[base & 15] for base in packedSequence)
+        position += (sequenceLength+1)//2
+        qualities = self.source[position:position + sequenceLength]
+        position += sequenceLength
+
+        referenceName = lambda referenceID: '*' if referenceID < 0 else self.referenceNames[referenceID]
+        if nextRefID < 0: nextReference = '*'
+        elif nextRefID == refID: nextReference = '='
+        else: nextReference = referenceName(nextRefID)
+
+        return '\t'.join((
+            self.readName, str(flag), referenceName(refID), str(pos+1), str(mapq),
+            ''.join(f"{operation >> 4}{BAM_CIGAR_OPERATIONS[operation & 15]}" for operation in cigar) or '*',
+            nextReference, str(nextPos+1), str(templateLength), sequence[:sequenceLength] or '*',
+            '*' if not qualities or qualities[0] == 0xff else ''.join(chr(quality + 33) for quality in qualities)
+        ) + getSamTags(self.source, position))
+
+
+# Converts the BAM optional fields in the given record, starting at the given position, to SAM tags.
+def getSamTags(record: bytes, position) -> Tuple[str]:
+
+    tags = list()
+    while position < len(record):
+        tag, tagType = record[position:position+2].decode(), chr(record[position+2])
+        position += 3
+        if tagType in BAM_TAG_FORMATS:
+            structFormat, samType = BAM_TAG_FORMATS[tagType]
+            value = struct.unpack_from('<' + structFormat, record, position)[0]
+            position += struct.calcsize(structFormat)
+            if tagType == 'A': value = value.decode()
+            tags.append(f"{tag}:{samType}:{value:g}" if samType == 'f' else f"{tag}:{samType}:{value}")
+        elif tagType in "ZH":
+            valueEnd = record.index(b'\0', position)
+            tags.append(f"{tag}:{tagType}:{record[position:valueEnd].decode()}")
+            position = valueEnd + 1
+        elif tagType == 'B':
+            subtype = chr(record[position])
+            count = struct.unpack_from("<i", record, position + 1)[0]
+            structFormat = BAM_TAG_FORMATS[subtype][0]
+            values = struct.unpack_from(f"<{count}{structFormat}", record, position + 5)
+            position += 5 + count*struct.calcsize(structFormat)
+            tags.append(f"{tag}:B:{subtype}" + ''.join(f",{value:g}" if subtype == 'f' else f",{value}"
+                                                       for value in values))
+        else: raise UserInputError(f"Unrecognized BAM optional field type {tagType} for tag {tag}.")
+    return tuple(tags)
+
+
+# Returns the number of reference bases covered by the given CIGAR operations, as (length, operation) pairs.
+def getReferenceLength(cigarOperations) -> int:
+    return sum(length for length, operation in cigarOperations if operation in REFERENCE_CIGAR_OPERATIONS)
+
+
+# Creates an alignment record from a single SAM line (as bytes).
+def parseSamLine(line: bytes) -> AlignmentRecord:
+    readName, flag, chromosome, pos, _, cigar = line.split(b'\t', 6)[:6]
+    startPos = int(pos)
+    referenceLength = getReferenceLength((int(length), operation)
+                                         for length, operation in SAM_CIGAR_PATTERN.findall(cigar.decode()))
+    return AlignmentRecord(readName.decode(), int(flag), chromosome.decode(), startPos,
+                           startPos + max(referenceLength, 1) - 1, SAM, line)
+
+
+# Creates an alignment record from a single BAM record (including its block_size field).
+def parseBamRecord(record: bytes, referenceNames: Tuple[str]) -> AlignmentRecord:
+    _, refID, pos, nameLength, _, _, cigarCount, flag = struct.unpack_from("<iiiBBHHH", record)
+    readName = record[36:36 + nameLength - 1].decode()
+    cigar = struct.unpack_from(f"<{cigarCount}I", record, 36 + nameLength)
+    referenceLength = getReferenceLength((operation >> 4, BAM_CIGAR_OPERATIONS[operation & 15]) for operation in cigar)
+    return AlignmentRecord(readName, flag, '*' if refID < 0 else referenceNames[refID], pos + 1,
+                           pos + max(referenceLength, 1), BAM, record, referenceNames)
+
+
+# Checks whether the given bytes could be the fixed-length portion and read name of a BAM record, given the number of
+# reference sequences. (Used to find the first record in a range, where the true record boundaries are unknown.)
+def isPlausibleBamRecord(data: bytes, referenceCount) -> bool:
+
+    if len(data) < 36: return False
+    (blockSize, refID, pos, nameLength, _, _, cigarCount, _, sequenceLength,
+     nextRefID, nextPos, _) = struct.unpack_from("<iiiBBHHHiiii", data)
+
+    if not (-1 <= refID < referenceCount and -1 <= nextRefID < referenceCount): return False
+    if pos < -1 or nextPos < -1 or nameLength < 2 or sequenceLength < 0: return False
+    if blockSize < 32 + nameLength + 4*cigarCount + (sequenceLength+1)//2 + sequenceLength: return False
+
+    readName = data[36:36 + nameLength]
+    if len(readName) < nameLength: return True # Can't check any further without more data.
+    if readName[-1] != 0 or not all(0x21 <= character <= 0x7e for character in readName[:-1]): return False
+    cigar = data[36 + nameLength:36 + nameLength + 4*cigarCount]
+    return all(operation & 15 <= 8 for operation in struct.unpack(f"<{len(cigar)//4}I", cigar[:len(cigar)//4*4]))
+
+
+# Returns the (compressed offset, uncompressed offset) of every block in the given file, with an additional final
+# entry giving the total compressed and uncompressed sizes. For BGZF files, only the header and footer of each block
+# are read. For uncompressed files, the "blocks" are fixed-size chunks of the file.
+def getBlockOffsets(filePath) -> Tuple[np.ndarray, np.ndarray]:
+
+    if not isBGZF(filePath):
+        fileSize = os.path.getsize(filePath)
+        offsets = np.append(np.arange(0, fileSize, RAW_CHUNK_SIZE, dtype = np.int64), fileSize)
+        return offsets, offsets
+
+    compressedOffsets = [0]
+    uncompressedOffsets = [0]
+    with open(filePath, 'rb') as bgzfFile:
+        while True:
+            blockSize = readBGZFBlockSize(bgzfFile, filePath)
+            if blockSize is None: break
+            bgzfFile.seek(compressedOffsets[-1] + blockSize - 4)
+            uncompressedSize = struct.unpack("<I", bgzfFile.read(4))[0]
+            compressedOffsets.append(compressedOffsets[-1] + blockSize)
+            uncompressedOffsets.append(uncompressedOffsets[-1] + uncompressedSize)
+            bgzfFile.seek(compressedOffsets[-1])
+
+    return np.array(compressedOffsets, np.int64), np.array(uncompressedOffsets, np.int64)
+
+
+# Reads the header of the BGZF block at the current position of the given file and returns the total size of the
+# block, or None if the end of the file has been reached. The file position is left after the header.
+def readBGZFBlockSize(bgzfFile, filePath) -> Optional[int]:
+
+    header = bgzfFile.read(12)
+    if not header: return None
+    if len(header) < 12 or header[:2] != GZIP_MAGIC or not header[3] & 4:
+        raise UserInputError(f"Invalid BGZF block header in {filePath} at offset {bgzfFile.tell() - len(header)}.")
+
+    extraField = bgzfFile.read(struct.unpack_from("<H", header, 10)[0])
+    position = 0
+    while position + 4 <= len(extraField):
+        subfieldLength = struct.unpack_from("<H", extraField, position + 2)[0]
+        if extraField[position:position+2] == b"BC" and subfieldLength == 2:
+            return struct.unpack_from("<H", extraField, position + 4)[0] + 1
+        position += 4 + subfieldLength
+    raise UserInputError(f"Missing BGZF block size in {filePath} at offset {bgzfFile.tell() - len(extraField) - 12}.")
+
+
+# Returns true if the given file starts with a BGZF block.
+def isBGZF(filePath):
+    with open(filePath, 'rb') as inputFile:
+        header = inputFile.read(18)
+    return len(header) == 18 and header[:2] == GZIP_MAGIC and header[3] & 4 and header[12:14] == b"BC"
+
+
+# Returns true if the given file can be split into independent ranges (i.e. it isn't plain gzip).
+def isSplittable(filePath):
+    with open(filePath, 'rb') as inputFile:
+        isGzip = inputFile.read(2) == GZIP_MAGIC
+    return not isGzip or isBGZF(filePath)
+
+
+class BlockReader:
+    """
+    Reads the (decompressed) data of consecutive blocks, starting with the block at the given compressed and
+    uncompressed offsets. Data is addressed by uncompressed offsets in the whole file, and blocks are only read
+    as needed to reach a requested offset. Data before a given offset can be discarded to bound memory usage.
+    """
+
+    def __init__(self, filePath, compressedOffset, uncompressedOffset, compressed):
+        self.filePath = filePath
+        self.inputFile = open(filePath, 'rb')
+        self.inputFile.seek(compressedOffset)
+        self.compressed = compressed
+        self.data = bytearray()
+        self.dataStart = uncompressedOffset
+        self.reachedEnd = False
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb): self.inputFile.close()
+
+    def readNextBlock(self):
+        if self.compressed:
+            blockStart = self.inputFile.tell()
+            blockSize = readBGZFBlockSize(self.inputFile, self.filePath)
+            if blockSize is None: self.reachedEnd = True; return
+            self.inputFile.seek(blockStart)
+            self.data += zlib.decompress(self.inputFile.read(blockSize), 31)
+        else:
+            chunk = self.inputFile.read(RAW_CHUNK_SIZE)
+            if not chunk: self.reachedEnd = True
+            self.data += chunk
+
+    def getDataEnd(self): return self.dataStart + len(self.data)
+
+    def ensure(self, end) -> bool:
+        """
+        Reads blocks until the data reaches the given offset. Returns false if the end of the file comes first.
+        """
+        while self.getDataEnd() < end and not self.reachedEnd: self.readNextBlock()
+        return self.getDataEnd() >= end
+
+    def get(self, start, end) -> bytes:
+        self.ensure(end)
+        return bytes(self.data[start - self.dataStart:end - self.dataStart])
+
+    def find(self, substring: bytes, start) -> int:
+        """
+        Returns the offset of the next occurrence of the given substring at or after the given offset, or -1.
+        """
+        while True:
+            position = self.data.find(substring, start - self.dataStart)
+            if position != -1: return position + self.dataStart
+            if self.reachedEnd: return -1
+            self.readNextBlock()
+
+    def discardBefore(self, offset):
+        if offset > self.dataStart:
+            del self.data[:offset - self.dataStart]
+            self.dataStart = offset
+
+
+class AlignmentRange:
+    """
+    A range of uncompressed offsets [rangeStart, rangeEnd) in a SAM or BAM file, which starts at the block with the
+    given compressed offset. Alignments starting within the range belong to it. (For SAM files, a line belongs to the
+    range if the preceding newline is within it, so that ranges can be read without the previous block.)
+    recordsStart is the offset of the first record after the BAM header (or 0 for SAM files).
+    """
+
+    def __init__(self, filePath, fileType, compressed, compressedOffset, rangeStart, rangeEnd,
+                 recordsStart = 0, referenceNames: Tuple[str] = None):
+        self.filePath = filePath
+        self.fileType = fileType
+        self.compressed = compressed
+        self.compressedOffset = compressedOffset
+        self.rangeStart = rangeStart
+        self.rangeEnd = rangeEnd
+        self.recordsStart = recordsStart
+        self.referenceNames = referenceNames
+        self.firstRecordStart = None
+        self.nextRecordStart = None
+
+    def __iter__(self) -> Iterator[AlignmentRecord]:
+        """
+        Yields every alignment that belongs to this range. Afterwards, firstRecordStart and nextRecordStart give
+        the offsets of the first alignment and of the first alignment after this range (None if the range is empty).
+        """
+        with BlockReader(self.filePath, self.compressedOffset, self.rangeStart, self.compressed) as blockReader:
+            if self.fileType == SAM: yield from self.iterateSamLines(blockReader)
+            else: yield from self.iterateBamRecords(blockReader)
+
+    def iterateSamLines(self, blockReader: BlockReader) -> Iterator[AlignmentRecord]:
+
+        if self.rangeStart == 0: lineStart = 0
+        else:
+            newlinePosition = blockReader.find(b'\n', self.rangeStart)
+            if newlinePosition == -1 or newlinePosition >= self.rangeEnd: return
+            lineStart = newlinePosition + 1
+
+        self.firstRecordStart = lineStart
+        while lineStart <= self.rangeEnd:
+            lineEnd = blockReader.find(b'\n', lineStart)
+            if lineEnd == -1: lineEnd = blockReader.getDataEnd() - 1
+            line = blockReader.get(lineStart, lineEnd + 1)
+            if not line: break
+            if not line.startswith(b'@') and line.strip(): yield parseSamLine(line)
+            lineStart = lineEnd + 1
+            blockReader.discardBefore(lineStart)
+        self.nextRecordStart = lineStart
+
+    def findFirstBamRecord(self, blockReader: BlockReader) -> Optional[int]:
+        """
+        Finds the first position within the range where a chain of plausible BAM records begins.
+        """
+        referenceCount = len(self.referenceNames)
+        for candidate in range(max(self.rangeStart, self.recordsStart), self.rangeEnd):
+            recordStart = candidate
+            for _ in range(BAM_RECORDS_TO_VALIDATE):
+                # The chain is also valid if it ends exactly at the end of the file.
+                if not blockReader.ensure(recordStart + 4):
+                    if recordStart != blockReader.getDataEnd(): recordStart = None
+                    break
+                if not isPlausibleBamRecord(blockReader.get(recordStart, recordStart + 36 + 256), referenceCount):
+                    recordStart = None
+                    break
+                recordStart += 4 + struct.unpack("<i", blockReader.get(recordStart, recordStart + 4))[0]
+            if recordStart is not None: return candidate
+        return None
+
+    def iterateBamRecords(self, blockReader: BlockReader) -> Iterator[AlignmentRecord]:
+
+        if self.rangeStart <= self.recordsStart: recordStart = self.recordsStart
+        else: recordStart = self.findFirstBamRecord(blockReader)
+        if recordStart is None or recordStart >= self.rangeEnd: return
+
+        self.firstRecordStart = recordStart
+        while recordStart < self.rangeEnd and blockReader.ensure(recordStart + 4):
+            recordEnd = recordStart + 4 + struct.unpack("<i", blockReader.get(recordStart, recordStart + 4))[0]
+            if not blockReader.ensure(recordEnd):
+                raise UserInputError(f"Truncated BAM record at uncompressed offset {recordStart} in {self.filePath}.")
+            yield parseBamRecord(blockReader.get(recordStart, recordEnd), self.referenceNames)
+            recordStart = recordEnd
+            blockReader.discardBefore(recordStart)
+        self.nextRecordStart = recordStart
+
+
+# Reads the header of the given BAM file, returning the reference sequence names and the uncompressed offset of the
+# first record. If includeText is true, the header text (as it would appear in a SAM file) is returned as well.
+def readBamHeader(filePath, includeText = False) -> Tuple:
+
+    with BlockReader(filePath, 0, 0, True) as blockReader:
+        if blockReader.get(0, 4) != BAM_MAGIC: raise UserInputError(f"{filePath} is not a BAM file.")
+        textLength = struct.unpack("<i", blockReader.get(4, 8))[0]
+        headerText = blockReader.get(8, 8 + textLength).rstrip(b'\0').decode()
+        position = 8 + textLength
+        referenceCount = struct.unpack("<i", blockReader.get(position, position + 4))[0]
+        position += 4
+        referenceNames = list()
+        referenceLengths = list()
+        for _ in range(referenceCount):
+            nameLength = struct.unpack("<i", blockReader.get(position, position + 4))[0]
+            referenceNames.append(blockReader.get(position + 4, position + 3 + nameLength).decode())
+            referenceLengths.append(struct.unpack("<i", blockReader.get(position + 4 + nameLength,
+                                                                         position + 8 + nameLength))[0])
+            position += 8 + nameLength
+
+    if not includeText: return tuple(referenceNames), position
+
+    # The header text isn't required to list the reference sequences, so add them if necessary.
+    if referenceNames and "@SQ\t" not in headerText:
+        headerText += ''.join(f"@SQ\tSN:{referenceName}\tLN:{referenceLength}\n"
+                              for referenceName, referenceLength in zip(referenceNames, referenceLengths))
+    return tuple(referenceNames), position, headerText
+
+
+# Returns the header lines of the given SAM or BAM file as a single string.
+def readHeaderText(filePath) -> str:
+
+    if filePath.endswith(".bam"): return readBamHeader(filePath, True)[2]
+
+    headerLines = list()
+    with (gzip.open(filePath, 'rt') if filePath.endswith(".gz") else open(filePath, 'r')) as samFile:
+        for line in samFile:
+            if not line.startswith('@'): break
+            headerLines.append(line)
+    return ''.join(headerLines)
+
+
+# Splits the given SAM or BAM file into ranges of alignments that can be read independently, aiming for the given
+# number of ranges (within the limits of MIN_RANGE_SIZE and the number of blocks).
+def getAlignmentRanges(filePath, rangeCount) -> List[AlignmentRange]:
+
+    if not isSplittable(filePath):
+        raise UserInputError(f"{filePath} is compressed with plain gzip, so it can't be split. "
+                             "Use bgzip compression or read the file sequentially.")
+
+    compressed = isBGZF(filePath)
+    fileType = BAM if filePath.endswith(".bam") else SAM
+    if fileType == BAM:
+        if not compressed: raise UserInputError(f"{filePath} is not BGZF compressed, as BAM files should be.")
+        referenceNames, recordsStart = readBamHeader(filePath)
+    else: referenceNames, recordsStart = None, 0
+
+    compressedOffsets, uncompressedOffsets = getBlockOffsets(filePath)
+    totalSize = uncompressedOffsets[-1]
+    rangeCount = max(1, min(rangeCount, totalSize // MIN_RANGE_SIZE))
+
+    # Split at the blocks closest to evenly spaced uncompressed offsets.
+    splitBlocks = np.unique(np.searchsorted(uncompressedOffsets[:-1],
+                                            np.linspace(0, totalSize, rangeCount, endpoint = False)))
+    rangeEnds = np.append(uncompressedOffsets[splitBlocks[1:]], totalSize)
+    return [AlignmentRange(filePath, fileType, compressed, int(compressedOffsets[blockIndex]),
+                           int(uncompressedOffsets[blockIndex]), int(rangeEnd), recordsStart, referenceNames)
+            for i, (blockIndex, rangeEnd) in enumerate(zip(splitBlocks, rangeEnds))
+            if i == 0 or rangeEnd > uncompressedOffsets[blockIndex]]
+
+
+# Yields every alignment in the given file in order, reading it as a single range (or, for plain gzip files, line by line).
+def readAlignments(filePath, skipUnaligned = True) -> Iterator[AlignmentRecord]:
+
+    if isSplittable(filePath): alignments = (alignment for alignmentRange in getAlignmentRanges(filePath, 1)
+                                             for alignment in alignmentRange)
+    else: alignments = readPlainGzipSamLines(filePath)
+
+    for alignment in alignments:
+        if not (skipUnaligned and alignment.flag & UNALIGNED_FLAG): yield alignment
+
+
+# Yields the alignments from a plain gzip-compressed SAM file.
+def readPlainGzipSamLines(filePath) -> Iterator[AlignmentRecord]:
+    with gzip.open(filePath, 'rb') as samFile:
+        for line in samFile:
+            if not line.startswith(b'@') and line.strip(): yield parseSamLine(line)
+
+
+# Runs rangeFunction(alignments, *args) on the given range, where alignments iterates through the range's (aligned,
+# if skipUnaligned is true) alignments. Returns the offsets of the range's first and next alignment along with the result.
+def processAlignmentRange(alignmentRange: AlignmentRange, rangeFunction: Callable, skipUnaligned, *args):
+
+    alignments = (alignment for alignment in alignmentRange
+                  if not (skipUnaligned and alignment.flag & UNALIGNED_FLAG))
+    result = rangeFunction(alignments, *args)
+    for _ in alignments: pass # Make sure the range has been read to the end.
+    return alignmentRange.firstRecordStart, alignmentRange.nextRecordStart, result
+
+
+# Splits the given SAM or BAM file into ranges and runs rangeFunction(alignments, *args) on each one in a pool of the
+# given number of worker processes (or in this process if workers is 1). rangeFunction must be defined at the top
+# level of a module so that it can be sent to the workers.
+# Returns the results in file order after making sure that the ranges covered every alignment exactly once.
+def mapAlignmentRangesInPool(rangeFunction: Callable, filePath, workers: int, *args, skipUnaligned = True) -> List:
+
+    alignmentRanges = getAlignmentRanges(filePath, workers * RANGES_PER_WORKER)
+
+    if workers == 1:
+        rangeResults = [processAlignmentRange(alignmentRange, rangeFunction, skipUnaligned, *args)
+                        for alignmentRange in alignmentRanges]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = [executor.submit(processAlignmentRange, alignmentRange, rangeFunction, skipUnaligned, *args)
+                       for alignmentRange in alignmentRanges]
+            rangeResults = [future.result() for future in futures]
+
+    expectedRecordStart = None
+    for firstRecordStart, nextRecordStart, _ in rangeResults:
+        if firstRecordStart is None: continue
+        if expectedRecordStart is not None and firstRecordStart != expectedRecordStart:
+            raise UserInputError(f"Alignments in {filePath} could not be split into independent ranges "
+                                 f"(expected an alignment at uncompressed offset {expectedRecordStart}, but found "
+                                 f"{firstRecordStart}). Try again with a single worker.")
+        expectedRecordStart = nextRecordStart
+
+    return [result for _, _, result in rangeResults]
+
+
+class BGZFWriter:
+    """
+    Writes text to a BGZF-compressed file (readable by gzip, and indexable by tools like tabix and samtools).
+    Data is buffered into blocks, which are compressed in batches on a pool of threads (zlib releases the GIL while
+    compressing) and written in order. At most a few batches per thread are held in memory at once.
+    """
+
+    def __init__(self, outputFilePath, threads = 1, compressionLevel = 6):
+        self.outputFile = open(outputFilePath, 'wb')
+        self.compressionLevel = compressionLevel
+        self.maxPendingTasks = 4*threads
+        self.executor = ThreadPoolExecutor(max_workers = threads)
+        self.pendingTasks = deque()
+        self.buffer = bytearray()
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb): self.close()
+
+    def compressBlocks(self, data: bytes) -> bytes:
+        """
+        Compresses the given data into consecutive BGZF blocks.
+        """
+        blocks = list()
+        for blockStart in range(0, len(data), BGZF_BLOCK_DATA_SIZE):
+            blockData = data[blockStart:blockStart + BGZF_BLOCK_DATA_SIZE]
+            compressor = zlib.compressobj(self.compressionLevel, zlib.DEFLATED, -15)
+            compressedData = compressor.compress(blockData) + compressor.flush()
+            blocks.append(b"\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0" +
+                          struct.pack("<H", len(compressedData) + 25) + compressedData +
+                          struct.pack("<II", zlib.crc32(blockData), len(blockData)))
+        return b''.join(blocks)
+
+    def write(self, text: str):
+        self.buffer += text.encode()
+        if len(self.buffer) >= BGZF_BLOCK_DATA_SIZE*BGZF_BLOCKS_PER_TASK: self.submitBuffer()
+
+    def submitBuffer(self):
+        """
+        Queues the buffered data for compression, writing out finished batches once too many are pending.
+        """
+        if self.buffer:
+            self.pendingTasks.append(self.executor.submit(self.compressBlocks, bytes(self.buffer)))
+            self.buffer.clear()
+        while len(self.pendingTasks) > self.maxPendingTasks:
+            self.outputFile.write(self.pendingTasks.popleft().result())
+
+    def close(self):
+        if self.outputFile.closed: return
+        try:
+            self.submitBuffer()
+            while self.pendingTasks: self.outputFile.write(self.pendingTasks.popleft().result())
+            self.outputFile.write(BGZF_EOF_BLOCK)
+        finally:
+            self.executor.shutdown()
+            self.outputFile.close()
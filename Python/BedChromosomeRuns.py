@@ -0,0 +1,100 @@
+# This script contains a bytes-level engine for rewriting or filtering bed data on its chromosome column alone.
+# Input is read in large binary blocks, and only the first tab of each line is looked up to find its chromosome; the
+# rest of the line is copied through untouched. Since consecutive lines in a sorted bed file share a chromosome, each
+# "run" of lines with the same chromosome is found with a single search and forwarded (or dropped) in bulk.
+import re
+from typing import Callable, Dict, Iterator, Optional, Pattern
+
+# The number of bytes to read from the input file at once.
+READ_BLOCK_SIZE = 16*1024*1024
+
+
+# Yields blocks of up to blockSize bytes from the given binary file object.
+def readBlocks(binaryFile, blockSize = READ_BLOCK_SIZE) -> Iterator[bytes]:
+    while True:
+        block = binaryFile.read(blockSize)
+        if not block: return
+        yield block
+
+
+# Regroups the given blocks so that every yielded block ends on a line boundary. (Only the last block may be missing
+# its trailing newline, if the data itself was.)
+def alignBlocksToLines(blocks: Iterator[bytes]) -> Iterator[bytes]:
+
+    partialLine = b''
+    for block in blocks:
+        lastNewline = block.rfind(b'\n')
+        if lastNewline == -1:
+            partialLine += block
+            continue
+        yield partialLine + block[:lastNewline+1]
+        partialLine = block[lastNewline+1:]
+    if partialLine: yield partialLine
+
+
+class ChromosomeRunRewriter:
+    """
+    Rewrites the chromosome column of bed data. getReplacement is called once for each distinct chromosome (as bytes)
+    and should return the replacement chromosome, the same chromosome to keep its lines as they are, or None to drop
+    all of its lines. Blank lines are dropped.
+    """
+
+    def __init__(self, getReplacement: Callable[[bytes], Optional[bytes]]):
+        self.getReplacement = getReplacement
+        self.replacements: Dict[bytes, Optional[bytes]] = dict()
+        self.runEndPatterns: Dict[bytes, Pattern] = dict()
+
+    def getRunEndPattern(self, chromosome: bytes) -> Pattern:
+        """
+        Returns a pattern matching the first newline that is not followed by another line on the given chromosome.
+        """
+        if chromosome not in self.runEndPatterns:
+            self.runEndPatterns[chromosome] = re.compile(b"\n(?!" + re.escape(chromosome + b'\t') + b')')
+        return self.runEndPatterns[chromosome]
+
+    def rewriteBlock(self, block: bytes) -> Iterator[bytes]:
+        """
+        Yields the rewritten data for a block made up of whole lines, one chromosome run at a time.
+        """
+        position = 0
+        while position < len(block):
+
+            # Find the chromosome at the start of this line.
+            lineEnd = block.find(b'\n', position)
+            if lineEnd == -1: lineEnd = len(block)
+            chromosomeEnd = block.find(b'\t', position, lineEnd)
+            if chromosomeEnd == -1:
+                chromosome = block[position:lineEnd].rstrip()
+                if not chromosome:
+                    position = lineEnd + 1
+                    continue
+            else: chromosome = block[position:chromosomeEnd]
+
+            # Find the end of the run of lines on this chromosome.
+            runEnd = self.getRunEndPattern(chromosome).search(block, lineEnd)
+            runEnd = len(block) if runEnd is None else runEnd.end()
+
+            if chromosome not in self.replacements: self.replacements[chromosome] = self.getReplacement(chromosome)
+            replacement = self.replacements[chromosome]
+
+            if replacement == chromosome: yield block[position:runEnd]
+            elif replacement is not None:
+                yield replacement + block[position+len(chromosome):runEnd].replace(
+                    b'\n' + chromosome + b'\t', b'\n' + replacement + b'\t'
+                )
+            position = runEnd
+
+    def rewriteBlocks(self, blocks: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        Yields the rewritten data for the given blocks of bed data, which may split lines arbitrarily.
+        """
+        for block in alignBlocksToLines(blocks):
+            rewrittenData = b''.join(self.rewriteBlock(block))
+            if rewrittenData: yield rewrittenData
+
+
+# Writes the bed data from the binary input file object to the binary output file object, rewriting or filtering its
+# chromosomes as determined by getReplacement. (See ChromosomeRunRewriter for details.)
+def rewriteBedChromosomes(inputFile, outputFile, getReplacement: Callable[[bytes], Optional[bytes]]):
+    for rewrittenData in ChromosomeRunRewriter(getReplacement).rewriteBlocks(readBlocks(inputFile)):
+        outputFile.write(rewrittenData)
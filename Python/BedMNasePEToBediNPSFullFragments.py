@@ -1,56 +1,314 @@
 # This script converts from paired-end MNase data in bed format to a format suitable for paired end input in iNPS.
 # This is accomplished by using each concordant pair in the input bed file to determine the original fragment ends.
-# As a result, input MUST contain only concordant pairs, and all entries must be adjacent to their companion.
-import os
+# As a result, input MUST contain only concordant pairs, and all entries must be adjacent to their companion,
+# unless mates are paired by read name (see MatePairing), in which case the input may be coordinate-sorted.
+import os, shutil, traceback, warnings
+import numpy as np
 from typing import List
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
-from benbiohelpers.CustomErrors import UserInputError
+from benbiohelpers.CustomErrors import UserInputError, checkForNumber
+from ParallelProcessing import mapFilesInPool, mapChromosomeShardsInPool, concatenateFiles
+from MatePairing import MatePairer, DEFAULT_MAX_HELD_MATES
+
+# The number of bytes read from the input at a time when converting whole files.
+PAIRED_ENTRY_BLOCK_SIZE = 16*1024*1024
+
+TAB = ord('\t')
+NEWLINE = ord('\n')
+
+
+# Given two adjacent, split paired-end bed entries, returns the full fragment bed line they describe.
+# If validateConcordantPairs is true, the 4th (index 3) column is checked to make sure the entries
+# are ordered, concordant pairs.
+def getFullFragment(companion1: List[str], companion2: List[str], validateConcordantPairs = True):
+
+    if validateConcordantPairs:
+        if (not companion1[3].endswith('1') or not companion2[3].endswith('2') or
+            companion1[3][:-1] != companion2[3][:-1]):
+            raise UserInputError(f"Found adjacent reads that are not ordered, "
+                                 f"concordant pairs:\n{companion1}\n{companion2}")
+
+    if companion1[5] == '+':
+        fullFragmentStart = companion1[1]
+        fullFragmentEnd = companion2[2]
+    elif companion2[5] == '+':
+        fullFragmentStart = companion2[1]
+        fullFragmentEnd = companion1[2]
+    else:
+        raise UserInputError("Neither entry in the following concordant pair is on the \'+\' strand.\n"
+                             f"{companion1}\n{companion2}")
+
+    return '\t'.join((companion1[0], fullFragmentStart, fullFragmentEnd)) + '\n'
+
+
+# Gathers the given (start, end) ranges of the buffer into a single array, in order.
+def gatherRanges(buffer: np.ndarray, rangeStarts: np.ndarray, rangeEnds: np.ndarray) -> np.ndarray:
+
+    # Each range's gather indices count up from its start, so they can be built by repeating each range's offset
+    # from its place in the output and adding the output positions. (32-bit indices halve the memory traffic, and
+    # are enough for any block given by readPairedEntryBlocks.)
+    indexType = np.int32 if len(buffer) < 2**31 else np.int64
+    rangeLengths = (rangeEnds - rangeStarts).astype(indexType)
+    rangeOffsets = rangeStarts.astype(indexType) - (np.cumsum(rangeLengths, dtype = indexType) - rangeLengths)
+    gatherIndices = np.repeat(rangeOffsets, rangeLengths)
+    gatherIndices += np.arange(len(gatherIndices), dtype = indexType)
+    return buffer[gatherIndices]
+
+
+# Bit masks selecting the first 0 to 8 bytes of an unsigned 64-bit integer read from memory (in native byte order).
+LEADING_BYTE_MASKS = np.frombuffer(b''.join(b'\xff'*byteCount + bytes(8 - byteCount) for byteCount in range(9)),
+                                   np.uint64)
+
+
+# Converts a block of complete, paired bed lines (an even number of lines, each terminated with a newline) to
+# full fragment bed lines. Columns are located and pairs are validated with array operations over the raw bytes,
+# and the output is gathered directly from the input bytes, so it is identical to the line-by-line conversion.
+# Returns None if any line is malformed or any pair fails validation, in which case the block should be converted
+# line-by-line to produce the appropriate error.
+def convertPairedEntryBlock(block: bytes, validateConcordantPairs = True):
+
+    # Pad the block so that a full 8-byte word can be read starting from any of its bytes.
+    paddedBlock = block + bytes(8)
+    buffer = np.frombuffer(paddedBlock, np.uint8)
+
+    # Find every tab and newline in a single pass. (No other bytes at or below a newline belong in a bed file,
+    # so if any turn up, the block is left to the line-by-line conversion.)
+    delimiters = np.flatnonzero(buffer[:len(block)] <= NEWLINE)
+    delimiterCharacters = buffer[delimiters]
+    if len(delimiters) == 0 or np.any(delimiterCharacters < TAB): return None
+
+    # Usually, every line has the same number of columns, so the delimiters can simply be split into rows.
+    # Otherwise, locate the first five tabs of each line, making sure that they are all actually within the line.
+    columnCount = int(np.argmax(delimiterCharacters == NEWLINE)) + 1
+    lineDelimiterCharacters = (delimiterCharacters.reshape(-1, columnCount)
+                               if len(delimiters) % columnCount == 0 else None)
+    if (columnCount >= 6 and lineDelimiterCharacters is not None and np.all(lineDelimiterCharacters[:, -1] == NEWLINE)
+        and np.all(lineDelimiterCharacters[:, :-1] == TAB)):
+        lineDelimiters = delimiters.reshape(-1, columnCount)
+        if len(lineDelimiters) % 2 != 0: return None
+        lineTabs = lineDelimiters[:, :5]
+        lineEnds = lineDelimiters[:, -1]
+        strandEnds = lineDelimiters[:, 5]
+    else:
+        newlineIndices = np.flatnonzero(delimiterCharacters == NEWLINE)
+        if len(newlineIndices) % 2 != 0: return None
+        firstDelimiterIndices = np.concatenate(([0], newlineIndices[:-1] + 1))
+        if np.any(newlineIndices - firstDelimiterIndices < 5): return None
+        lineTabs = delimiters[firstDelimiterIndices[:, None] + np.arange(5)]
+        lineEnds = delimiters[newlineIndices]
+        strandEnds = delimiters[np.minimum(firstDelimiterIndices + 5, newlineIndices)]
+    lineStarts = np.concatenate(([0], lineEnds[:-1] + 1))
+
+    # Make sure the strand column is a single character (ignoring any carriage return).
+    strandEnds = strandEnds - (buffer[strandEnds - 1] == ord('\r'))
+    if np.any(strandEnds - lineTabs[:, 4] != 2): return None
+
+    companion1 = slice(0, None, 2)
+    companion2 = slice(1, None, 2)
+
+    if validateConcordantPairs:
+        nameStarts = lineTabs[:, 2] + 1
+        nameEnds = lineTabs[:, 3]
+        nameLengths = nameEnds - nameStarts
+        if np.any(nameLengths == 0): return None
+        if (np.any(buffer[nameEnds[companion1] - 1] != ord('1')) or np.any(buffer[nameEnds[companion2] - 1] != ord('2')) or
+            np.any(nameLengths[companion1] != nameLengths[companion2])): return None
+        # Compare the name prefixes across all pairs eight characters at a time, reading each 8-byte word as a single
+        # integer and ignoring any characters past the end of the prefix.
+        words = np.ndarray((len(buffer) - 7,), np.uint64, paddedBlock, strides = (1,))
+        prefixLengths = nameLengths[companion1] - 1
+        nameStarts1 = nameStarts[companion1]
+        nameStarts2 = nameStarts[companion2]
+        for wordStart in range(0, prefixLengths.max(), 8):
+            wordPairs = np.flatnonzero(prefixLengths > wordStart)
+            wordDifferences = words[nameStarts1[wordPairs] + wordStart] ^ words[nameStarts2[wordPairs] + wordStart]
+            if np.any(wordDifferences & LEADING_BYTE_MASKS[np.minimum(prefixLengths[wordPairs] - wordStart, 8)]):
+                return None
+
+    isPlus = buffer[lineTabs[:, 4] + 1] == ord('+')
+    companion1IsPlus = isPlus[companion1]
+    if np.any(~companion1IsPlus & ~isPlus[companion2]): return None
+
+    # Each output line is made up of four ranges from the input: companion 1's chromosome and the tab after it,
+    # the plus strand companion's start position and the tab after it, the other companion's end position,
+    # and companion 1's newline.
+    tabs1, tabs2 = lineTabs[companion1], lineTabs[companion2]
+    rangeStarts = np.stack((lineStarts[companion1], np.where(companion1IsPlus, tabs1[:, 0], tabs2[:, 0]) + 1,
+                            np.where(companion1IsPlus, tabs2[:, 1], tabs1[:, 1]) + 1, lineEnds[companion1]), axis = 1)
+    rangeEnds = np.stack((tabs1[:, 0] + 1, np.where(companion1IsPlus, tabs1[:, 1], tabs2[:, 1]) + 1,
+                          np.where(companion1IsPlus, tabs2[:, 2], tabs1[:, 2]), lineEnds[companion1] + 1), axis = 1)
+    return gatherRanges(buffer, rangeStarts.ravel(), rangeEnds.ravel()).tobytes()
+
+
+# Reads the given binary bed file in large blocks, yielding blocks of complete lines that always contain an even
+# number of lines. The final line is given a newline if it is missing one.
+def readPairedEntryBlocks(bedFile, blockSize = PAIRED_ENTRY_BLOCK_SIZE):
+
+    leftover = b''
+    while True:
+        data = bedFile.read(blockSize)
+        if not data: break
+        block = leftover + data
+        cutPosition = block.rfind(b'\n') + 1
+        if block.count(b'\n', 0, cutPosition) % 2 != 0: cutPosition = block.rfind(b'\n', 0, cutPosition - 1) + 1
+        if cutPosition == 0:
+            leftover = block
+            continue
+        yield block[:cutPosition]
+        leftover = block[cutPosition:]
+
+    if leftover:
+        if not leftover.endswith(b'\n'): leftover += b'\n'
+        yield leftover
+
+
+class FullFragmentWriter:
+    """
+    Converts adjacent, concordant pairs of paired-end bed entries into full fragments and writes them to the given
+    output file. Entries are passed in one at a time (already split on tabs), so the writer can be fed by any loop
+    over a paired-end bed file, including loops that produce other output at the same time.
+    If validateConcordantPairs is true, the 4th (index 3) column of every pair is checked to make sure the entries
+    are ordered, concordant pairs.
+    If pairNonAdjacentMates is true, entries are instead paired on their read names (the 4th column, minus the final
+    mate number character) using a MatePairer, so companions don't need to be adjacent. In this case, pairs that
+    complete after held mates have been spilled to disk are written when the writer is closed, and mates without
+    a companion raise an error if validateConcordantPairs is true or a warning otherwise.
+    """
+
+    def __init__(self, outputFilePath, validateConcordantPairs = True,
+                 pairNonAdjacentMates = False, maxHeldMates = DEFAULT_MAX_HELD_MATES):
+        self.outputFilePath = outputFilePath
+        self.validateConcordantPairs = validateConcordantPairs
+        self.outputFile = open(outputFilePath, 'w')
+        self.companion1 = None
+        if pairNonAdjacentMates:
+            self.matePairer = MatePairer(lambda splitLine: (splitLine[3][:-1], splitLine[3][-1]), maxHeldMates,
+                                         os.path.join(os.path.dirname(os.path.abspath(outputFilePath)), ".tmp"))
+        else: self.matePairer = None
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None and self.matePairer is not None:
+                for companion1, companion2 in self.matePairer.finish():
+                    self.outputFile.write(getFullFragment(companion1, companion2, self.validateConcordantPairs))
+                if self.matePairer.unpairedMates > 0:
+                    message = f"Found {self.matePairer.unpairedMates} entries without a companion."
+                    if self.validateConcordantPairs: raise UserInputError(message)
+                    else: warnings.warn(message + " These entries were omitted.")
+        finally:
+            self.outputFile.close()
+            if self.matePairer is not None: self.matePairer.cleanUp()
+        if exc_type is None and self.companion1 is not None:
+            raise UserInputError(f"Found an entry without a companion at the end of the file:\n{self.companion1}")
+
+    def addEntry(self, splitLine: List[str]):
+        """
+        Adds the next bed entry. Every second entry (or, when pairing non-adjacent mates, every entry whose
+        companion has already been seen) completes a pair, which is written as a full fragment.
+        """
+        if self.matePairer is not None:
+            pair = self.matePairer.addMate(splitLine)
+            if pair is not None: self.outputFile.write(getFullFragment(*pair, self.validateConcordantPairs))
+            return
+
+        if self.companion1 is None:
+            self.companion1 = splitLine
+            return
+        companion1 = self.companion1
+        companion2 = splitLine
+        self.companion1 = None
+
+        self.outputFile.write(getFullFragment(companion1, companion2, self.validateConcordantPairs))
+
+
+# Returns the path to the full fragments bed file generated from the given paired-end bed file.
+def getFullFragmentsBedFilePath(bedFilePath):
+    basename = os.path.basename(bedFilePath).rsplit('.',1)[0]
+    return os.path.join(os.path.dirname(bedFilePath), basename+"_iNPS_PE_full_fragments.bed")
+
+
+# Converts a single paired-end bed file to a bed file of full fragments, returning the path to the output file.
+# (See bedMNasePEToBediNPSFullFragments for details.) The input is read and converted in large blocks
+# (see convertPairedEntryBlock), and any block that can't be converted that way is passed through a
+# FullFragmentWriter line-by-line instead. If pairNonAdjacentMates is true, every line goes through the
+# FullFragmentWriter so that mates can be paired by read name.
+def convertBedFileToFullFragments(bedFilePath, validateConcordantPairs = True,
+                                  pairNonAdjacentMates = False, maxHeldMates = DEFAULT_MAX_HELD_MATES):
+
+    print(f"Working with {os.path.basename(bedFilePath)}")
+
+    # Create the path to the output files.
+    fullFragmentsBedFilePath = getFullFragmentsBedFilePath(bedFilePath)
+
+    # Get the nucleosome mid points (estimated) from the paired end reads.
+    if validateConcordantPairs: print("Converting to full fragments bed file while validating pairs...")
+    else: print("Converting to full fragments bed file without validating pairs...")
+    if pairNonAdjacentMates:
+        with open(bedFilePath, 'r') as bedFile:
+            with FullFragmentWriter(fullFragmentsBedFilePath, validateConcordantPairs,
+                                    True, maxHeldMates) as fullFragmentWriter:
+                for line in bedFile: fullFragmentWriter.addEntry(line.strip().split('\t'))
+        return fullFragmentsBedFilePath
+
+    with open(bedFilePath, 'rb') as bedFile:
+        with FullFragmentWriter(fullFragmentsBedFilePath, validateConcordantPairs) as fullFragmentWriter:
+            for block in readPairedEntryBlocks(bedFile):
+                fullFragmentsBlock = convertPairedEntryBlock(block, validateConcordantPairs)
+                if fullFragmentsBlock is not None:
+                    fullFragmentWriter.outputFile.write(fullFragmentsBlock.decode())
+                else:
+                    for line in block.decode().split('\n')[:-1]: fullFragmentWriter.addEntry(line.strip().split('\t'))
+
+    return fullFragmentsBedFilePath
+
 
 # Given a list of bed files with paired entries, convert each to a bed file of full fragments derived from
 # each pair. Input bed files MUST contain only concordant pairs, and all entries must be adjacent to their companions.
 # If set to true, the validateConcordantPairs parameter will run a check on the 4th (index 3) column of every
-# pair of lines to make sure the above conditions are met. Returns a list of the generated output bed file paths.
-def bedMNasePEToBediNPSFullFragments(bedFilePaths: List[str], validateConcordantPairs = True):
+# pair of lines to make sure the above conditions are met.
+# If pairNonAdjacentMates is true, companions are matched by read name instead, so they do not need to be adjacent
+# (e.g. for coordinate-sorted input). At most maxHeldMates unmatched mates are held in memory before spilling to disk.
+# If workers is greater than 1, input files are converted concurrently in a pool of that many processes. In this case,
+# an error in one file is reported without stopping the others, and that file is left out of the results.
+# If shardByChromosome is true, each input file is instead split by chromosome, the chromosomes are converted
+# concurrently, and the results are merged back together in chromosome order.
+# Returns a list of the generated output bed file paths.
+def bedMNasePEToBediNPSFullFragments(bedFilePaths: List[str], validateConcordantPairs = True,
+                                     workers = 1, shardByChromosome = False,
+                                     pairNonAdjacentMates = False, maxHeldMates = DEFAULT_MAX_HELD_MATES):
 
-    fullFragmentsBedFilePaths = list()
+    conversionArgs = (validateConcordantPairs, pairNonAdjacentMates, maxHeldMates)
 
-    for bedFilePath in bedFilePaths:
+    fullFragmentsBedFilePaths = list()
 
-        print(f"Working with {os.path.basename(bedFilePath)}")
+    if shardByChromosome:
+        for bedFilePath in bedFilePaths:
+            print(f"Splitting {os.path.basename(bedFilePath)} by chromosome...")
+            shardDirectory = os.path.join(os.path.dirname(bedFilePath), ".tmp",
+                                          os.path.basename(bedFilePath).rsplit('.',1)[0] + "_chromosome_shards")
+            try:
+                shardFullFragmentsBedFilePaths = mapChromosomeShardsInPool(convertBedFileToFullFragments, bedFilePath,
+                                                                           shardDirectory, workers, *conversionArgs)
+                print(f"Merging chromosome outputs for {os.path.basename(bedFilePath)}...")
+                concatenateFiles(shardFullFragmentsBedFilePaths, getFullFragmentsBedFilePath(bedFilePath))
+                fullFragmentsBedFilePaths.append(getFullFragmentsBedFilePath(bedFilePath))
+            except Exception:
+                if len(bedFilePaths) == 1: raise
+                print(f"Error encountered while processing {os.path.basename(bedFilePath)}. Skipping.")
+                traceback.print_exc()
+            finally:
+                shutil.rmtree(shardDirectory, ignore_errors = True)
 
-        # Create the path to the output files.
-        basename = os.path.basename(bedFilePath).rsplit('.',1)[0]
-        fullFragmentsBedFilePath = os.path.join(os.path.dirname(bedFilePath), basename+"_iNPS_PE_full_fragments.bed")
+    elif workers > 1:
+        for fullFragmentsBedFilePath in mapFilesInPool(convertBedFileToFullFragments, bedFilePaths,
+                                                       workers, *conversionArgs):
+            if fullFragmentsBedFilePath is not None: fullFragmentsBedFilePaths.append(fullFragmentsBedFilePath)
 
-        
-        # Get the nucleosome mid points (estimated) from the paired end reads.
-        if validateConcordantPairs: print("Converting to full fragments bed file while validating pairs...")
-        else: print("Converting to full fragments bed file without validating pairs...")
-        with open(bedFilePath, 'r') as bedFile:
-            with open(fullFragmentsBedFilePath, 'w') as fullFragmentsBedFile:
-                for companion1 in bedFile:
-                    companion1 = companion1.strip().split('\t')
-                    companion2 = bedFile.readline().strip().split('\t')
-
-                    if validateConcordantPairs:
-                        if (not companion1[3].endswith('1') or not companion2[3].endswith('2') or
-                            companion1[3][:-1] != companion2[3][:-1]):
-                            raise UserInputError(f"Found adjacent reads that are not ordered, "
-                                                 f"concordant pairs:\n{companion1}\n{companion2}")
-
-                    if companion1[5] == '+':
-                        fullFragmentStart = companion1[1]
-                        fullFragmentEnd = companion2[2]
-                    elif companion2[5] == '+':
-                        fullFragmentStart = companion2[1]
-                        fullFragmentEnd = companion1[2]
-                    else:
-                        raise UserInputError("Neither entry in the following concordant pair is on the \'+\' strand.\n"
-                                             f"{companion1}\n{companion2}")
-
-                    fullFragmentsBedFile.write('\t'.join((companion1[0], fullFragmentStart, fullFragmentEnd)) + '\n')
-
-        fullFragmentsBedFilePaths.append(fullFragmentsBedFilePath)
+    else:
+        for bedFilePath in bedFilePaths:
+            fullFragmentsBedFilePaths.append(convertBedFileToFullFragments(bedFilePath, *conversionArgs))
 
     return fullFragmentsBedFilePaths
 
@@ -67,8 +325,14 @@ def main():
     with TkinterDialog(workingDirectory = workingDirectory) as dialog:
         dialog.createMultipleFileSelector("MNase PE Bed Files:", 0, ".bed", ("Bed Files", ".bed"))
         dialog.createCheckbox("Validate concordant pairs", 1, 0)
+        dialog.createTextField("Worker processes:", 2, 0, defaultText = "1")
+        dialog.createCheckbox("Split files by chromosome", 3, 0)
+        dialog.createCheckbox("Pair non-adjacent mates (e.g. coordinate-sorted input)", 4, 0)
 
-    bedMNasePEToBediNPSFullFragments(dialog.selections.getFilePathGroups()[0], dialog.selections.getToggleStates()[0])
+    workers = checkForNumber(dialog.selections.getTextEntries()[0], True, lambda x: x > 0)
+    bedMNasePEToBediNPSFullFragments(dialog.selections.getFilePathGroups()[0], dialog.selections.getToggleStates()[0],
+                                     workers, dialog.selections.getToggleStates()[1],
+                                     dialog.selections.getToggleStates()[2])
 
 
 if __name__ == "__main__": main()
\ No newline at end of file
@@ -3,171 +3,517 @@
 # midpoints, which are assumed to be 73 bp 3' from the 5' end of each entry.
 # Next, the resulting data is sorted and optionally converted to fixed-step wig, or a wig-like bed format. (for
 # use in the BBG pipeline)
-import os, subprocess
-from typing import List
+# Alternatively, midpoints can be counted directly into per-chromosome arrays (using a chrom.sizes file), which
+# skips the intermediate midpoints file and the sorting step entirely.
+import os, shutil, subprocess, traceback, warnings
+from contextlib import nullcontext
+import numpy as np
+from typing import List, Dict, Tuple, Iterable, Union
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
 from benbiohelpers.FileSystemHandling.DirectoryHandling import checkDirs
+from benbiohelpers.CustomErrors import UserInputError, checkForNumber
+from CoverageStore import CoverageStoreWriter, mergeCoverageStores, PLUS_STRAND, MINUS_STRAND
+from GenomeIndex import getChromSizes, FASTA_FILE_ENDINGS
+from ParallelProcessing import mapFilesInPool, mapChromosomeShardsInPool, concatenateFiles
+from BedMNasePEToBediNPSFullFragments import FullFragmentWriter, getFullFragmentsBedFilePath, bedMNasePEToBediNPSFullFragments
+from MatePairing import DEFAULT_MAX_HELD_MATES
 
 SIMPLE_BED = "Simple bed"
 FIXED_STEP_WIG = "Fixed-step wig"
 WIG_LIKE_BED = "Wig-like bed"
 STRANDED_WIG_LIKE_BED = "Stranded wig-like bed"
+VARIABLE_STEP_WIG = "Variable-step wig"
+BEDGRAPH = "bedGraph"
+BINARY_COVERAGE = "Binary coverage store"
+INPS_FULL_FRAGMENTS = "iNPS full fragments"
+
+# All output formats, in the order their file paths are returned.
+OUTPUT_FORMATS = (SIMPLE_BED, FIXED_STEP_WIG, WIG_LIKE_BED, STRANDED_WIG_LIKE_BED,
+                  VARIABLE_STEP_WIG, BEDGRAPH, BINARY_COVERAGE, INPS_FULL_FRAGMENTS)
+
+# Output formats which are always generated from midpoint count arrays, and therefore require a chrom.sizes file.
+COUNT_ARRAY_FORMATS = (VARIABLE_STEP_WIG, BEDGRAPH, BINARY_COVERAGE)
+
+# The data type used for midpoint count arrays, and the number of midpoints buffered before they are added to them.
+COUNT_DTYPE = np.uint32
+MIDPOINT_BUFFER_SIZE = 1000000
+# The number of array values converted to text at a time when writing count arrays out to a file.
+WRITE_BLOCK_SIZE = 1000000
+
+
+# Counts the nucleosome midpoints derived from the given paired-end bed file directly into count arrays, one for each
+# strand of each chromosome. Array indices are the 0-based midpoint positions (the bed start coordinate).
+# Midpoints are buffered and added to the arrays in bulk, so nothing is written to disk and no sorting is required.
+# If a FullFragmentWriter is given, every entry is also passed to it, so full fragments are written in the same pass.
+# If a midpointEntries dictionary is given, the position and original score of every counted midpoint are also added
+# to it, in input order, as lists of position arrays and score strings for each (chromosome, strand).
+# Returns a dictionary mapping chromosomes to (plus strand counts, minus strand counts) tuples. Only chromosomes
+# with at least one midpoint are included.
+def countNucleosomeMids(bedFilePath, chromSizes: Dict[str, int], fullFragmentWriter: FullFragmentWriter = None,
+                        midpointEntries: Dict[Tuple[str, str], Tuple[List[np.ndarray], List[str]]] = None
+                        ) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+
+    countArrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = dict()
+    midpointBuffers: Dict[Tuple[str, str], List[int]] = dict()
+    scoreBuffers: Dict[Tuple[str, str], List[str]] = dict()
+    bufferedMidpoints = 0
+    skippedChromosomes = set()
+    outOfBoundsMidpoints = 0
+
+    # Adds all buffered midpoints to their respective count arrays and clears the buffers.
+    def flushMidpointBuffers():
+        for (chromosome, strand), midpointStarts in midpointBuffers.items():
+            if chromosome not in countArrays:
+                countArrays[chromosome] = (np.zeros(chromSizes[chromosome], COUNT_DTYPE),
+                                           np.zeros(chromSizes[chromosome], COUNT_DTYPE))
+            midpointStarts = np.array(midpointStarts, dtype = np.int64)
+            positions, counts = np.unique(midpointStarts, return_counts = True)
+            countArrays[chromosome][0 if strand == '+' else 1][positions] += counts.astype(COUNT_DTYPE)
+            if midpointEntries is not None:
+                entryPositions, entryScores = midpointEntries.setdefault((chromosome, strand), (list(), list()))
+                entryPositions.append(midpointStarts)
+                entryScores += scoreBuffers[(chromosome, strand)]
+        midpointBuffers.clear()
+        scoreBuffers.clear()
+
+    with open(bedFilePath, 'r') as bedFile:
+        for line in bedFile:
+            splitLine = line.strip().split('\t')
+            if fullFragmentWriter is not None: fullFragmentWriter.addEntry(splitLine)
+            chromosome = splitLine[0]
+            strand = splitLine[5]
+
+            if strand == '+': midpointStart = int(splitLine[1]) + 73
+            elif strand == '-': midpointStart = int(splitLine[2]) - 74
+            else: continue
+
+            if midpointStart < 73: continue
+
+            if chromosome not in chromSizes:
+                if chromosome not in skippedChromosomes:
+                    skippedChromosomes.add(chromosome)
+                    warnings.warn(f"Chromosome {chromosome} not found in chrom.sizes file. "
+                                  "Omitting all associated midpoints.")
+                continue
+            if midpointStart >= chromSizes[chromosome]:
+                outOfBoundsMidpoints += 1
+                continue
+
+            midpointBuffers.setdefault((chromosome, strand), list()).append(midpointStart)
+            if midpointEntries is not None: scoreBuffers.setdefault((chromosome, strand), list()).append(splitLine[4])
+            bufferedMidpoints += 1
+            if bufferedMidpoints == MIDPOINT_BUFFER_SIZE:
+                flushMidpointBuffers()
+                bufferedMidpoints = 0
+
+    flushMidpointBuffers()
+    if outOfBoundsMidpoints > 0:
+        warnings.warn(f"Omitted {outOfBoundsMidpoints} midpoints that fell outside of their chromosome's bounds.")
+
+    return countArrays
+
+
+# Writes the given midpoint entries (see countNucleosomeMids) as a simple bed file identical to the sorted output:
+# entries are ordered by position and then strand, with ties kept in input order, and keep their original scores.
+# This only needs an in-memory stable sort of each chromosome's positions, rather than sorting the file on disk.
+def writeSimpleBedFromMidpoints(midpointEntries: Dict[Tuple[str, str], Tuple[List[np.ndarray], List[str]]],
+                                outputFilePath):
+
+    with open(outputFilePath, 'w') as outputFile:
+        for chromosome in sorted({chromosome for chromosome, _ in midpointEntries}):
+            positions, scores, strands = list(), list(), list()
+            for strand in ('+', '-'):
+                if (chromosome, strand) not in midpointEntries: continue
+                entryPositions, entryScores = midpointEntries[(chromosome, strand)]
+                positions += entryPositions
+                scores += entryScores
+                strands.append(np.full(len(entryScores), strand == '-'))
+            positions, strands = np.concatenate(positions), np.concatenate(strands)
+            order = np.argsort(positions*2 + strands, kind = "stable")
+
+            for blockStart in range(0, len(order), WRITE_BLOCK_SIZE):
+                blockOrder = order[blockStart:blockStart + WRITE_BLOCK_SIZE]
+                outputFile.write(''.join([f"{chromosome}\t{position}\t{position+1}\t.\t{scores[i]}\t"
+                                          f"{'-' if isMinus else '+'}\n" for i, position, isMinus in
+                                          zip(blockOrder.tolist(), positions[blockOrder].tolist(),
+                                              strands[blockOrder].tolist())]))
+
+
+# Writes the given count arrays to a fixed-step (1) wig file, combining counts from both strands.
+def writeFixedStepWigFromCounts(countArrays: Dict[str, Tuple[np.ndarray, np.ndarray]], outputFilePath):
+
+    with open(outputFilePath, 'w') as outputFile:
+        for chromosome in sorted(countArrays):
+            print(f"Creating fixed step entry for {chromosome}")
+            counts = countArrays[chromosome][0] + countArrays[chromosome][1]
+            outputFile.write(f"fixedStep chrom={chromosome} start=1 step=1\n")
+            for blockStart in range(0, len(counts), WRITE_BLOCK_SIZE):
+                outputFile.write('\n'.join(map(str, counts[blockStart:blockStart+WRITE_BLOCK_SIZE].tolist())) + '\n')
+
+
+# Writes a run of zero-count lines to the given (fixed-step wig) file in large blocks.
+def writeZeroRun(outputFile, runLength):
+    while runLength > 0:
+        blockLength = min(runLength, WRITE_BLOCK_SIZE)
+        outputFile.write("0\n"*blockLength)
+        runLength -= blockLength
+
+
+# Run-length encodes the given counts array, returning the start positions, end positions (exclusive), and counts
+# of every run of equal, non-zero values.
+def getNonZeroRuns(counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+
+    runStarts = np.concatenate(([0], np.flatnonzero(np.diff(counts)) + 1))
+    runEnds = np.append(runStarts[1:], len(counts))
+    runCounts = counts[runStarts]
+    nonZeroRuns = runCounts != 0
+    return runStarts[nonZeroRuns], runEnds[nonZeroRuns], runCounts[nonZeroRuns]
+
+
+# Writes the given count arrays to a bedGraph file, combining counts from both strands.
+# Adjacent positions with equal counts are collapsed into a single entry, and positions without midpoints are omitted.
+def writeBedGraphFromCounts(countArrays: Dict[str, Tuple[np.ndarray, np.ndarray]], outputFilePath):
+
+    with open(outputFilePath, 'w') as outputFile:
+        for chromosome in sorted(countArrays):
+            runStarts, runEnds, runCounts = getNonZeroRuns(countArrays[chromosome][0] + countArrays[chromosome][1])
+            for blockStart in range(0, len(runStarts), WRITE_BLOCK_SIZE):
+                blockEnd = blockStart + WRITE_BLOCK_SIZE
+                outputFile.write(''.join([f"{chromosome}\t{runStart}\t{runEnd}\t{runCount}\n" for runStart, runEnd, runCount in
+                                          zip(runStarts[blockStart:blockEnd].tolist(), runEnds[blockStart:blockEnd].tolist(),
+                                              runCounts[blockStart:blockEnd].tolist())]))
+
+
+# Writes the given count arrays to a variable-step wig file, combining counts from both strands.
+# Positions without midpoints are omitted. Since the span of a variableStep declaration applies to all of its entries,
+# runs of equal counts are written in position order, with a new declaration whenever the run length changes.
+def writeVariableStepWigFromCounts(countArrays: Dict[str, Tuple[np.ndarray, np.ndarray]], outputFilePath):
+
+    with open(outputFilePath, 'w') as outputFile:
+        for chromosome in sorted(countArrays):
+            runStarts, runEnds, runCounts = getNonZeroRuns(countArrays[chromosome][0] + countArrays[chromosome][1])
+            runLengths = runEnds - runStarts
+            spanBoundaries = np.concatenate(([0], np.flatnonzero(np.diff(runLengths)) + 1, [len(runLengths)]))
+            runStarts, runCounts = (runStarts + 1).tolist(), runCounts.tolist()
+            outputLines = list()
+            for sectionStart, sectionEnd in zip(spanBoundaries[:-1].tolist(), spanBoundaries[1:].tolist()):
+                outputLines.append(f"variableStep chrom={chromosome} span={runLengths[sectionStart]}\n")
+                outputLines.extend([f"{runStart} {runCount}\n" for runStart, runCount in
+                                    zip(runStarts[sectionStart:sectionEnd], runCounts[sectionStart:sectionEnd])])
+                if len(outputLines) >= WRITE_BLOCK_SIZE:
+                    outputFile.write(''.join(outputLines))
+                    outputLines.clear()
+            outputFile.write(''.join(outputLines))
+
+
+# Writes the given count arrays to a binary coverage store directory (see CoverageStore), with separate
+# arrays for each strand.
+def writeCoverageStoreFromCounts(countArrays: Dict[str, Tuple[np.ndarray, np.ndarray]], chromSizes: Dict[str, int],
+                                 outputDirectory):
+
+    with CoverageStoreWriter(outputDirectory, chromSizes) as coverageStoreWriter:
+        for chromosome in sorted(countArrays):
+            coverageStoreWriter.writeCounts(chromosome, PLUS_STRAND, countArrays[chromosome][0])
+            coverageStoreWriter.writeCounts(chromosome, MINUS_STRAND, countArrays[chromosome][1])
+
+
+# Writes the given count arrays to a wig-like bed file, with one entry for every position with at least one midpoint.
+# If stranded is true, each strand receives its own entries, and the strand is given in the sixth (index 5) column.
+# Otherwise, counts from both strands are combined.
+def writeWigLikeBedFromCounts(countArrays: Dict[str, Tuple[np.ndarray, np.ndarray]], outputFilePath, stranded = False):
+
+    with open(outputFilePath, 'w') as outputFile:
+        for chromosome in sorted(countArrays):
+            plusCounts, minusCounts = countArrays[chromosome]
+            if stranded:
+                positions = np.flatnonzero(plusCounts | minusCounts)
+                outputLines = list()
+                for position, plusCount, minusCount in zip(positions.tolist(), plusCounts[positions].tolist(),
+                                                           minusCounts[positions].tolist()):
+                    if plusCount: outputLines.append(f"{chromosome}\t{position}\t{position+1}\t{plusCount}\t.\t+\n")
+                    if minusCount: outputLines.append(f"{chromosome}\t{position}\t{position+1}\t{minusCount}\t.\t-\n")
+            else:
+                counts = plusCounts + minusCounts
+                positions = np.flatnonzero(counts)
+                outputLines = [f"{chromosome}\t{position}\t{position+1}\t{count}\n"
+                               for position, count in zip(positions.tolist(), counts[positions].tolist())]
+            outputFile.write(''.join(outputLines))
+
+
+# Returns a dictionary of the output file paths (or directory, for the binary coverage store) for each output format,
+# given the input bed file path. Unless the simple bed format is requested (or midpoints are counted without sorting),
+# the simple bed path points to an intermediate file in a .tmp directory.
+def getNucleosomeMidsOutputFilePaths(bedFilePath, outputFormats, sortFree) -> Dict[str, str]:
+
+    basename = os.path.basename(bedFilePath).rsplit('.',1)[0]
+    if SIMPLE_BED in outputFormats or sortFree:
+        bedNucleosomeMidsFilePath = os.path.join(os.path.dirname(bedFilePath), basename+"_nucleosome_mids.bed")
+    else:
+        tempDir = os.path.join(os.path.dirname(bedFilePath), ".tmp")
+        checkDirs(tempDir)
+        bedNucleosomeMidsFilePath = os.path.join(tempDir, basename+"_nucleosome_mids.bed")
+    wigNucleosomeMidsFilePath = os.path.join(os.path.dirname(bedFilePath), basename+"_nucleosome_mids.wig")
+    wigLikeNucleosomeMidsFilePath = os.path.join(os.path.dirname(bedFilePath), basename+"_wig-like_nucleosome_mids.bed")
+    strandedWigLikeNucleosomeMidsFilePath = os.path.join(os.path.dirname(bedFilePath), basename+"_wig-like_nucleosome_mids_stranded.bed")
+    variableStepWigNucleosomeMidsFilePath = os.path.join(os.path.dirname(bedFilePath), basename+"_nucleosome_mids_variable_step.wig")
+    bedGraphNucleosomeMidsFilePath = os.path.join(os.path.dirname(bedFilePath), basename+"_nucleosome_mids.bedGraph")
+    coverageStoreNucleosomeMidsDirectory = os.path.join(os.path.dirname(bedFilePath), basename+"_nucleosome_mids_coverage")
+    fullFragmentsBedFilePath = getFullFragmentsBedFilePath(bedFilePath)
+    return {SIMPLE_BED: bedNucleosomeMidsFilePath, FIXED_STEP_WIG: wigNucleosomeMidsFilePath,
+            WIG_LIKE_BED: wigLikeNucleosomeMidsFilePath,
+            STRANDED_WIG_LIKE_BED: strandedWigLikeNucleosomeMidsFilePath,
+            VARIABLE_STEP_WIG: variableStepWigNucleosomeMidsFilePath,
+            BEDGRAPH: bedGraphNucleosomeMidsFilePath, BINARY_COVERAGE: coverageStoreNucleosomeMidsDirectory,
+            INPS_FULL_FRAGMENTS: fullFragmentsBedFilePath}
+
+
+# Converts a single paired-end bed file to each of the given nucleosome midpoint output formats.
+# (See bedMNasePEToNucleosomeMids for details.) chromSizes is only required if sortFree is true or fixed-step wig
+# output is requested. Returns the output file paths, ordered as in OUTPUT_FORMATS.
+def convertBedFileToNucleosomeMids(bedFilePath, chromSizes: Dict[str, int], outputFormats, sortFree,
+                                   validateConcordantPairs, pairNonAdjacentMates = False,
+                                   maxHeldMates = DEFAULT_MAX_HELD_MATES) -> List[str]:
+
+    print(f"\nWorking with {os.path.basename(bedFilePath)}")
+
+    outputFilePaths = getNucleosomeMidsOutputFilePaths(bedFilePath, outputFormats, sortFree)
+
+    # If requested, set up the full fragments writer so that it receives every entry as the input is read.
+    if INPS_FULL_FRAGMENTS in outputFormats:
+        fullFragmentWriter = FullFragmentWriter(outputFilePaths[INPS_FULL_FRAGMENTS], validateConcordantPairs,
+                                                pairNonAdjacentMates, maxHeldMates)
+    else: fullFragmentWriter = None
+
+    # If requested, count midpoints directly into arrays and write the requested output from them.
+    if sortFree:
+
+        print("Counting midpoints from paired reads...")
+        midpointEntries = dict() if SIMPLE_BED in outputFormats else None
+        with fullFragmentWriter or nullcontext():
+            countArrays = countNucleosomeMids(bedFilePath, chromSizes, fullFragmentWriter, midpointEntries)
+
+        if SIMPLE_BED in outputFormats:
+            print("Writing midpoints to simple bed file...")
+            writeSimpleBedFromMidpoints(midpointEntries, outputFilePaths[SIMPLE_BED])
+            del midpointEntries
+        if FIXED_STEP_WIG in outputFormats:
+            print("Converting to fixed step wig file...")
+            writeFixedStepWigFromCounts(countArrays, outputFilePaths[FIXED_STEP_WIG])
+        if WIG_LIKE_BED in outputFormats:
+            print("Converting to wig-like bed file...")
+            writeWigLikeBedFromCounts(countArrays, outputFilePaths[WIG_LIKE_BED])
+        if STRANDED_WIG_LIKE_BED in outputFormats:
+            print("Converting to wig-like bed file with strand information...")
+            writeWigLikeBedFromCounts(countArrays, outputFilePaths[STRANDED_WIG_LIKE_BED], stranded = True)
+        if VARIABLE_STEP_WIG in outputFormats:
+            print("Converting to variable step wig file...")
+            writeVariableStepWigFromCounts(countArrays, outputFilePaths[VARIABLE_STEP_WIG])
+        if BEDGRAPH in outputFormats:
+            print("Converting to bedGraph file...")
+            writeBedGraphFromCounts(countArrays, outputFilePaths[BEDGRAPH])
+        if BINARY_COVERAGE in outputFormats:
+            print("Writing binary coverage store...")
+            writeCoverageStoreFromCounts(countArrays, chromSizes, outputFilePaths[BINARY_COVERAGE])
+
+        return [outputFilePaths[thisFormat] for thisFormat in OUTPUT_FORMATS if thisFormat in outputFormats]
+
+    # Get the nucleosome mid points (estimated) from the paired end reads.
+    print("Retrieving midpoints from paired reads...")
+    with open(bedFilePath, 'r') as bedFile:
+        with open(outputFilePaths[SIMPLE_BED], 'w') as bedNucleosomeMidsFile, fullFragmentWriter or nullcontext():
+            for line in bedFile:
+                splitLine = line.strip().split('\t')
+                if fullFragmentWriter is not None: fullFragmentWriter.addEntry(splitLine)
+
+                if splitLine[5] == '+':
+                    midpointStart = int(splitLine[1]) + 73
+                    midpointEnd = midpointStart + 1
+                elif splitLine[5] == '-':
+                    midpointEnd = int(splitLine[2]) - 73
+                    midpointStart = midpointEnd - 1
+
+                if midpointStart < 73: continue
+
+                bedNucleosomeMidsFile.write('\t'.join((splitLine[0], str(midpointStart), str(midpointEnd),
+                                                       '.', splitLine[4], splitLine[5])) + '\n')
+
+    # Sort the nucleosome mids bed file in place.
+    print("Sorting midpoints...")
+    subprocess.check_call(("sort","-k1,1","-k2,2n", "-k6,6", "-s", "-o", outputFilePaths[SIMPLE_BED], outputFilePaths[SIMPLE_BED]))
+
+    # If "Fixed-step wig" output was selected, convert the file to a fixed step (1) wig file using the chrom.sizes dictionary.
+    if FIXED_STEP_WIG in outputFormats:
+
+        print("Converting to fixed step wig file...")
+        with open(outputFilePaths[SIMPLE_BED], 'r') as bedNucleosomeMidsFile:
+            with open(outputFilePaths[FIXED_STEP_WIG], 'w') as wigNucleosomeMidsFile:
+
+                currentChrom = None
+                for line in bedNucleosomeMidsFile:
+                    splitLine = line.strip().split('\t')
 
-# Given a list of bed files with paired entries, convert each to a fixed step wig file containing
-# counts for nucleosome midpoints. Note that this requires a chrom.sizes file as well.
-# Output format can be either fixed-step wig or a wig-like bed, containing bed entries with counts in
-# the fourth (index 3) column
-# Returns a list of the generated nucleosome file paths.
-def bedMNasePEToNucleosomeMids(bedFilePaths: List[str], chromSizesFilePath, outputFormat):
+                    # Check for a new (or the first) chromsoome.
+                    if currentChrom is None or splitLine[0] != currentChrom:
+                        # Make sure to finish the last chromosome.
+                        if currentChrom is not None:
+                            wigNucleosomeMidsFile.write(str(currentCount) + '\n')
+                            writeZeroRun(wigNucleosomeMidsFile, maxPos - currentPos)
+
+                        currentChrom = splitLine[0]
+                        print(f"Creating fixed step entry for {currentChrom}")
+                        maxPos = chromSizes[currentChrom]
+                        currentPos = 1
+                        currentCount = 0
+                        wigNucleosomeMidsFile.write(f"fixedStep chrom={splitLine[0]} start=1 step=1\n")
+
+                    # For each bed entry, see if we've reached it in the wig file. Once we have, increment current count.
+                    # Otherwise, step through the wig file until we reach the bed entry, writing counts as we go.
+                    bedEntryPos = int(splitLine[2])
+                    if bedEntryPos > currentPos:
+                        wigNucleosomeMidsFile.write(str(currentCount) + '\n')
+                        writeZeroRun(wigNucleosomeMidsFile, bedEntryPos - currentPos - 1)
+                        currentCount = 0
+                        currentPos = bedEntryPos
+                    assert bedEntryPos == currentPos, f"Bed entry: {splitLine}\nCurrent position: {currentPos}"
+                    currentCount += 1
 
-    nucleosomeMidsOutputFilePaths = list()
+                # Make sure to finish the current chromosome in the wig file after iterating through the bed file.
+                if currentChrom is not None:
+                    wigNucleosomeMidsFile.write(str(currentCount) + '\n')
+                    writeZeroRun(wigNucleosomeMidsFile, maxPos - currentPos)
 
-    for bedFilePath in bedFilePaths:
 
-        print(f"\nWorking with {os.path.basename(bedFilePath)}")
+    # If "Wig-like bed" output was selected, count/merge bed entries to create the wig-like bed output.
+    if WIG_LIKE_BED in outputFormats:
 
-        # Create paths to output files.
-        tempDir = os.path.join(os.path.dirname(bedFilePath), ".tmp")
-        checkDirs(tempDir)
-        basename = os.path.basename(bedFilePath).rsplit('.',1)[0]
-        if outputFormat == SIMPLE_BED:
-            bedNucleosomeMidsFilePath = os.path.join(os.path.dirname(bedFilePath), basename+"_nucleosome_mids.bed")
-        else:
-            bedNucleosomeMidsFilePath = os.path.join(tempDir, basename+"_nucleosome_mids.bed")
-        wigNucleosomeMidsFilePath = os.path.join(os.path.dirname(bedFilePath), basename+"_nucleosome_mids.wig")
-        wigLikeNucleosomeMidsFilePath = os.path.join(os.path.dirname(bedFilePath), basename+"_wig-like_nucleosome_mids.bed")
-        strandedWigLikeNucleosomeMidsFilePath = os.path.join(os.path.dirname(bedFilePath), basename+"_wig-like_nucleosome_mids_stranded.bed")
-
-        # Get the nucleosome mid points (estimated) from the paired end reads.
-        print("Retrieving midpoints from paired reads...")
-        with open(bedFilePath, 'r') as bedFile:
-            with open(bedNucleosomeMidsFilePath, 'w') as bedNucleosomeMidsFile:
-                for line in bedFile:
+        print("Converting to wig-like bed file...")
+        with open(outputFilePaths[SIMPLE_BED], 'r') as bedNucleosomeMidsFile:
+            with open(outputFilePaths[WIG_LIKE_BED], 'w') as wigLikeNucleosomeMidsFile:
+
+                lastEntry = None
+                currentCount = 0
+                for line in bedNucleosomeMidsFile:
                     splitLine = line.strip().split('\t')
 
-                    if splitLine[5] == '+':
-                        midpointStart = int(splitLine[1]) + 73
-                        midpointEnd = midpointStart + 1
-                    elif splitLine[5] == '-':
-                        midpointEnd = int(splitLine[2]) - 73
-                        midpointStart = midpointEnd - 1
+                    # Compare this entry with the last. If it matches, just iterate the count.
+                    # If it doesn't, write the last Entry and its count and reset both.
+                    if lastEntry is not None and lastEntry[:2] == splitLine[:2]: currentCount += 1
+                    else:
+                        if lastEntry is not None: wigLikeNucleosomeMidsFile.write('\t'.join(lastEntry[:3] + [str(currentCount)]) + '\n')
+                        lastEntry = splitLine
+                        currentCount = 1
 
-                    if midpointStart < 73: continue
+                # Make sure to finish the current entry after iterating through the bed file.
+                if lastEntry is not None: wigLikeNucleosomeMidsFile.write('\t'.join(lastEntry[:3] + [str(currentCount)]) + '\n')
 
-                    bedNucleosomeMidsFile.write('\t'.join((splitLine[0], str(midpointStart), str(midpointEnd),
-                                                           '.', splitLine[4], splitLine[5])) + '\n')
 
-        # Sort the nucleosome mids bed file in place.
-        print("Sorting midpoints...")
-        subprocess.check_call(("sort","-k1,1","-k2,2n", "-k6,6", "-s", "-o", bedNucleosomeMidsFilePath, bedNucleosomeMidsFilePath))
+    # If "Stranded wig-like bed" output was selected, count/merge bed entries to create the wig-like bed output preserving strand information.
+    if STRANDED_WIG_LIKE_BED in outputFormats:
 
-        # If "Fixed-step wig" output was selected, convert the file to a fixed step (1) wig file using the chrom.sizes dictionary.
-        if outputFormat == FIXED_STEP_WIG:
+        print("Converting to wig-like bed file with strand information...")
+        with open(outputFilePaths[SIMPLE_BED], 'r') as bedNucleosomeMidsFile:
+            with open(outputFilePaths[STRANDED_WIG_LIKE_BED], 'w') as strandedWigLikeNucleosomeMidsFile:
 
-            print("Parsing chrom.sizes file...")
-            chromSizes = dict()
-            with open(chromSizesFilePath, 'r') as chromSizesFile:
-                for line in chromSizesFile:
-                    chromosome, size = line.strip().split('\t')
-                    chromSizes[chromosome] = int(size)
+                lastEntry = None
+                currentCount = 0
+                for line in bedNucleosomeMidsFile:
+                    splitLine = line.strip().split('\t')
 
-            print("Converting to fixed step wig file...")
-            with open(bedNucleosomeMidsFilePath, 'r') as bedNucleosomeMidsFile:
-                with open(wigNucleosomeMidsFilePath, 'w') as wigNucleosomeMidsFile:
-
-                    currentChrom = None
-                    for line in bedNucleosomeMidsFile:
-                        splitLine = line.strip().split('\t')
-
-                        # Check for a new (or the first) chromsoome.
-                        if currentChrom is None or splitLine[0] != currentChrom:
-                            # Make sure to finish the last chromosome.
-                            if currentChrom is not None:
-                                wigNucleosomeMidsFile.write(str(currentCount) + '\n')
-                                currentPos += 1
-                                while currentPos <= maxPos:
-                                    wigNucleosomeMidsFile.write("0\n")
-                                    currentPos += 1
-
-                            currentChrom = splitLine[0]
-                            print(f"Creating fixed step entry for {currentChrom}")
-                            maxPos = chromSizes[currentChrom]
-                            currentPos = 1
-                            currentCount = 0
-                            wigNucleosomeMidsFile.write(f"fixedStep chrom={splitLine[0]} start=1 step=1\n")
-
-                        # For each bed entry, see if we've reached it in the wig file. Once we have, increment current count.
-                        # Otherwise, step through the wig file until we reach the bed entry, writing counts as we go.
-                        bedEntryPos = int(splitLine[2])
-                        while bedEntryPos > currentPos:
-                            wigNucleosomeMidsFile.write(str(currentCount) + '\n')
-                            currentCount = 0
-                            currentPos += 1
-                        assert bedEntryPos == currentPos, f"Bed entry: {splitLine}\nCurrent position: {currentPos}"
-                        currentCount += 1
+                    # Compare this entry with the last. If it matches, just iterate the count.
+                    # If it doesn't, write the last Entry and its count and reset both.
+                    if lastEntry is not None and lastEntry[:2] + [lastEntry[5]] == splitLine[:2] + [splitLine[5]]: currentCount += 1
+                    else:
+                        if lastEntry is not None:
+                            strandedWigLikeNucleosomeMidsFile.write('\t'.join(lastEntry[:3] + [str(currentCount), '.', lastEntry[5]]) + '\n')
+                        lastEntry = splitLine
+                        currentCount = 1
 
-                    # Make sure to finish the current chromosome in the wig file after iterating through the bed file.
-                    if currentChrom is not None:
-                        wigNucleosomeMidsFile.write(str(currentCount) + '\n')
-                        currentPos += 1
-                        while currentPos <= maxPos:
-                            wigNucleosomeMidsFile.write("0\n")
-                            currentPos += 1
+                # Make sure to finish the current entry after iterating through the bed file.
+                if lastEntry is not None:
+                    strandedWigLikeNucleosomeMidsFile.write('\t'.join(lastEntry[:3] + [str(currentCount), '.', lastEntry[5]]) + '\n')
 
-            nucleosomeMidsOutputFilePaths.append(wigNucleosomeMidsFilePath)
 
-        # If "Wig-like bed" output was selected, count/merge bed entries to create the wig-like bed output.
-        elif outputFormat == WIG_LIKE_BED:
+    return [outputFilePaths[thisFormat] for thisFormat in OUTPUT_FORMATS if thisFormat in outputFormats]
 
-            print("Converting to wig-like bed file...")
-            with open(bedNucleosomeMidsFilePath, 'r') as bedNucleosomeMidsFile:
-                with open(wigLikeNucleosomeMidsFilePath, 'w') as wigLikeNucleosomeMidsFile:
-
-                    lastEntry = None
-                    currentCount = 0
-                    for line in bedNucleosomeMidsFile:
-                        splitLine = line.strip().split('\t')
-
-                        # Compare this entry with the last. If it matches, just iterate the count.
-                        # If it doesn't, write the last Entry and its count and reset both.
-                        if lastEntry is not None and lastEntry[:2] == splitLine[:2]: currentCount += 1
-                        else:
-                            if lastEntry is not None: wigLikeNucleosomeMidsFile.write('\t'.join(lastEntry[:3] + [str(currentCount)]) + '\n')
-                            lastEntry = splitLine
-                            currentCount = 1
-                    
-                    # Make sure to finish the current entry after iterating through the bed file.
-                    if lastEntry is not None: wigLikeNucleosomeMidsFile.write('\t'.join(lastEntry[:3] + [str(currentCount)]) + '\n')
-                        
-            nucleosomeMidsOutputFilePaths.append(wigLikeNucleosomeMidsFilePath)
-
-        # If "Stranded wig-like bed" output was selected, count/merge bed entries to create the wig-like bed output preserving strand information.
-        elif outputFormat == STRANDED_WIG_LIKE_BED:
 
-            print("Converting to wig-like bed file with strand information...")
-            with open(bedNucleosomeMidsFilePath, 'r') as bedNucleosomeMidsFile:
-                with open(strandedWigLikeNucleosomeMidsFilePath, 'w') as strandedWigLikeNucleosomeMidsFile:
-
-                    lastEntry = None
-                    currentCount = 0
-                    for line in bedNucleosomeMidsFile:
-                        splitLine = line.strip().split('\t')
-
-                        # Compare this entry with the last. If it matches, just iterate the count.
-                        # If it doesn't, write the last Entry and its count and reset both.
-                        if lastEntry is not None and lastEntry[:2] + [lastEntry[5]] == splitLine[:2] + [splitLine[5]]: currentCount += 1
-                        else:
-                            if lastEntry is not None:
-                                strandedWigLikeNucleosomeMidsFile.write('\t'.join(lastEntry[:3] + [str(currentCount), '.', lastEntry[5]]) + '\n')
-                            lastEntry = splitLine
-                            currentCount = 1
-                    
-                    # Make sure to finish the current entry after iterating through the bed file.
-                    if lastEntry is not None:
-                        strandedWigLikeNucleosomeMidsFile.write('\t'.join(lastEntry[:3] + [str(currentCount), '.', lastEntry[5]]) + '\n')
-                        
-            nucleosomeMidsOutputFilePaths.append(wigLikeNucleosomeMidsFilePath)
+# Given a list of bed files with paired entries, convert each to a fixed step wig file containing
+# counts for nucleosome midpoints. Note that this requires a chrom.sizes file as well.
+# Output format can be either fixed-step wig or a wig-like bed, containing bed entries with counts in
+# the fourth (index 3) column
+# outputFormat may also be a collection of formats, in which case every requested output is generated from a single
+# read of each input file. This includes iNPS full fragments (see BedMNasePEToBediNPSFullFragments), which are
+# written as the input is read and validated according to validateConcordantPairs. If pairNonAdjacentMates is true,
+# full fragment companions are matched by read name instead of adjacency (see MatePairing), holding at most
+# maxHeldMates unmatched mates in memory. (Midpoints are derived from single entries, so they are unaffected.)
+# If sortFree is true, midpoints are counted directly into arrays (see countNucleosomeMids) instead of being written
+# to an intermediate file and sorted. This requires a chrom.sizes file for every output format.
+# The sparse variable-step wig, bedGraph, and binary coverage store formats are always generated this way.
+# If workers is greater than 1, input files are converted concurrently in a pool of that many processes. In this case,
+# an error in one file is reported without stopping the others, and that file's outputs are left out of the results.
+# If shardByChromosome is true, each input file is instead split by chromosome, the chromosomes are converted
+# concurrently, and the per-chromosome outputs are merged back together in chromosome order.
+# (Note that this also orders full fragments by chromosome.)
+# chromSizesFilePath may also be a genome fasta file, in which case chromosome sizes come from its cached index
+# (see GenomeIndex).
+# Returns a list of the generated nucleosome file paths (ordered as in OUTPUT_FORMATS).
+def bedMNasePEToNucleosomeMids(bedFilePaths: List[str], chromSizesFilePath, outputFormat: Union[str, Iterable[str]],
+                               sortFree = False, validateConcordantPairs = True, workers = 1, shardByChromosome = False,
+                               pairNonAdjacentMates = False, maxHeldMates = DEFAULT_MAX_HELD_MATES):
 
+    nucleosomeMidsOutputFilePaths = list()
+
+    if isinstance(outputFormat, str): outputFormats = {outputFormat}
+    else: outputFormats = set(outputFormat)
+    invalidOutputFormats = outputFormats.difference(OUTPUT_FORMATS)
+    if invalidOutputFormats: raise UserInputError(f"Invalid output format(s): {', '.join(invalidOutputFormats)}")
+
+    # If only full fragments were requested, there's no need to derive midpoints at all.
+    if outputFormats == {INPS_FULL_FRAGMENTS}:
+        return bedMNasePEToBediNPSFullFragments(bedFilePaths, validateConcordantPairs, workers, shardByChromosome,
+                                                pairNonAdjacentMates, maxHeldMates)
+
+    if outputFormats.intersection(COUNT_ARRAY_FORMATS): sortFree = True
+    if sortFree or FIXED_STEP_WIG in outputFormats:
+        if chromSizesFilePath is None:
+            raise UserInputError("Fixed-step wig output and sort-free midpoint counting require a chrom.sizes file.")
+        print("Getting chromosome sizes...")
+        chromSizes = getChromSizes(chromSizesFilePath)
+    else: chromSizes = None
+
+    conversionArgs = (chromSizes, outputFormats, sortFree, validateConcordantPairs, pairNonAdjacentMates, maxHeldMates)
+
+    if shardByChromosome:
+        for bedFilePath in bedFilePaths:
+            print(f"\nSplitting {os.path.basename(bedFilePath)} by chromosome...")
+            shardDirectory = os.path.join(os.path.dirname(bedFilePath), ".tmp",
+                                          os.path.basename(bedFilePath).rsplit('.',1)[0] + "_chromosome_shards")
+            try:
+                shardOutputFilePaths = mapChromosomeShardsInPool(convertBedFileToNucleosomeMids, bedFilePath,
+                                                                 shardDirectory, workers, *conversionArgs)
+                print(f"\nMerging chromosome outputs for {os.path.basename(bedFilePath)}...")
+                outputFilePaths = getNucleosomeMidsOutputFilePaths(bedFilePath, outputFormats, sortFree)
+                for i, thisFormat in enumerate(thisFormat for thisFormat in OUTPUT_FORMATS if thisFormat in outputFormats):
+                    if thisFormat == BINARY_COVERAGE:
+                        mergeCoverageStores([shardOutputs[i] for shardOutputs in shardOutputFilePaths],
+                                            outputFilePaths[thisFormat])
+                    else:
+                        concatenateFiles([shardOutputs[i] for shardOutputs in shardOutputFilePaths],
+                                         outputFilePaths[thisFormat])
+                    nucleosomeMidsOutputFilePaths.append(outputFilePaths[thisFormat])
+            except Exception:
+                if len(bedFilePaths) == 1: raise
+                print(f"\nError encountered while processing {os.path.basename(bedFilePath)}. Skipping.")
+                traceback.print_exc()
+            finally:
+                shutil.rmtree(shardDirectory, ignore_errors = True)
+
+    elif workers > 1:
+        for outputFilePaths in mapFilesInPool(convertBedFileToNucleosomeMids, bedFilePaths, workers, *conversionArgs):
+            if outputFilePaths is not None: nucleosomeMidsOutputFilePaths += outputFilePaths
+
+    else:
+        for bedFilePath in bedFilePaths:
+            nucleosomeMidsOutputFilePaths += convertBedFileToNucleosomeMids(bedFilePath, *conversionArgs)
 
     return nucleosomeMidsOutputFilePaths
 
@@ -183,15 +529,32 @@ def main():
     with TkinterDialog(workingDirectory = workingDirectory) as dialog:
         dialog.createMultipleFileSelector("MNase PE Bed Files:", 0, ".bed", ("Bed Files", ".bed"))
         with dialog.createDynamicSelector(1, 0) as outputFormatDynSel:
-            outputFormatDynSel.initDropdownController("Output format:", (SIMPLE_BED, FIXED_STEP_WIG, WIG_LIKE_BED, STRANDED_WIG_LIKE_BED))
-            outputFormatDynSel.initDisplay(FIXED_STEP_WIG, FIXED_STEP_WIG).createFileSelector(
-                "chrom.sizes File:", 0, ("chrom.sizes File", ".chrom.sizes")
+            outputFormatDynSel.initDropdownController("Output format:", (SIMPLE_BED, FIXED_STEP_WIG, WIG_LIKE_BED, STRANDED_WIG_LIKE_BED,
+                                                                         VARIABLE_STEP_WIG, BEDGRAPH, BINARY_COVERAGE))
+            for chromSizesFormat in (FIXED_STEP_WIG,) + COUNT_ARRAY_FORMATS:
+                outputFormatDynSel.initDisplay(chromSizesFormat, chromSizesFormat).createFileSelector(
+                    "chrom.sizes or Genome Fasta File:", 0, ("chrom.sizes File", ".chrom.sizes"),
+                    ("Fasta File", FASTA_FILE_ENDINGS)
+                )
+        with dialog.createDynamicSelector(2, 0) as sortFreeDynSel:
+            sortFreeDynSel.initCheckboxController("Count midpoints without sorting")
+            sortFreeDynSel.initDisplay(True, "sortFree").createFileSelector(
+                "chrom.sizes or Genome Fasta File:", 0, ("chrom.sizes File", ".chrom.sizes"),
+                ("Fasta File", FASTA_FILE_ENDINGS)
             )
-
-    if outputFormatDynSel.getControllerVar() != FIXED_STEP_WIG: chromSizesFilePath = None
-    else: chromSizesFilePath = dialog.selections.getIndividualFilePaths(FIXED_STEP_WIG)[0]
+        dialog.createTextField("Worker processes:", 3, 0, defaultText = "1")
+        dialog.createCheckbox("Split files by chromosome", 4, 0)
+
+    sortFree = sortFreeDynSel.getControllerVar()
+    outputFormat = outputFormatDynSel.getControllerVar()
+    if sortFree: chromSizesFilePath = dialog.selections.getIndividualFilePaths("sortFree")[0]
+    elif outputFormat in (FIXED_STEP_WIG,) + COUNT_ARRAY_FORMATS:
+        chromSizesFilePath = dialog.selections.getIndividualFilePaths(outputFormat)[0]
+    else: chromSizesFilePath = None
+    workers = checkForNumber(dialog.selections.getTextEntries()[0], True, lambda x: x > 0)
     bedMNasePEToNucleosomeMids(dialog.selections.getFilePathGroups()[0],
-                                  chromSizesFilePath, outputFormatDynSel.getControllerVar())
+                                  chromSizesFilePath, outputFormat, sortFree, workers = workers,
+                                  shardByChromosome = dialog.selections.getToggleStates()[0])
 
 
 if __name__ == "__main__": main()
\ No newline at end of file
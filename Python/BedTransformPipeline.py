@@ -0,0 +1,224 @@
+# This script chains bed cleanup steps (chromosome ID conversion, invalid chromosome removal, sorting, and gzip
+# compression) into a single pass, so that each input file is read once and only the final output is written.
+# Each stage is a generator over line-aligned blocks of bed data (bytes), and stages are applied in order:
+# convert IDs -> filter chromosomes -> sort -> (gzip) output. Sorting is done in memory until the buffered data
+# grows too large, at which point sorted runs are spilled to temporary files and merged at the end.
+# Run with no arguments for the Tkinter UI, or with command line arguments (see --help).
+import argparse, gzip, heapq, os, shutil, sys, tempfile
+from typing import Callable, Iterator, List
+from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
+from benbiohelpers.CustomErrors import UserInputError, checkForNumber
+from BedChromosomeRuns import ChromosomeRunRewriter, readBlocks, alignBlocksToLines
+from ConvertBedChromosomeIDs import getChromosomeIDConverter, readConversionFile
+from RemoveInvalidChromosomes import getChromosomeFilter, getAcceptableChromosomeSet
+
+# The default amount of bed data (in bytes) to hold in memory while sorting before spilling to disk.
+DEFAULT_SORT_BUFFER_SIZE = 512*1024*1024
+
+# The number of bytes to collect from sorted lines before yielding them as a block.
+OUTPUT_BLOCK_SIZE = 4*1024*1024
+
+Stage = Callable[[Iterator[bytes]], Iterator[bytes]]
+
+
+# Returns a stage that converts chromosome IDs using the given conversion file (see ConvertBedChromosomeIDs).
+def getConvertChromosomeIDsStage(conversionFilePath) -> Stage:
+    return ChromosomeRunRewriter(getChromosomeIDConverter(readConversionFile(conversionFilePath))).rewriteBlocks
+
+
+# Returns a stage that removes entries whose chromosomes are not acceptable for the given genome
+# (see RemoveInvalidChromosomes).
+def getFilterChromosomesStage(genomeFilePath) -> Stage:
+    return ChromosomeRunRewriter(getChromosomeFilter(getAcceptableChromosomeSet(genomeFilePath))).rewriteBlocks
+
+
+# Header and comment lines, which are kept at the top of sorted output.
+HEADER_LINE_STARTS = (b"track", b"browser", b"#")
+
+
+# Returns the key used to sort bed lines, equivalent to "LC_ALL=C sort -k1,1 -k2,2n -k3,3n".
+def getBedSortKey(line: bytes):
+    try:
+        chromosome, startPos, endPos = line.split(b'\t', 3)[:3]
+        return chromosome, int(startPos), int(endPos)
+    except ValueError:
+        raise UserInputError(f"Unable to sort malformed bed line: {line.decode(errors = 'replace').rstrip()}")
+
+
+# Yields the given lines joined into blocks of roughly OUTPUT_BLOCK_SIZE bytes.
+def joinLinesIntoBlocks(lines: Iterator[bytes]) -> Iterator[bytes]:
+
+    blockLines = list()
+    blockSize = 0
+    for line in lines:
+        blockLines.append(line)
+        blockSize += len(line)
+        if blockSize >= OUTPUT_BLOCK_SIZE:
+            yield b''.join(blockLines)
+            blockLines.clear()
+            blockSize = 0
+    if blockLines: yield b''.join(blockLines)
+
+
+# Returns a stage that sorts bed data (stably, so that otherwise equal entries keep their input order).
+# Header and comment lines (track, browser, and '#' lines) are written first, in their original order.
+# Up to sortBufferSize bytes of lines are sorted in memory. Beyond that, each sorted run is written to a temporary
+# file in tempDirectory (or the system default) and the runs are merged once all the input has been read.
+# If tempDirectory has to be created, it is removed again afterwards (as long as nothing else has been put in it).
+def getSortStage(sortBufferSize = DEFAULT_SORT_BUFFER_SIZE, tempDirectory = None) -> Stage:
+
+    def sortBlocks(blocks: Iterator[bytes]) -> Iterator[bytes]:
+
+        runDirectory = None
+        createdTempDirectory = False
+        runFilePaths = list()
+        headerLines = list()
+        lines = list()
+        bufferedSize = 0
+
+        try:
+            for block in alignBlocksToLines(blocks):
+                blockLines = block.splitlines(keepends = True)
+                if not blockLines[-1].endswith(b'\n'): blockLines[-1] += b'\n'
+                for line in blockLines:
+                    if line.startswith(HEADER_LINE_STARTS): headerLines.append(line)
+                    elif line.strip(): lines.append(line)
+                bufferedSize += len(block)
+
+                # Spill a sorted run if too much data is being held.
+                if bufferedSize > sortBufferSize:
+                    if runDirectory is None:
+                        if tempDirectory is not None and not os.path.isdir(tempDirectory):
+                            os.makedirs(tempDirectory)
+                            createdTempDirectory = True
+                        runDirectory = tempfile.mkdtemp(prefix = "bed_sort_", dir = tempDirectory)
+                    runFilePaths.append(os.path.join(runDirectory, f"run_{len(runFilePaths)}.bed"))
+                    lines.sort(key = getBedSortKey)
+                    with open(runFilePaths[-1], 'wb') as runFile:
+                        for runBlock in joinLinesIntoBlocks(lines): runFile.write(runBlock)
+                    lines.clear()
+                    bufferedSize = 0
+
+            lines.sort(key = getBedSortKey)
+            if headerLines: yield b''.join(headerLines)
+            if not runFilePaths:
+                yield from joinLinesIntoBlocks(lines)
+                return
+
+            runFiles = [open(runFilePath, 'rb') for runFilePath in runFilePaths]
+            try:
+                yield from joinLinesIntoBlocks(heapq.merge(*runFiles, lines, key = getBedSortKey))
+            finally:
+                for runFile in runFiles: runFile.close()
+
+        finally:
+            if runDirectory is not None: shutil.rmtree(runDirectory, ignore_errors = True)
+            if createdTempDirectory:
+                try: os.rmdir(tempDirectory)
+                except OSError: pass
+
+    return sortBlocks
+
+
+# Reads the given bed file (which may be gzipped) as blocks, passes them through each stage in order, and writes
+# the result to the given output file path, gzip-compressing it if the path ends in ".gz".
+def runBedTransformPipeline(inputFilePath, outputFilePath, stages: List[Stage]):
+
+    inputOpen = gzip.open if inputFilePath.endswith(".gz") else open
+    outputOpen = gzip.open if outputFilePath.endswith(".gz") else open
+
+    with inputOpen(inputFilePath, 'rb') as inputFile:
+        blocks = readBlocks(inputFile)
+        for stage in stages: blocks = stage(blocks)
+        with outputOpen(outputFilePath, 'wb') as outputFile:
+            for block in blocks: outputFile.write(block)
+
+    return outputFilePath
+
+
+# Applies the requested transforms to each of the given bed files in a single pass, writing the results to
+# "<base>_transformed.bed" (with a ".gz" extension if compressOutput is true). Chromosome IDs are converted if a
+# conversion file is given, entries with invalid chromosomes are removed if a genome file is given, and the output is
+# sorted if sortOutput is true. Sort runs are spilled to a ".tmp" directory next to each output file.
+# Returns the output file paths.
+def transformBeds(bedFilePaths: List[str], conversionFilePath = None, genomeFilePath = None, sortOutput = False,
+                  compressOutput = False, sortBufferSize = DEFAULT_SORT_BUFFER_SIZE):
+
+    outputFilePaths = list()
+
+    for bedFilePath in bedFilePaths:
+
+        print(f"Working in {os.path.basename(bedFilePath)}")
+
+        outputFilePathBase = bedFilePath
+        if outputFilePathBase.endswith(".gz"): outputFilePathBase = outputFilePathBase[:-len(".gz")]
+        outputFilePath = outputFilePathBase.rsplit('.', 1)[0] + "_transformed.bed"
+        if compressOutput: outputFilePath += ".gz"
+
+        stages = list()
+        if conversionFilePath is not None: stages.append(getConvertChromosomeIDsStage(conversionFilePath))
+        if genomeFilePath is not None: stages.append(getFilterChromosomesStage(genomeFilePath))
+        if sortOutput:
+            stages.append(getSortStage(sortBufferSize, os.path.join(os.path.dirname(outputFilePath), ".tmp")))
+
+        outputFilePaths.append(runBedTransformPipeline(bedFilePath, outputFilePath, stages))
+
+    return outputFilePaths
+
+
+def parseArgs(args):
+
+    parser = argparse.ArgumentParser(description = "Convert chromosome IDs, remove invalid chromosomes, sort, "
+                                                   "and compress bed files in a single pass.")
+    parser.add_argument("bedFilePaths", nargs = '+', help = "The bed files to transform (optionally gzipped).")
+    parser.add_argument("-c", "--conversion-file", dest = "conversionFilePath",
+                        help = "A tsv file of chromosome IDs to convert from (1st column) and to (2nd column).")
+    parser.add_argument("-g", "--genome-file", dest = "genomeFilePath",
+                        help = "A genome fasta file used to determine which chromosomes are valid.")
+    parser.add_argument("-s", "--sort", dest = "sortOutput", action = "store_true", help = "Sort the output.")
+    parser.add_argument("-z", "--gzip", dest = "compressOutput", action = "store_true", help = "Gzip the output.")
+    parser.add_argument("--sort-buffer-mb", dest = "sortBufferSize", type = int,
+                        default = DEFAULT_SORT_BUFFER_SIZE//(1024*1024),
+                        help = "Megabytes of bed data to sort in memory before spilling to disk.")
+    return parser.parse_args(args)
+
+
+def main():
+
+    if len(sys.argv) > 1:
+        args = parseArgs(sys.argv[1:])
+        transformBeds(args.bedFilePaths, args.conversionFilePath, args.genomeFilePath, args.sortOutput,
+                      args.compressOutput, args.sortBufferSize*1024*1024)
+        return
+
+    with TkinterDialog(workingDirectory=os.path.dirname(__file__), title = "Transform Bed Files") as dialog:
+        dialog.createMultipleFileSelector("Bed Files:", 0, ".bed", ("Bed Files", (".bed", ".bed.gz")),
+                                          additionalFileEndings = (".bed.gz",))
+        with dialog.createDynamicSelector(1, 0) as conversionDynSel:
+            conversionDynSel.initCheckboxController("Convert chromosome IDs")
+            conversionDisplay = conversionDynSel.initDisplay(True, "conversion")
+            conversionDisplay.createFileSelector("Conversion File", 0, ("TSV file", ".tsv"))
+        with dialog.createDynamicSelector(2, 0) as genomeDynSel:
+            genomeDynSel.initCheckboxController("Remove invalid chromosomes")
+            genomeDisplay = genomeDynSel.initDisplay(True, "genome")
+            genomeDisplay.createFileSelector("Genome File Path:", 0, ("Fasta File", ".fa"))
+        with dialog.createDynamicSelector(3, 0) as sortDynSel:
+            sortDynSel.initCheckboxController("Sort output")
+            sortDisplay = sortDynSel.initDisplay(True, "sort")
+            sortDisplay.createTextField("Sort buffer (MB):", 0, 0,
+                                        defaultText = str(DEFAULT_SORT_BUFFER_SIZE//(1024*1024)))
+        dialog.createCheckbox("Gzip output", 4, 0)
+
+    conversionFilePath = None
+    if conversionDynSel.getControllerVar():
+        conversionFilePath = dialog.selections.getIndividualFilePaths("conversion")[0]
+    genomeFilePath = None
+    if genomeDynSel.getControllerVar(): genomeFilePath = dialog.selections.getIndividualFilePaths("genome")[0]
+    sortBufferSize = DEFAULT_SORT_BUFFER_SIZE
+    if sortDynSel.getControllerVar():
+        sortBufferSize = checkForNumber(dialog.selections.getTextEntries("sort")[0], True, lambda x: x > 0)*1024*1024
+
+    transformBeds(dialog.selections.getFilePathGroups()[0], conversionFilePath, genomeFilePath,
+                  sortDynSel.getControllerVar(), dialog.selections.getToggleStates()[0], sortBufferSize)
+
+if __name__ == "__main__": main()
@@ -1,18 +1,101 @@
-import os
+# This script converts bed files to fasta files of the sequences at each interval.
+# The genome is converted to (or loaded from) a memory-mapped .2bit file once (see TwoBitGenome), and the bed files
+# are then spread over a pool of worker processes, which all share the same mapped genome. Alternatively, each file
+# can be converted with bedtools getfasta, in which case the subprocesses are run from a pool of threads.
+# Sequences are fetched through a sequence cache (see SequenceCache), so intervals repeated across files are only
+# read from the genome once per worker, and optionally only once across runs, using a persistent cache file.
+# The in-memory caches share a single memory budget, which is split evenly between the workers.
+# Throughput is reported for each file as it finishes.
+import os, sys, time, argparse
 from typing import List
-from benbiohelpers.FileSystemHandling.BedToFasta import bedToFasta
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
+from benbiohelpers.CustomErrors import checkForNumber
+from benbiohelpers.FileSystemHandling.BedToFasta import bedToFasta
+from TwoBitGenome import getTwoBitGenome, writeBedSequencesToFasta
+from SequenceCache import getSequenceCache, DEFAULT_MAX_CACHE_BYTES
+from ParallelProcessing import mapFilesInPool
+
+
+# Returns the path of the fasta file for the given bed file.
+def getFastaFilePath(bedFilePath): return bedFilePath.rsplit('.',1)[0]+".fa"
+
+
+# Converts a single bed file to a fasta file and prints its throughput. Returns the number of sequences written
+# (or None when using bedtools) and the number of seconds taken.
+def bedToFastaWithThroughput(bedFilePath, genomeFilePath, useBedtools = False, sequenceCacheFilePath = None,
+                             maxCacheBytes = DEFAULT_MAX_CACHE_BYTES):
+
+    startTime = time.perf_counter()
+    if useBedtools:
+        bedToFasta(bedFilePath, genomeFilePath, getFastaFilePath(bedFilePath))
+        sequenceCount = None
+    else:
+        sequenceCache = getSequenceCache(genomeFilePath, sequenceCacheFilePath, maxCacheBytes)
+        previousHits = sequenceCache.hits
+        sequenceCount = writeBedSequencesToFasta(bedFilePath, genomeFilePath, getFastaFilePath(bedFilePath),
+                                                 sequenceCache = sequenceCache)
+    seconds = time.perf_counter() - startTime
+
+    throughput = f"{os.path.getsize(getFastaFilePath(bedFilePath))/1024/1024/max(seconds, 1e-6):.1f} MB/s"
+    if sequenceCount is not None:
+        throughput = (f"{sequenceCount/max(seconds, 1e-6):.0f} sequences/s, " + throughput +
+                      f", {sequenceCache.hits - previousHits} cached")
+    print(f"Converted {os.path.basename(bedFilePath)} in {seconds:.2f} s ({throughput})")
+    return sequenceCount, seconds
+
 
-# Given a list of bed files, simply uses the bedToFasta command to convert them to fasta files.
-def bedsToFastas(bedFilePaths: List[str], genomeFilePath):
-    
-    for bedFilePath in bedFilePaths:
-        print("Converting",os.path.basename(bedFilePath))
-        bedToFasta(bedFilePath, genomeFilePath, bedFilePath.rsplit('.',1)[0]+".fa")
+# Given a list of bed files, converts each one to a fasta file, using up to maxWorkers worker processes (or threads,
+# if using bedtools) at once. If sequenceCacheFilePath is given, fetched sequences are also saved to (and read from)
+# a persistent cache there. The workers' in-memory sequence caches use up to about cacheMemory bytes in total.
+def bedsToFastas(bedFilePaths: List[str], genomeFilePath, maxWorkers = 1, useBedtools = False,
+                 sequenceCacheFilePath = None, cacheMemory = DEFAULT_MAX_CACHE_BYTES):
+
+    # Make sure the .2bit file exists before the workers try to use it.
+    if not useBedtools: getTwoBitGenome(genomeFilePath)
+
+    print(f"Converting {len(bedFilePaths)} bed file(s) with up to {maxWorkers} worker(s)...")
+    startTime = time.perf_counter()
+    if maxWorkers > 1 and len(bedFilePaths) > 1:
+        workers = min(maxWorkers, len(bedFilePaths))
+        results = mapFilesInPool(bedToFastaWithThroughput, bedFilePaths, workers, genomeFilePath, useBedtools,
+                                 sequenceCacheFilePath, cacheMemory // workers, useThreads = useBedtools)
+    else: results = [bedToFastaWithThroughput(bedFilePath, genomeFilePath, useBedtools, sequenceCacheFilePath,
+                                              cacheMemory) for bedFilePath in bedFilePaths]
+    seconds = time.perf_counter() - startTime
+
+    convertedFiles = sum(result is not None for result in results)
+    print(f"Converted {convertedFiles} of {len(bedFilePaths)} bed file(s) in {seconds:.2f} s.")
+    if not useBedtools:
+        totalSequences = sum(result[0] for result in results if result is not None)
+        print(f"Wrote {totalSequences} sequences ({totalSequences/max(seconds, 1e-6):.0f} sequences/s overall).")
+
+
+def parseArgs(args):
+
+    parser = argparse.ArgumentParser(description = "Convert bed files to fasta files of the sequences they cover.")
+    parser.add_argument("bedFilePaths", nargs = '+', help = "The bed files to convert.")
+    parser.add_argument("-g", "--genome-file", dest = "genomeFilePath", required = True,
+                        help = "The genome fasta (or .2bit) file to read sequences from.")
+    parser.add_argument("--max-workers", dest = "maxWorkers", type = int, default = os.cpu_count() or 1,
+                        help = "The maximum number of bed files to convert at once.")
+    parser.add_argument("--bedtools", dest = "useBedtools", action = "store_true",
+                        help = "Convert each file with bedtools getfasta instead of in-process.")
+    parser.add_argument("--sequence-cache", dest = "sequenceCacheFilePath",
+                        help = "A SQLite file in which to cache fetched sequences between runs.")
+    parser.add_argument("--cache-memory", dest = "cacheMemory", type = int,
+                        default = DEFAULT_MAX_CACHE_BYTES//(1024*1024),
+                        help = "The total memory, in MB, for the in-memory sequence caches, shared between workers.")
+    return parser.parse_args(args)
 
 
 def main():
-    
+
+    if len(sys.argv) > 1:
+        args = parseArgs(sys.argv[1:])
+        bedsToFastas(args.bedFilePaths, args.genomeFilePath, max(args.maxWorkers, 1), args.useBedtools,
+                     args.sequenceCacheFilePath, max(args.cacheMemory, 0)*1024*1024)
+        return
+
     # Get the working directory from mutperiod if possible. Otherwise, just use this script's directory.
     try:
         from mutperiodpy.helper_scripts.UsefulFileSystemFunctions import getDataDirectory
@@ -22,9 +105,11 @@ def main():
 
     with TkinterDialog(workingDirectory = workingDirectory) as dialog:
         dialog.createMultipleFileSelector("Bed Files:", 0, ".bed", ("Bed Files", ".bed"))
-        dialog.createFileSelector("Genome Fasta File:", 1, ("Fasta File", ".fa"))
+        dialog.createFileSelector("Genome Fasta File:", 1, ("Fasta File", ".fa"), ("2bit File", ".2bit"))
+        dialog.createTextField("Max workers:", 2, 0, defaultText = str(os.cpu_count() or 1))
 
-    bedsToFastas(dialog.selections.getFilePathGroups()[0], dialog.selections.getIndividualFilePaths()[0])
+    bedsToFastas(dialog.selections.getFilePathGroups()[0], dialog.selections.getIndividualFilePaths()[0],
+                 checkForNumber(dialog.selections.getTextEntries()[0], True, lambda x: x > 0))
 
 
-if __name__ == "__main__": main()
\ No newline at end of file
+if __name__ == "__main__": main()
@@ -0,0 +1,155 @@
+# This script reads bigWig files directly, without going through the bigWigToWig program.
+# The chromosome B+ tree and the full-resolution R-tree index are read to find each data block, and the (zlib
+# compressed) blocks are then decoded in file order, which is sorted by chromosome and position.
+# Records are yielded one at a time, so a full bigWig can be streamed into another conversion with no intermediate files.
+# See the bigWig specification in Kent et al. (2010) doi:10.1093/bioinformatics/btq351 for details on the format.
+import struct, zlib
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Tuple
+from benbiohelpers.CustomErrors import UserInputError
+
+BIGWIG_MAGIC = 0x888FFC26
+CHROM_TREE_MAGIC = 0x78CA8C91
+R_TREE_MAGIC = 0x2468ACE0
+
+# Section types within bigWig data blocks.
+BEDGRAPH_SECTION = 1
+VARIABLE_STEP_SECTION = 2
+FIXED_STEP_SECTION = 3
+
+
+class BigWigReader:
+    """
+    Reads the header, chromosome list, and data block index of a bigWig file, and iterates through its
+    full-resolution data as (chromosome, start, end, value) records with 0-based, half-open coordinates.
+    """
+
+    def __init__(self, bigWigFilePath):
+        self.bigWigFilePath = bigWigFilePath
+        self.bigWigFile = open(bigWigFilePath, 'rb')
+
+        # Determine the byte order from the magic number, then read the rest of the header.
+        header = self.bigWigFile.read(64)
+        if len(header) == 64 and struct.unpack("<I", header[:4])[0] == BIGWIG_MAGIC: self.byteOrder = '<'
+        elif len(header) == 64 and struct.unpack(">I", header[:4])[0] == BIGWIG_MAGIC: self.byteOrder = '>'
+        else: raise UserInputError(f"{bigWigFilePath} is not a bigWig file.")
+
+        (_, self.version, self.zoomLevels, self.chromTreeOffset, self.fullDataOffset, self.fullIndexOffset,
+         _, _, _, self.totalSummaryOffset, self.uncompressBufSize, _) = struct.unpack(self.byteOrder + "IHHQQQHHQQIQ", header)
+
+        self.chromNames: Dict[int, str] = dict()
+        self.chromSizes: Dict[str, int] = dict()
+        self.readChromTree()
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb): self.close()
+
+    def close(self): self.bigWigFile.close()
+
+    def unpackFrom(self, format, offset):
+        """
+        Reads and unpacks the given struct format from the given file offset.
+        """
+        format = self.byteOrder + format
+        self.bigWigFile.seek(offset)
+        return struct.unpack(format, self.bigWigFile.read(struct.calcsize(format)))
+
+    def readChromTree(self):
+        """
+        Reads chromosome names, IDs, and sizes from the chromosome B+ tree.
+        """
+        magic, _, keySize, _, _, _ = self.unpackFrom("IIIIQQ", self.chromTreeOffset)
+        if magic != CHROM_TREE_MAGIC: raise UserInputError(f"Invalid chromosome tree in {self.bigWigFilePath}.")
+
+        nodeOffsets = [self.chromTreeOffset + 32]
+        while nodeOffsets:
+            nodeOffset = nodeOffsets.pop()
+            isLeaf, _, itemCount = self.unpackFrom("BBH", nodeOffset)
+            if isLeaf:
+                items = self.unpackFrom(f"{keySize}sII"*itemCount, nodeOffset + 4)
+                for i in range(itemCount):
+                    chromName = items[i*3].rstrip(b'\0').decode()
+                    self.chromNames[items[i*3+1]] = chromName
+                    self.chromSizes[chromName] = items[i*3+2]
+            else:
+                items = self.unpackFrom(f"{keySize}sQ"*itemCount, nodeOffset + 4)
+                nodeOffsets += reversed(items[1::2])
+
+    def getDataBlocks(self) -> List[Tuple[int, int]]:
+        """
+        Returns the (offset, size) of every full-resolution data block from the R-tree index, in file order.
+        """
+        magic = self.unpackFrom("I", self.fullIndexOffset)[0]
+        if magic != R_TREE_MAGIC: raise UserInputError(f"Invalid data index in {self.bigWigFilePath}.")
+
+        dataBlocks = list()
+        nodeOffsets = [self.fullIndexOffset + 48]
+        while nodeOffsets:
+            nodeOffset = nodeOffsets.pop()
+            isLeaf, _, itemCount = self.unpackFrom("BBH", nodeOffset)
+            if isLeaf:
+                items = self.unpackFrom("IIIIQQ"*itemCount, nodeOffset + 4)
+                dataBlocks += zip(items[4::6], items[5::6])
+            else:
+                items = self.unpackFrom("IIIIQ"*itemCount, nodeOffset + 4)
+                nodeOffsets += reversed(items[4::5])
+
+        dataBlocks.sort()
+        return dataBlocks
+
+    def getMinimumValue(self) -> Optional[float]:
+        """
+        Returns the minimum value across all records from the file's total summary, or None if there is no summary.
+        """
+        if self.totalSummaryOffset == 0: return None
+        validCount, minVal, _, _, _ = self.unpackFrom("Qdddd", self.totalSummaryOffset)
+        if validCount == 0: return None
+        return minVal
+
+    def readDataBlock(self, offset, size) -> Iterator[Tuple[str, int, int, float]]:
+        """
+        Decompresses (if necessary) and decodes the sections in the data block at the given offset.
+        """
+        self.bigWigFile.seek(offset)
+        block = self.bigWigFile.read(size)
+        if self.uncompressBufSize > 0: block = zlib.decompress(block)
+
+        sectionHeaderFormat = self.byteOrder + "IIIIIBBH"
+        sectionHeaderSize = struct.calcsize(sectionHeaderFormat)
+        position = 0
+        while position < len(block):
+            chromID, sectionStart, _, itemStep, itemSpan, sectionType, _, itemCount = struct.unpack_from(
+                sectionHeaderFormat, block, position
+            )
+            position += sectionHeaderSize
+            chromName = self.chromNames[chromID]
+
+            if sectionType == BEDGRAPH_SECTION:
+                items = np.frombuffer(block, np.dtype([("start", self.byteOrder+"u4"), ("end", self.byteOrder+"u4"),
+                                                       ("value", self.byteOrder+"f4")]), itemCount, position)
+                starts, ends = items["start"].tolist(), items["end"].tolist()
+            elif sectionType == VARIABLE_STEP_SECTION:
+                items = np.frombuffer(block, np.dtype([("start", self.byteOrder+"u4"), ("value", self.byteOrder+"f4")]),
+                                      itemCount, position)
+                starts = items["start"].tolist()
+                ends = [start + itemSpan for start in starts]
+            elif sectionType == FIXED_STEP_SECTION:
+                items = np.frombuffer(block, np.dtype([("value", self.byteOrder+"f4")]), itemCount, position)
+                starts = list(range(sectionStart, sectionStart + itemCount*itemStep, itemStep))
+                ends = [start + itemSpan for start in starts]
+            else: raise UserInputError(f"Unrecognized section type {sectionType} in {self.bigWigFilePath}.")
+            position += items.nbytes
+
+            for start, end, value in zip(starts, ends, items["value"].tolist()):
+                yield chromName, start, end, value
+
+    def __iter__(self) -> Iterator[Tuple[str, int, int, float]]:
+        for offset, size in self.getDataBlocks():
+            yield from self.readDataBlock(offset, size)
+
+
+# Yields the (chromosome, start, end, value) records from the given bigWig file.
+def readBigWigRecords(bigWigFilePath) -> Iterator[Tuple[str, int, int, float]]:
+    with BigWigReader(bigWigFilePath) as bigWigReader:
+        yield from bigWigReader
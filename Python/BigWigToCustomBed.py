@@ -1,19 +1,134 @@
-# This script passes a bigwig file through several other python scripts to convert it to a format suitable for mutperiod.
-from typing import List
-from BigWigToWig import bigWigToWig
-from WigToBed import wigToBed
-from WigBedToCustomBed import wigBedToCustomBed
+# This script converts bigwig files to a format suitable for mutperiod.
+# By default, the bigwig files are read directly (see BigWigReader), and their records are streamed straight into the
+# custom bed conversion, so no intermediate wig or wig-bed files are written, and no external programs are required.
+# Alternatively, the bigWigToWig program can still be used. In this case, bigWigToWig, the wig to bed conversion, and
+# the custom bed conversion run as concurrent processes connected by pipes, and the intermediate wig and wig-bed files
+# are only written if requested.
+from typing import Dict, List
+from BigWigReader import BigWigReader
+from WigBedToCustomBed import (writeCustomBedFromRecords, getCustomBedFilePath, bufferRecords, parseWigBedLines,
+                               CUSTOM_BED, BINARY_COVERAGE)
+from WigToBed import teeLines
+from ParallelProcessing import mapFilesInPool
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
-import os
+from benbiohelpers.FileSystemHandling.DirectoryHandling import checkDirs
+from benbiohelpers.CustomErrors import UserInputError, checkForNumber
+from CoverageStore import parseChromSizes
+import os, subprocess, sys
 
+# The command run (with the python interpreter) for the wig to bed stage when piping through external tools.
+# It takes the path to copy the wig data to (or an empty string) as its only argument. bigWigToWig writes 1-based
+# fixedStep and variableStep positions, so they are shifted to 0-based to match the records from BigWigReader.
+WIG_TO_BED_STAGE_COMMAND = ("import sys; from WigToBed import streamWigToBed; "
+                            "streamWigToBed(sys.argv[1] or None, zeroIndexed = False)")
 
-def bigWigToCustomBed(bigWigFilePaths: List[str], strandDesignation = '.'):
 
-    wigFilePaths = bigWigToWig(bigWigFilePaths, True)
-    print()
-    wigBedFilePaths = wigToBed(wigFilePaths, True)
-    print()
-    wigBedToCustomBed(wigBedFilePaths, strandDesignation = strandDesignation)
+# Converts a single bigwig file by reading it directly. (See bigWigToCustomBed for details.)
+def readBigWigToCustomBed(bigWigFilePath, strandDesignation = '.', outputFormat = CUSTOM_BED,
+                          chromSizes: Dict[str, int] = None):
+
+    print("Converting",os.path.basename(bigWigFilePath),"to custom bed format.")
+    customBedFilePath = getCustomBedFilePath(bigWigFilePath, outputFormat = outputFormat)
+
+    with BigWigReader(bigWigFilePath) as bigWigReader:
+
+        # Use the minimum value from the bigwig's summary as the base value if possible.
+        # Otherwise, buffer the records while finding it, so the data is still only decoded once.
+        minCount = bigWigReader.getMinimumValue()
+        if minCount is None:
+            minCount, records = bufferRecords(bigWigReader, os.path.join(os.path.dirname(customBedFilePath), ".tmp"))
+        else: records = bigWigReader
+
+        writeCustomBedFromRecords(records, minCount, customBedFilePath,
+                                  strandDesignation, outputFormat, chromSizes)
+
+    return customBedFilePath
+
+
+# Converts a single bigwig file by piping the output of bigWigToWig through the wig to bed conversion (in its own
+# python process) and into the custom bed conversion, so that all three stages run concurrently.
+# If keepIntermediateFiles is true, the wig and wig-bed data are also written to the intermediate_files directory.
+def pipeBigWigToCustomBed(bigWigFilePath, strandDesignation = '.', outputFormat = CUSTOM_BED,
+                          chromSizes: Dict[str, int] = None, keepIntermediateFiles = False):
+
+    print("Piping",os.path.basename(bigWigFilePath),"through bigWigToWig and wig to bed to custom bed format.")
+    customBedFilePath = getCustomBedFilePath(bigWigFilePath, outputFormat = outputFormat)
+
+    if keepIntermediateFiles:
+        intermediateDirectory = os.path.join(os.path.dirname(bigWigFilePath), "intermediate_files")
+        checkDirs(intermediateDirectory)
+        basename = os.path.basename(bigWigFilePath).rsplit('.',1)[0]
+        wigFilePath = os.path.join(intermediateDirectory, basename + ".wig")
+        wigBedFilePath = os.path.join(intermediateDirectory, basename + ".bed")
+    else: wigFilePath, wigBedFilePath = '', None
+
+    # Make sure the wig to bed stage can import this script's sibling modules.
+    stageEnvironment = dict(os.environ)
+    stageEnvironment["PYTHONPATH"] = os.pathsep.join(filter(None, (os.path.dirname(os.path.abspath(__file__)),
+                                                                   os.environ.get("PYTHONPATH"))))
+
+    bigWigToWigProcess = subprocess.Popen(("bigWigToWig", bigWigFilePath, "stdout"), stdout = subprocess.PIPE)
+    wigToBedProcess = subprocess.Popen((sys.executable, "-c", WIG_TO_BED_STAGE_COMMAND, wigFilePath),
+                                       stdin = bigWigToWigProcess.stdout, stdout = subprocess.PIPE, text = True,
+                                       env = stageEnvironment)
+    # Only the wig to bed stage should hold the read end of the first pipe, so that bigWigToWig stops if it exits.
+    bigWigToWigProcess.stdout.close()
+
+    try:
+        with wigToBedProcess.stdout as wigBedLines:
+            if wigBedFilePath is None:
+                minCount, records = bufferRecords(parseWigBedLines(wigBedLines),
+                                                  os.path.join(os.path.dirname(customBedFilePath), ".tmp"))
+            else:
+                with open(wigBedFilePath, 'w') as wigBedFile:
+                    minCount, records = bufferRecords(parseWigBedLines(teeLines(wigBedLines, wigBedFile)),
+                                                      os.path.join(os.path.dirname(customBedFilePath), ".tmp"))
+    except BaseException:
+        # The pipe is closed by now, so the stages will stop on their own. Wait for them, but let the original error
+        # through rather than the broken pipe it caused.
+        for process in (wigToBedProcess, bigWigToWigProcess): process.wait()
+        raise
+    else:
+        # Check the downstream stage first, since an error there also breaks the pipe out of bigWigToWig.
+        for process in (wigToBedProcess, bigWigToWigProcess):
+            if process.wait() != 0: raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    writeCustomBedFromRecords(records, minCount, customBedFilePath, strandDesignation, outputFormat, chromSizes)
+
+    return customBedFilePath
+
+
+# Converts a single bigwig file using either of the above methods.
+def convertBigWigToCustomBed(bigWigFilePath, strandDesignation = '.', outputFormat = CUSTOM_BED,
+                             chromSizes: Dict[str, int] = None, useExternalTools = False, keepIntermediateFiles = False):
+    if useExternalTools:
+        return pipeBigWigToCustomBed(bigWigFilePath, strandDesignation, outputFormat, chromSizes, keepIntermediateFiles)
+    else: return readBigWigToCustomBed(bigWigFilePath, strandDesignation, outputFormat, chromSizes)
+
+
+# Converts each bigwig file to a custom bed file in the same directory (or, if the output format is BINARY_COVERAGE,
+# a coverage store directory, which requires a chrom.sizes file, or if it is WEIGHTED_BED, a weighted custom bed file).
+# If useExternalTools is true, bigWigToWig is used through a concurrent pipeline (see pipeBigWigToCustomBed).
+# If workers is greater than 1, files are converted concurrently in a pool of that many processes. In this case,
+# an error in one file is reported without stopping the others, and that file is left out of the results.
+# Returns the resulting file paths.
+def bigWigToCustomBed(bigWigFilePaths: List[str], strandDesignation = '.',
+                      outputFormat = CUSTOM_BED, chromSizesFilePath = None,
+                      useExternalTools = False, keepIntermediateFiles = False, workers = 1):
+
+    if outputFormat == BINARY_COVERAGE:
+        if chromSizesFilePath is None: raise UserInputError("Binary coverage store output requires a chrom.sizes file.")
+        chromSizes = parseChromSizes(chromSizesFilePath)
+    else: chromSizes = None
+
+    conversionArgs = (strandDesignation, outputFormat, chromSizes, useExternalTools, keepIntermediateFiles)
+
+    if workers > 1:
+        return [customBedFilePath for customBedFilePath in
+                mapFilesInPool(convertBigWigToCustomBed, bigWigFilePaths, workers, *conversionArgs)
+                if customBedFilePath is not None]
+
+    return [convertBigWigToCustomBed(bigWigFilePath, *conversionArgs) for bigWigFilePath in bigWigFilePaths]
 
 
 def main():
@@ -23,6 +138,9 @@ def main():
     dialog.createMultipleFileSelector("bigwig Files:", 0, ".bigwig", ("bigwig files", (".bw",".bigwig")), 
                                       additionalFileEndings = (".bw"))
     dialog.createDropdown("Strand Designation", 1, 0, ("Ambiguous '.'", "Plus Strand '+'", "Minus Strand '-'"))
+    dialog.createTextField("Worker processes:", 2, 0, defaultText = "1")
+    dialog.createCheckbox("Pipe through bigWigToWig", 3, 0)
+    dialog.createCheckbox("Keep intermediate wig and wig-bed files", 3, 1)
 
 
     # Run the UI
@@ -33,6 +151,10 @@ def main():
 
     strandDesignation = dialog.selections.getDropdownSelections()[0].rsplit('\'',2)[1]
 
-    bigWigToCustomBed(dialog.selections.getFilePathGroups()[0], strandDesignation)
+    workers = checkForNumber(dialog.selections.getTextEntries()[0], True, lambda x: x > 0)
+
+    bigWigToCustomBed(dialog.selections.getFilePathGroups()[0], strandDesignation,
+                      useExternalTools = dialog.selections.getToggleStates()[0],
+                      keepIntermediateFiles = dialog.selections.getToggleStates()[1], workers = workers)
 
 if __name__ == "__main__": main()
\ No newline at end of file
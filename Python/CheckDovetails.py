@@ -1,52 +1,413 @@
 # This script checks for dovetailed regions of paired-end alignments.
-import os, gzip
-from typing import List
+# By default, mates are expected to be adjacent (e.g. name-sorted input). Otherwise, they can be paired by read name
+# with bounded memory (see MatePairing), which allows coordinate-sorted input.
+# BAM files are supported, and BAM, bgzipped SAM, and uncompressed SAM files can be split into ranges that are
+# checked by a pool of worker processes (see AlignmentFileScanning).
+# Instead of printing every dovetailed read, dovetails can be summarized (by overhang length, side, and chromosome)
+# in a TSV or JSON report, optionally with a random sample of example alignments.
+# Dovetails can also be trimmed in the same pass, writing a corrected SAM file (optionally BGZF-compressed) in which
+# the overhanging 3' ends are soft-clipped.
+import os, gzip, json, random, warnings
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
 from benbiohelpers.FileSystemHandling.SamFileIterator import SamFileIterator
+from benbiohelpers.CustomErrors import UserInputError, checkForNumber
+from MatePairing import MatePairer, DEFAULT_MAX_HELD_MATES
+from AlignmentFileScanning import (mapAlignmentRangesInPool, readAlignments, readHeaderText, isSplittable,
+                                   AlignmentRecord, BGZFWriter, SAM_CIGAR_PATTERN, UNALIGNED_FLAG)
 
 
-def checkDovetails(samFilePaths: List[str]):
+TSV_REPORT = "TSV"
+JSON_REPORT = "JSON"
+
+# The sides a read pair can be dovetailed on.
+MINUS_3_PRIME = "minus"
+PLUS_3_PRIME = "plus"
+
+
+# Returns a (side, overhang length, dovetailed read) tuple for each dovetailed region in the given read pair.
+def findDovetails(read1: SamFileIterator.SamRead, read2: SamFileIterator.SamRead) -> List[Tuple[str, int, object]]:
+
+    dovetails = list()
+
+    if read2.strand == '+':
+        plusRead = read2
+        minusRead = read1
+    else:
+        plusRead = read1
+        minusRead = read2
+
+    if minusRead.startPos < plusRead.startPos:
+        dovetails.append((MINUS_3_PRIME, plusRead.startPos - minusRead.startPos, minusRead))
+
+    if plusRead.endPos > minusRead.endPos:
+        dovetails.append((PLUS_3_PRIME, plusRead.endPos - minusRead.endPos, plusRead))
+
+    return dovetails
+
+
+# Returns a message for each dovetailed region in the given read pair.
+def getDovetailMessages(read1: SamFileIterator.SamRead, read2: SamFileIterator.SamRead) -> List[str]:
+    return [f"Dovetailing for read pair {read2.readName} at 3' end of {side} strand read. ({overhang} base(s))\n"
+            f"Dovetailing read alignmnent:\n{dovetailedRead.getAlignmentString()}\n"
+            for side, overhang, dovetailedRead in findDovetails(read1, read2)]
+
+
+class DovetailStatistics:
+    """
+    Counts checked read pairs and dovetails, with dovetails broken down by side, overhang length, and chromosome.
+    Up to maxExamples dovetailed alignments are kept as a uniform random sample (reservoir sampling), and only
+    sampled alignments are ever rendered as strings. Statistics from separate parts of a file can be merged.
+    """
+
+    def __init__(self, maxExamples = 0):
+        self.maxExamples = maxExamples
+        self.pairsChecked = 0
+        self.dovetailedPairs = 0
+        self.sideCounts: Dict[str, int] = Counter()
+        self.overhangCounts: Dict[str, Dict[int, int]] = {MINUS_3_PRIME: Counter(), PLUS_3_PRIME: Counter()}
+        self.chromosomeCounts: Dict[str, int] = Counter()
+        self.dovetailCount = 0
+        self.examples: List[Tuple[str, str, int, str]] = list()
+        self.random = random.Random()
+
+    def addPair(self, read1: SamFileIterator.SamRead, read2: SamFileIterator.SamRead):
+        """
+        Checks the given read pair for dovetails and counts them.
+        """
+        self.pairsChecked += 1
+        dovetails = findDovetails(read1, read2)
+        if dovetails:
+            self.dovetailedPairs += 1
+            # Not every alignment type records its chromosome.
+            self.chromosomeCounts[getattr(read2, "chromosome", '.')] += 1
+
+        for side, overhang, dovetailedRead in dovetails:
+            self.sideCounts[side] += 1
+            self.overhangCounts[side][overhang] += 1
+            self.dovetailCount += 1
+
+            if len(self.examples) < self.maxExamples: exampleIndex = len(self.examples)
+            else: exampleIndex = self.random.randrange(self.dovetailCount)
+            if exampleIndex < self.maxExamples:
+                example = (read2.readName, side, overhang, dovetailedRead.getAlignmentString())
+                if exampleIndex == len(self.examples): self.examples.append(example)
+                else: self.examples[exampleIndex] = example
+
+    def merge(self, other: "DovetailStatistics"):
+        """
+        Adds the counts from another set of statistics, combining the example samples so that they remain uniform.
+        """
+        self.pairsChecked += other.pairsChecked
+        self.dovetailedPairs += other.dovetailedPairs
+        self.sideCounts.update(other.sideCounts)
+        for side, overhangCounts in other.overhangCounts.items(): self.overhangCounts[side].update(overhangCounts)
+        self.chromosomeCounts.update(other.chromosomeCounts)
+
+        # Draw the merged sample without replacement from the two populations, then subsample each reservoir.
+        remaining = [self.dovetailCount, other.dovetailCount]
+        drawn = [0, 0]
+        for _ in range(min(self.maxExamples, sum(remaining))):
+            source = 0 if self.random.randrange(sum(remaining)) < remaining[0] else 1
+            remaining[source] -= 1
+            drawn[source] += 1
+        self.examples = self.random.sample(self.examples, drawn[0]) + self.random.sample(other.examples, drawn[1])
+        self.dovetailCount += other.dovetailCount
+
+    def writeReport(self, reportFilePathBase, reportFormat = TSV_REPORT) -> List[str]:
+        """
+        Writes the statistics to "<base>_dovetail_stats.tsv" (with any examples in "<base>_dovetail_examples.tsv"),
+        or to "<base>_dovetail_stats.json". Returns the paths to the written files.
+        """
+        if reportFormat == JSON_REPORT:
+            reportFilePath = reportFilePathBase + "_dovetail_stats.json"
+            with open(reportFilePath, 'w') as reportFile:
+                json.dump({"pairsChecked": self.pairsChecked, "dovetailedPairs": self.dovetailedPairs,
+                           "dovetailsBySide": self.sideCounts,
+                           "overhangLengths": {side: dict(sorted(overhangCounts.items()))
+                                               for side, overhangCounts in self.overhangCounts.items()},
+                           "dovetailedPairsByChromosome": dict(sorted(self.chromosomeCounts.items())),
+                           "examples": [{"readName": readName, "side": side, "overhang": overhang,
+                                         "alignment": alignment}
+                                        for readName, side, overhang, alignment in self.examples]},
+                          reportFile, indent = 1)
+            return [reportFilePath]
+
+        reportFilePath = reportFilePathBase + "_dovetail_stats.tsv"
+        with open(reportFilePath, 'w') as reportFile:
+            reportFile.write("category\tkey\tcount\n")
+            reportFile.write(f"pairs\tchecked\t{self.pairsChecked}\n")
+            reportFile.write(f"pairs\tdovetailed\t{self.dovetailedPairs}\n")
+            for side in (MINUS_3_PRIME, PLUS_3_PRIME):
+                reportFile.write(f"side\t{side}\t{self.sideCounts[side]}\n")
+            for side in (MINUS_3_PRIME, PLUS_3_PRIME):
+                for overhang, count in sorted(self.overhangCounts[side].items()):
+                    reportFile.write(f"{side}_overhang\t{overhang}\t{count}\n")
+            for chromosome, count in sorted(self.chromosomeCounts.items()):
+                reportFile.write(f"chromosome\t{chromosome}\t{count}\n")
+        if not self.examples: return [reportFilePath]
+
+        examplesFilePath = reportFilePathBase + "_dovetail_examples.tsv"
+        with open(examplesFilePath, 'w') as examplesFile:
+            examplesFile.write("read_name\tside\toverhang\talignment\n")
+            for example in self.examples: examplesFile.write('\t'.join(str(field) for field in example) + '\n')
+        return [reportFilePath, examplesFilePath]
+
+
+# Checks the given read pair for dovetailing and prints any that is found.
+def checkReadPairForDovetails(read1: SamFileIterator.SamRead, read2: SamFileIterator.SamRead):
+    for message in getDovetailMessages(read1, read2): print(message)
+
+
+# Yields the aligned reads from the given sam, sam.gz, or bam file.
+def readAlignedReads(samFilePath):
+    if samFilePath.endswith(".bam"):
+        yield from readAlignments(samFilePath)
+        return
+
+    if samFilePath.endswith(".gz"): openFunction = gzip.open
+    else: openFunction = open
+    with openFunction(samFilePath, "rt") as samFile:
+        yield from SamFileIterator(samFile, skipUnaligned = True)
+
+
+# Soft-clips the given number of reference bases from the start (or end) of the given CIGAR string. Any deletions or
+# insertions directly adjacent to the clipped bases are removed as well. Returns the new CIGAR string and the number of
+# reference bases that were removed, or None if no aligned bases would remain.
+def softClipCigar(cigar: str, referenceBases, fromStart = True) -> Optional[Tuple[str, int]]:
+
+    operations = [(int(length), operation) for length, operation in SAM_CIGAR_PATTERN.findall(cigar)]
+    if not fromStart: operations.reverse()
+
+    hardClips = list()
+    while operations and operations[0][1] == 'H': hardClips.append(operations.pop(0))
+
+    softClippedBases = 0
+    referenceBasesRemoved = 0
+    keptOperations = list()
+    for length, operation in operations:
+        if keptOperations: keptOperations.append((length, operation))
+        elif operation in "SI": softClippedBases += length
+        elif operation in "DN": referenceBasesRemoved += length
+        elif operation in "M=X":
+            clippedLength = max(0, min(length, referenceBases - referenceBasesRemoved))
+            softClippedBases += clippedLength
+            referenceBasesRemoved += clippedLength
+            if length > clippedLength: keptOperations.append((length - clippedLength, operation))
+    if not keptOperations: return None
+
+    newOperations = hardClips + [(softClippedBases, 'S')] + keptOperations
+    if not fromStart: newOperations.reverse()
+    return ''.join(f"{length}{operation}" for length, operation in newOperations), referenceBasesRemoved
+
+
+# Returns the SAM lines for the given read pair with any dovetailed 3' ends soft-clipped, along with the number of
+# reads that were trimmed. If trimming the pair would leave nothing aligned, the reads are returned unchanged.
+# Mate positions and template lengths are updated to reflect the trimmed alignments.
+def trimDovetails(read1: AlignmentRecord, read2: AlignmentRecord) -> Tuple[List[str], int]:
+
+    reads = (read1, read2)
+    fields = [read.getAlignmentString().split('\t') for read in reads]
+    startPositions = [read.startPos for read in reads]
+    endPositions = [read.endPos for read in reads]
+
+    trimmedReads = 0
+    for side, overhang, dovetailedRead in findDovetails(read1, read2):
+        i = reads.index(dovetailedRead)
+        clippedCigar = softClipCigar(fields[i][5], overhang, side == MINUS_3_PRIME)
+        if clippedCigar is None: continue
+        fields[i][5], referenceBasesRemoved = clippedCigar
+        if side == MINUS_3_PRIME:
+            startPositions[i] += referenceBasesRemoved
+            fields[i][3] = str(startPositions[i])
+        else: endPositions[i] -= referenceBasesRemoved
+        trimmedReads += 1
+
+    if trimmedReads > 0 and read1.chromosome == read2.chromosome:
+        templateLength = max(endPositions) - min(startPositions) + 1
+        for i, mate in ((0, 1), (1, 0)):
+            if fields[i][6] in ('=', fields[mate][2]): fields[i][7] = str(startPositions[mate])
+            isLeftmost = (startPositions[i] < startPositions[mate]
+                          or (startPositions[i] == startPositions[mate] and i == 0))
+            fields[i][8] = str(templateLength if isLeftmost else -templateLength)
+
+    return ['\t'.join(readFields) + '\n' for readFields in fields], trimmedReads
+
+
+# Checks adjacent reads within a range of a sam or bam file (see AlignmentFileScanning) for dovetailing.
+# Returns the dovetail messages (or, if summarize is true, DovetailStatistics) along with the first and last reads in
+# the range, so that a pair split across two ranges can be checked when the ranges are merged.
+def checkDovetailsInRange(alignments, summarize = False, maxExamples = 0):
+
+    if summarize: dovetailStatistics = DovetailStatistics(maxExamples)
+    else: messages = list()
+    firstRead = None
+    lastRead = None
+    for alignment in alignments:
+        if firstRead is None: firstRead = alignment
+        elif alignment.readName == lastRead.readName:
+            if summarize: dovetailStatistics.addPair(lastRead, alignment)
+            else: messages += getDovetailMessages(lastRead, alignment)
+        lastRead = alignment
+    return dovetailStatistics if summarize else messages, firstRead, lastRead
+
+
+# If pairNonAdjacentMates is true, reads are paired by name instead of adjacency, holding at most maxHeldMates
+# unpaired reads in memory before spilling them to a temporary directory next to the sam file.
+# Pairs involving spilled reads are checked after the rest of the file.
+# If workers is greater than 1, each file is split into ranges that are checked concurrently in a pool of that many
+# processes, with pairs split across ranges checked as the results are merged. (This requires adjacent mates, and
+# plain gzip files can't be split, so they are still checked sequentially.)
+# If summarize is true, dovetails are counted instead of printed (see DovetailStatistics), and a report is written
+# next to each input file in the given format, with up to maxExamples randomly sampled dovetailed alignments.
+# If trim is true, a copy of each input file is written with its dovetails trimmed (see trimDovetails) as
+# "<base>_dovetails_trimmed.sam", in the same pass used to check for dovetails. If compressTrimmedOutput is true,
+# this file is BGZF-compressed (".sam.gz") using the given number of workers as compression threads.
+# (Trimming reads each file sequentially and requires adjacent mates.)
+# The paths to any reports and trimmed files are returned.
+def checkDovetails(samFilePaths: List[str], pairNonAdjacentMates = False, maxHeldMates = DEFAULT_MAX_HELD_MATES,
+                   workers = 1, summarize = False, reportFormat = TSV_REPORT, maxExamples = 0,
+                   trim = False, compressTrimmedOutput = False):
+
+    if trim and pairNonAdjacentMates: raise UserInputError("Trimming dovetails requires adjacent mates.")
+
+    outputFilePaths = list()
 
     for samFilePath in samFilePaths:
         print(f"Working in {os.path.basename(samFilePath)}\n")
 
-        if samFilePath.endswith(".gz"): openFunction = gzip.open
-        else: openFunction = open
+        outputFilePathBase = samFilePath
+        if outputFilePathBase.endswith(".gz"): outputFilePathBase = outputFilePathBase[:-len(".gz")]
+        outputFilePathBase = outputFilePathBase.rsplit('.',1)[0]
+
+        dovetailStatistics = DovetailStatistics(maxExamples) if summarize else None
+        if trim:
+            trimmedFilePath = outputFilePathBase + "_dovetails_trimmed.sam"
+            if compressTrimmedOutput: trimmedFilePath += ".gz"
+            trimDovetailsInFile(samFilePath, trimmedFilePath, workers, dovetailStatistics)
+            outputFilePaths.append(trimmedFilePath)
+        else: checkDovetailsInFile(samFilePath, pairNonAdjacentMates, maxHeldMates, workers, dovetailStatistics)
+
+        if summarize:
+            print(f"Checked {dovetailStatistics.pairsChecked} read pairs and found "
+                  f"{dovetailStatistics.dovetailedPairs} dovetailed pairs.")
+            outputFilePaths += dovetailStatistics.writeReport(outputFilePathBase, reportFormat)
+
+    return outputFilePaths
+
+
+# Copies the given sam or bam file to the given SAM file path, trimming dovetails from adjacent read pairs and either
+# printing them or, if dovetailStatistics is given, adding them to the statistics. If the output file path ends in
+# ".gz", it is BGZF-compressed using the given number of threads.
+def trimDovetailsInFile(samFilePath, trimmedFilePath, compressionThreads = 1,
+                        dovetailStatistics: DovetailStatistics = None):
+
+    if dovetailStatistics is not None: handleReadPair = dovetailStatistics.addPair
+    else: handleReadPair = checkReadPairForDovetails
+
+    trimmedReads = 0
+    if trimmedFilePath.endswith(".gz"): trimmedFile = BGZFWriter(trimmedFilePath, compressionThreads)
+    else: trimmedFile = open(trimmedFilePath, 'w')
+
+    with trimmedFile:
+        trimmedFile.write(readHeaderText(samFilePath))
+
+        lastRead: AlignmentRecord = None
+        for alignment in readAlignments(samFilePath, skipUnaligned = False):
+
+            # Check for aligned read pairs, writing them together once they've been trimmed.
+            if (lastRead is not None and alignment.readName == lastRead.readName
+                and not (alignment.flag | lastRead.flag) & UNALIGNED_FLAG):
+                handleReadPair(lastRead, alignment)
+                trimmedLines, pairTrimmedReads = trimDovetails(lastRead, alignment)
+                trimmedFile.write(''.join(trimmedLines))
+                trimmedReads += pairTrimmedReads
+                lastRead = None
+                continue
+
+            if lastRead is not None: trimmedFile.write(lastRead.getAlignmentString() + '\n')
+            lastRead = alignment
+
+        if lastRead is not None: trimmedFile.write(lastRead.getAlignmentString() + '\n')
+
+    print(f"Trimmed dovetails from {trimmedReads} reads.")
+
+
+# Checks each read pair in the given file for dovetails, printing them or, if dovetailStatistics is given, adding them
+# to the statistics. (See checkDovetails for details.)
+def checkDovetailsInFile(samFilePath, pairNonAdjacentMates, maxHeldMates, workers,
+                         dovetailStatistics: DovetailStatistics = None):
+
+    if dovetailStatistics is not None: handleReadPair = dovetailStatistics.addPair
+    else: handleReadPair = checkReadPairForDovetails
+
+    if pairNonAdjacentMates:
+        spillDirectory = os.path.join(os.path.dirname(os.path.abspath(samFilePath)), ".tmp")
+        with MatePairer(lambda samRead: (samRead.readName, None), maxHeldMates, spillDirectory) as matePairer:
+            for samRead in readAlignedReads(samFilePath):
+                readPair = matePairer.addMate(samRead)
+                if readPair is not None: handleReadPair(*readPair)
+            for readPair in matePairer.finish(): handleReadPair(*readPair)
+        return
+
+    if workers > 1 and not isSplittable(samFilePath):
+        warnings.warn(f"{os.path.basename(samFilePath)} is compressed with plain gzip and can't be split "
+                      "between workers. Checking it sequentially instead.")
+    elif workers > 1:
+        lastRead = None
+        for rangeResult, firstRead, rangeLastRead in mapAlignmentRangesInPool(
+            checkDovetailsInRange, samFilePath, workers, dovetailStatistics is not None,
+            0 if dovetailStatistics is None else dovetailStatistics.maxExamples
+        ):
+            if firstRead is None: continue
+            if lastRead is not None and firstRead.readName == lastRead.readName:
+                handleReadPair(lastRead, firstRead)
+            if dovetailStatistics is not None: dovetailStatistics.merge(rangeResult)
+            else:
+                for message in rangeResult: print(message)
+            lastRead = rangeLastRead
+        return
+
+    lastRead: SamFileIterator.SamRead = None
+    for samRead in readAlignedReads(samFilePath):
         
-        lastRead: SamFileIterator.SamRead = None
-        with openFunction(samFilePath, "rt") as samFile:
-            for samRead in SamFileIterator(samFile, skipUnaligned = True):
-                
-                # Check for read pairs
-                if lastRead is not None and samRead.readName == lastRead.readName:
-
-                    # Check for dovetailing.
-                    if samRead.strand == '+':
-                        plusRead = samRead
-                        minusRead = lastRead
-                    else:
-                        plusRead = lastRead
-                        minusRead = samRead
-
-                    if minusRead.startPos < plusRead.startPos:
-                        print(f"Dovetailing for read pair {samRead.readName} at 3' end of minus strand read. "
-                              f"({plusRead.startPos - minusRead.startPos} base(s))")
-                        print(f"Dovetailing read alignmnent:\n{minusRead.getAlignmentString()}\n")
-
-                    if plusRead.endPos > minusRead.endPos:
-                        print(f"Dovetailing for read pair {samRead.readName} at 3' end of plus strand read. "
-                              f"({plusRead.endPos - minusRead.endPos} base(s))")
-                        print(f"Dovetailing read alignmnent:\n{plusRead.getAlignmentString()}\n")
-
-                lastRead = samRead
+        # Check for read pairs
+        if lastRead is not None and samRead.readName == lastRead.readName:
+            handleReadPair(lastRead, samRead)
+
+        lastRead = samRead
 
 
 def main():
 
     with TkinterDialog(workingDirectory = os.path.join(os.path.dirname(__file__),"..","..","data")) as dialog:
-        dialog.createMultipleFileSelector("Sam files:", 0, ".sam", ("Sam Files", (".sam", ".sam.gz")))
+        dialog.createMultipleFileSelector("Sam files:", 0, ".sam", ("Sam/Bam Files", (".sam", ".sam.gz", ".bam")),
+                                          additionalFileEndings = (".sam.gz", ".bam"))
+        dialog.createCheckbox("Pair non-adjacent mates (e.g. coordinate-sorted input)", 1, 0)
+        dialog.createTextField("Worker processes:", 2, 0, defaultText = "1")
+        with dialog.createDynamicSelector(3, 0) as summaryDynSel:
+            summaryDynSel.initCheckboxController("Summarize dovetails in a report")
+            summaryDisplay = summaryDynSel.initDisplay(True, "summary")
+            summaryDisplay.createDropdown("Report format:", 0, 0, (TSV_REPORT, JSON_REPORT))
+            summaryDisplay.createTextField("Example alignments:", 1, 0, defaultText = "0")
+        with dialog.createDynamicSelector(4, 0) as trimDynSel:
+            trimDynSel.initCheckboxController("Write trimmed alignments")
+            trimDynSel.initDisplay(True, "trim").createCheckbox("BGZF-compress trimmed alignments", 0, 0)
+
+    workers = checkForNumber(dialog.selections.getTextEntries()[0], True, lambda x: x > 0)
+    summarize = summaryDynSel.getControllerVar()
+    if summarize:
+        reportFormat = dialog.selections.getDropdownSelections("summary")[0]
+        maxExamples = checkForNumber(dialog.selections.getTextEntries("summary")[0], True, lambda x: x >= 0)
+    else: reportFormat, maxExamples = TSV_REPORT, 0
+
+    trim = trimDynSel.getControllerVar()
+    compressTrimmedOutput = trim and dialog.selections.getToggleStates("trim")[0]
 
-    checkDovetails(dialog.selections.getFilePathGroups()[0])
+    checkDovetails(dialog.selections.getFilePathGroups()[0], dialog.selections.getToggleStates()[0],
+                   workers = workers, summarize = summarize, reportFormat = reportFormat, maxExamples = maxExamples,
+                   trim = trim, compressTrimmedOutput = compressTrimmedOutput)
 
 
 if __name__ == "__main__": main()
@@ -1,17 +1,41 @@
 # This script takes one or more bed files and a simple tsv file containing chromosome
 # IDs to convert from (1st column) and to (2nd column).
+# Only the chromosome column is rewritten; the rest of each line is copied through as is (see BedChromosomeRuns).
 import os, warnings
 from typing import List
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
+from BedChromosomeRuns import rewriteBedChromosomes
 
 
-def convertBedChromosomeIDs(bedFilePaths: List[str], conversionFilePath: str):
-    
+# Returns a function giving the converted ID for a chromosome (as bytes) from the given conversion dictionary, or
+# None (with a warning) if the chromosome isn't in the dictionary.
+def getChromosomeIDConverter(conversionDict):
+
+    def convertChromosomeID(chromosome: bytes):
+        chrFrom = chromosome.decode()
+        if chrFrom not in conversionDict:
+            warnings.warn(f"Chromosome ID {chrFrom} not found in conversion dictionary. "
+                          "Omitting associated bed rows from output file.")
+            return None
+        return conversionDict[chrFrom].encode()
+
+    return convertChromosomeID
+
+
+# Reads the conversion dictionary from the given tsv file.
+def readConversionFile(conversionFilePath):
+
     conversionDict = dict()
     with open(conversionFilePath, 'r') as conversionFile:
         for line in conversionFile:
             chrFrom, chrTo = line.split()
             conversionDict[chrFrom] = chrTo
+    return conversionDict
+
+
+def convertBedChromosomeIDs(bedFilePaths: List[str], conversionFilePath: str):
+
+    convertChromosomeID = getChromosomeIDConverter(readConversionFile(conversionFilePath))
 
     for bedFilePath in bedFilePaths:
 
@@ -19,17 +43,9 @@ def convertBedChromosomeIDs(bedFilePaths: List[str], conversionFilePath: str):
 
         outputFilePath = bedFilePath.rsplit('.', 1)[0] + "_converted.bed"
 
-        with open(bedFilePath, 'r') as bedFile:
-            with open(outputFilePath, 'w') as outputFile:
-
-                for line in bedFile:
-                    splitLine = line.split()
-                    if splitLine[0] not in conversionDict:
-                        warnings.warn(f"Chromosome ID {splitLine[0]} not found in conversion dictionary. "
-                                      "Omitting bed row from output file.")
-                        continue
-                    splitLine[0] = conversionDict[splitLine[0]]
-                    outputFile.write('\t'.join(splitLine) + '\n')
+        with open(bedFilePath, 'rb') as bedFile:
+            with open(outputFilePath, 'wb') as outputFile:
+                rewriteBedChromosomes(bedFile, outputFile, convertChromosomeID)
 
 
 def main():
@@ -0,0 +1,170 @@
+# This script defines a simple binary format for storing per-base coverage (counts) across a genome, along with tools
+# for reading and writing it. A coverage store is a directory containing one flat array of unsigned 32-bit integers
+# per chromosome and strand, plus a small JSON header giving the chromosome sizes and the files for each chromosome.
+# Because the arrays are raw binary, they can be memory-mapped by downstream code and sliced without any parsing,
+# and the same pages can be shared between processes.
+import os, json, shutil
+import numpy as np
+from typing import Dict, List
+from benbiohelpers.CustomErrors import UserInputError, InvalidPathError
+
+COVERAGE_STORE_HEADER = "coverage_store.json"
+COVERAGE_DTYPE = np.uint32
+
+PLUS_STRAND = '+'
+MINUS_STRAND = '-'
+UNSTRANDED = '.'
+STRAND_FILE_NAMES = {PLUS_STRAND: "plus", MINUS_STRAND: "minus", UNSTRANDED: "unstranded"}
+
+
+# Reads the given chrom.sizes file into a dictionary of chromosome sizes.
+def parseChromSizes(chromSizesFilePath) -> Dict[str, int]:
+
+    chromSizes = dict()
+    with open(chromSizesFilePath, 'r') as chromSizesFile:
+        for line in chromSizesFile:
+            chromosome, size = line.strip().split('\t')
+            chromSizes[chromosome] = int(size)
+    return chromSizes
+
+
+class CoverageStoreWriter:
+    """
+    Writes per-base coverage arrays to a new coverage store directory. Arrays can either be written in full using
+    writeCounts or filled in place through the writable memory maps returned by getCounts. The JSON header is
+    written when the writer is closed (or its context is exited), so a partially written store is never readable.
+    """
+
+    def __init__(self, storeDirectory, chromSizes: Dict[str, int]):
+        self.storeDirectory = storeDirectory
+        self.chromSizes = chromSizes
+        self.files: Dict[str, Dict[str, str]] = dict()
+        self.openArrays: Dict[tuple, np.memmap] = dict()
+        os.makedirs(storeDirectory, exist_ok = True)
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None: self.close()
+
+    def getFileName(self, chromosome, strand):
+        """
+        Registers and returns the name of the binary file for the given chromosome and strand.
+        """
+        if chromosome not in self.chromSizes:
+            raise UserInputError(f"Chromosome {chromosome} not found in the coverage store's chromosome sizes.")
+        if strand not in STRAND_FILE_NAMES: raise UserInputError(f"Invalid strand designation: {strand}")
+        fileName = f"{chromosome}_{STRAND_FILE_NAMES[strand]}.u32"
+        self.files.setdefault(chromosome, dict())[strand] = fileName
+        return fileName
+
+    def writeCounts(self, chromosome, strand, counts: np.ndarray):
+        """
+        Writes a full coverage array for the given chromosome and strand.
+        """
+        if len(counts) != self.chromSizes[chromosome]:
+            raise UserInputError(f"Coverage array for {chromosome} has length {len(counts)}, but the chromosome "
+                                 f"has size {self.chromSizes[chromosome]}.")
+        fileName = self.getFileName(chromosome, strand)
+        counts.astype(COVERAGE_DTYPE, copy = False).tofile(os.path.join(self.storeDirectory, fileName))
+
+    def getCounts(self, chromosome, strand) -> np.memmap:
+        """
+        Returns a writable, zero-initialized memory map of the coverage array for the given chromosome and strand,
+        creating it on first access.
+        """
+        if (chromosome, strand) not in self.openArrays:
+            fileName = self.getFileName(chromosome, strand)
+            self.openArrays[(chromosome, strand)] = np.memmap(os.path.join(self.storeDirectory, fileName),
+                                                              COVERAGE_DTYPE, 'w+', shape = self.chromSizes[chromosome])
+        return self.openArrays[(chromosome, strand)]
+
+    def close(self):
+        """
+        Flushes any open memory maps and writes the JSON header.
+        """
+        for openArray in self.openArrays.values(): openArray.flush()
+        self.openArrays.clear()
+        with open(os.path.join(self.storeDirectory, COVERAGE_STORE_HEADER), 'w') as headerFile:
+            json.dump({"dtype": np.dtype(COVERAGE_DTYPE).name, "chromSizes": self.chromSizes,
+                       "files": self.files}, headerFile, indent = 1)
+
+
+class CoverageStore:
+    """
+    Read-only access to a coverage store directory. Coverage arrays are memory-mapped on first access,
+    so slicing a region reads only the relevant pages from disk.
+    Chromosomes and strands without a stored array are treated as having no coverage.
+    """
+
+    def __init__(self, storeDirectory):
+        self.storeDirectory = storeDirectory
+        headerFilePath = os.path.join(storeDirectory, COVERAGE_STORE_HEADER)
+        if not os.path.exists(headerFilePath):
+            raise InvalidPathError(headerFilePath, "Expected coverage store header at the following path, but it does not exist")
+        with open(headerFilePath, 'r') as headerFile:
+            header = json.load(headerFile)
+        self.dtype = np.dtype(header["dtype"])
+        self.chromSizes: Dict[str, int] = header["chromSizes"]
+        self.files: Dict[str, Dict[str, str]] = header["files"]
+        self.openArrays: Dict[tuple, np.ndarray] = dict()
+
+    def getStrands(self, chromosome):
+        """
+        Returns the strands with stored coverage for the given chromosome.
+        """
+        return tuple(self.files.get(chromosome, dict()))
+
+    def getCounts(self, chromosome, strand = UNSTRANDED) -> np.ndarray:
+        """
+        Returns a read-only memory map of the full coverage array for the given chromosome and strand.
+        """
+        if (chromosome, strand) not in self.openArrays:
+            if chromosome not in self.chromSizes:
+                raise UserInputError(f"Chromosome {chromosome} is not present in the coverage store.")
+            if strand in self.files.get(chromosome, dict()):
+                self.openArrays[(chromosome, strand)] = np.memmap(
+                    os.path.join(self.storeDirectory, self.files[chromosome][strand]),
+                    self.dtype, 'r', shape = self.chromSizes[chromosome]
+                )
+            else:
+                counts = np.zeros(self.chromSizes[chromosome], self.dtype)
+                counts.flags.writeable = False
+                self.openArrays[(chromosome, strand)] = counts
+        return self.openArrays[(chromosome, strand)]
+
+    def fetch(self, chromosome, start, end, strand = None) -> np.ndarray:
+        """
+        Returns the coverage over the 0-based, half-open region [start, end) of the given chromosome.
+        If a strand is given, the result is a zero-copy view of that strand's memory map.
+        Otherwise, coverage is summed across all stored strands, which requires a copy.
+        """
+        if strand is not None: return self.getCounts(chromosome, strand)[start:end]
+        totalCounts = np.zeros(max(min(end, self.chromSizes[chromosome]) - start, 0), np.uint64)
+        for storedStrand in self.getStrands(chromosome):
+            totalCounts += self.getCounts(chromosome, storedStrand)[start:end]
+        return totalCounts
+
+
+# Combines the given coverage stores, which must share chromosome sizes but contain different chromosomes or strands,
+# into a single store in the given output directory. The binary files are moved, not copied.
+def mergeCoverageStores(storeDirectories: List[str], outputDirectory):
+
+    os.makedirs(outputDirectory, exist_ok = True)
+    chromSizes = None
+    files: Dict[str, Dict[str, str]] = dict()
+
+    for storeDirectory in storeDirectories:
+        coverageStore = CoverageStore(storeDirectory)
+        if chromSizes is None: chromSizes = coverageStore.chromSizes
+        elif coverageStore.chromSizes != chromSizes:
+            raise UserInputError(f"Coverage store at {storeDirectory} has different chromosome sizes than the others.")
+        for chromosome, strandFiles in coverageStore.files.items():
+            for strand, fileName in strandFiles.items():
+                if strand in files.get(chromosome, dict()):
+                    raise UserInputError(f"Multiple coverage stores contain {chromosome} ({strand} strand).")
+                shutil.move(os.path.join(storeDirectory, fileName), os.path.join(outputDirectory, fileName))
+                files.setdefault(chromosome, dict())[strand] = fileName
+
+    with open(os.path.join(outputDirectory, COVERAGE_STORE_HEADER), 'w') as headerFile:
+        json.dump({"dtype": np.dtype(COVERAGE_DTYPE).name, "chromSizes": chromSizes, "files": files}, headerFile, indent = 1)
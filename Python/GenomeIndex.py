@@ -0,0 +1,195 @@
+# This script builds and caches a samtools-style index for genome fasta files, giving the name, length, and
+# byte offset of every sequence. The index is built with a single scan of the fasta the first time it's needed and
+# written next to the fasta, along with a small stamp file recording the fasta's size and modification time.
+# The index is saved under its own extension rather than as a .fai file, so any index belonging to samtools or bedtools
+# is left alone (this index may mark a sequence's line widths as unusable, which those tools can't handle).
+# Later runs reuse the index as long as the stamp still matches, and indices are also cached in memory, so chromosome
+# validity and length queries never require re-reading the fasta.
+import os, gzip, warnings
+from typing import Dict, Iterator, List, Tuple
+from benbiohelpers.CustomErrors import UserInputError
+from CoverageStore import parseChromSizes
+
+INDEX_EXTENSION = ".genome_index"
+STAMP_EXTENSION = ".genome_index.stamp"
+
+# File endings recognized as fasta files (rather than chrom.sizes files) by getChromSizes.
+FASTA_FILE_ENDINGS = (".fa", ".fasta", ".fna", ".fa.gz", ".fasta.gz", ".fna.gz")
+
+# The number of bytes to read at once when searching for the end of a sequence with irregular line lengths.
+SEARCH_BLOCK_SIZE = 1024*1024
+
+
+class FastaIndexEntry:
+    """
+    One line of a fasta index: the sequence's name and length, the byte offset of its first base, and the number of
+    bases and bytes per line. (Both per-line values are 0 if the sequence's lines are not of uniform length.)
+    """
+
+    __slots__ = ("name", "length", "offset", "lineBases", "lineWidth")
+
+    def __init__(self, name: str, length: int, offset: int, lineBases: int, lineWidth: int):
+        self.name = name
+        self.length = length
+        self.offset = offset
+        self.lineBases = lineBases
+        self.lineWidth = lineWidth
+
+    def getFaiLine(self):
+        return f"{self.name}\t{self.length}\t{self.offset}\t{self.lineBases}\t{self.lineWidth}\n"
+
+
+class GenomeIndex:
+    """
+    Answers chromosome validity and length queries for a genome fasta file from its index, and reads individual
+    sequences by seeking directly to them. Use getGenomeIndex to get a (cached) instance.
+    """
+
+    def __init__(self, fastaFilePath, entries: List[FastaIndexEntry]):
+        self.fastaFilePath = fastaFilePath
+        self.entries: Dict[str, FastaIndexEntry] = {entry.name: entry for entry in entries}
+
+    def __contains__(self, chromosome): return chromosome in self.entries
+
+    def isValidChromosome(self, chromosome): return chromosome in self.entries
+
+    def getChromosomes(self) -> List[str]:
+        """
+        Returns the chromosome names in the order they appear in the fasta file.
+        """
+        return list(self.entries)
+
+    def getLength(self, chromosome) -> int:
+        if chromosome not in self.entries:
+            raise UserInputError(f"Chromosome {chromosome} not found in {os.path.basename(self.fastaFilePath)}.")
+        return self.entries[chromosome].length
+
+    def getChromSizes(self) -> Dict[str, int]:
+        """
+        Returns a dictionary of chromosome lengths, like the one given by parseChromSizes for chrom.sizes files.
+        """
+        return {entry.name: entry.length for entry in self.entries.values()}
+
+    def readSequence(self, chromosome) -> str:
+        """
+        Reads the full sequence for the given chromosome, with line breaks removed.
+        """
+        return self.readSequenceBytes(chromosome).decode()
+
+    def readSequenceBytes(self, chromosome) -> bytes:
+        """
+        Reads the full sequence for the given chromosome as bytes (with line breaks removed), skipping the decoding
+        step for code that works with the raw bases.
+        """
+        entry = self.entries[chromosome]
+        with openFasta(self.fastaFilePath) as fastaFile:
+            fastaFile.seek(entry.offset)
+            if entry.lineBases > 0:
+                fullLines, remainingBases = divmod(entry.length, entry.lineBases)
+                sequence = fastaFile.read(fullLines*entry.lineWidth + remainingBases)
+            else:
+                sequenceBlocks = list()
+                while True:
+                    block = fastaFile.read(SEARCH_BLOCK_SIZE)
+                    headerStart = block.find(b'>')
+                    if headerStart != -1 or not block:
+                        sequenceBlocks.append(block[:headerStart] if headerStart != -1 else block)
+                        break
+                    sequenceBlocks.append(block)
+                sequence = b''.join(sequenceBlocks)
+        return sequence.translate(None, b" \t\r\n")
+
+
+def openFasta(fastaFilePath):
+    if fastaFilePath.endswith(".gz"): return gzip.open(fastaFilePath, 'rb')
+    else: return open(fastaFilePath, 'rb')
+
+
+# Scans the given fasta file and yields an index entry for each of its sequences.
+def buildFastaIndex(fastaFilePath) -> Iterator[FastaIndexEntry]:
+
+    entry = None
+    lastLineWidth = None
+    position = 0
+
+    with openFasta(fastaFilePath) as fastaFile:
+        for line in fastaFile:
+
+            if line.startswith(b'>'):
+                if entry is not None: yield entry
+                entry = FastaIndexEntry(line[1:].split()[0].decode(), 0, position + len(line), 0, 0)
+                lastLineWidth = None
+
+            elif entry is not None and line.strip():
+                lineBases = len(line.rstrip(b'\r\n'))
+                if entry.length == 0: entry.lineBases, entry.lineWidth = lineBases, len(line)
+                # Every line but the last must be the same length for the index's line widths to be usable.
+                elif lastLineWidth != entry.lineWidth or lineBases > entry.lineBases:
+                    entry.lineBases, entry.lineWidth = 0, 0
+                entry.length += lineBases
+                lastLineWidth = len(line)
+
+            # Blank lines within a sequence also leave its line widths unusable.
+            elif entry is not None and entry.length > 0: entry.lineBases, entry.lineWidth = 0, 0
+
+            position += len(line)
+
+    if entry is not None: yield entry
+
+
+# Returns the (size, modification time) stamp used to check whether a fasta file has changed since it was indexed.
+def getFastaStamp(fastaFilePath) -> Tuple[int, int]:
+    fastaStat = os.stat(fastaFilePath)
+    return fastaStat.st_size, fastaStat.st_mtime_ns
+
+
+# Reads the index for the given fasta file from disk, returning None if there is no index or its stamp doesn't match.
+def readCachedIndex(fastaFilePath, stamp) -> List[FastaIndexEntry]:
+
+    indexFilePath, stampFilePath = fastaFilePath + INDEX_EXTENSION, fastaFilePath + STAMP_EXTENSION
+    if not (os.path.exists(indexFilePath) and os.path.exists(stampFilePath)): return None
+
+    with open(stampFilePath, 'r') as stampFile:
+        if tuple(int(value) for value in stampFile.read().split()) != stamp: return None
+
+    with open(indexFilePath, 'r') as indexFile:
+        return [FastaIndexEntry(name, int(length), int(offset), int(lineBases), int(lineWidth))
+                for name, length, offset, lineBases, lineWidth in (line.split('\t') for line in indexFile)]
+
+
+# Writes the given index and stamp next to the fasta file, warning (but continuing) if that isn't possible.
+def writeCachedIndex(fastaFilePath, stamp, entries: List[FastaIndexEntry]):
+
+    indexFilePath, stampFilePath = fastaFilePath + INDEX_EXTENSION, fastaFilePath + STAMP_EXTENSION
+    try:
+        with open(indexFilePath + ".tmp", 'w') as indexFile:
+            indexFile.write(''.join(entry.getFaiLine() for entry in entries))
+        os.replace(indexFilePath + ".tmp", indexFilePath)
+        with open(stampFilePath, 'w') as stampFile:
+            stampFile.write(f"{stamp[0]}\t{stamp[1]}\n")
+    except OSError as error:
+        warnings.warn(f"Unable to save the index for {os.path.basename(fastaFilePath)}: {error}")
+
+
+genomeIndexCache: Dict[Tuple[str, int, int], GenomeIndex] = dict()
+
+# Returns the index for the given genome fasta file, from memory if possible, then from the index saved next to the
+# fasta, and otherwise by indexing the fasta (and saving the result).
+def getGenomeIndex(fastaFilePath) -> GenomeIndex:
+
+    stamp = getFastaStamp(fastaFilePath)
+    cacheKey = (os.path.abspath(fastaFilePath),) + stamp
+    if cacheKey not in genomeIndexCache:
+        entries = readCachedIndex(fastaFilePath, stamp)
+        if entries is None:
+            print(f"Indexing {os.path.basename(fastaFilePath)}...")
+            entries = list(buildFastaIndex(fastaFilePath))
+            writeCachedIndex(fastaFilePath, stamp, entries)
+        genomeIndexCache[cacheKey] = GenomeIndex(fastaFilePath, entries)
+    return genomeIndexCache[cacheKey]
+
+
+# Returns a dictionary of chromosome sizes from either a chrom.sizes file or a genome fasta file (through its index).
+def getChromSizes(chromSizesFilePath) -> Dict[str, int]:
+    if chromSizesFilePath.endswith(FASTA_FILE_ENDINGS): return getGenomeIndex(chromSizesFilePath).getChromSizes()
+    else: return parseChromSizes(chromSizesFilePath)
@@ -1,51 +1,299 @@
 # This script takes a genome fasta file and one or more sequences and determines their frequency throughout the genome.
-import os
+# Sequences of a single length made up of only A, C, G, and T are counted with the 2-bit vectorized k-mer engine in
+# KmerCounting. Otherwise (mixed lengths or IUPAC ambiguity codes), all sequences are found in a single scan of each
+# chromosome with an Aho-Corasick automaton (see MotifSearch), which can also write every match to a bed file.
+# A full-spectrum mode also counts every k-mer of a given length (optionally collapsed with reverse complements) and
+# writes the counts to a TSV file. Chromosomes can be counted in a pool of worker processes.
+# Chromosome sequences are read from the genome's memory-mapped .2bit file (see TwoBitGenome), which worker processes
+# share instead of each reading the fasta.
+# A windowed mode instead gives the sequences' frequency within fixed-size windows along each chromosome (e.g. for GC
+# or dipyrimidine normalization), written as a bedGraph file or as binary per-chromosome arrays (see CoverageStore).
+import os, json, shutil, tempfile, warnings
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
-from benbiohelpers.FileSystemHandling.FastaFileIterator import FastaFileIterator
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
 from benbiohelpers.InputParsing.ParseToIterable import parseToIterable
-from benbiohelpers.CustomErrors import UserInputError
+from benbiohelpers.CustomErrors import UserInputError, checkForNumber
+from GenomeIndex import getGenomeIndex
+from TwoBitGenome import getTwoBitGenome
+from KmerCountIndex import KmerCountIndex
+from MotifSearch import AhoCorasickAutomaton, expandIUPACMotif
+from ParallelProcessing import concatenateFiles
+from CoverageStore import CoverageStoreWriter, UNSTRANDED
+from KmerCounting import (encodeKmer, decodeKmer, countKmers, countSelectedKmers, collapseReverseComplements,
+                          getReverseComplementCodes, countKmersInWindows, MAX_HISTOGRAM_K)
 
+BEDGRAPH_FORMAT = "bedGraph"
+BINARY_FORMAT = "binary"
 
-def getGenomicSequenceFrequency(genomeFastaFilePath, sequences: List[str]):
+WINDOWED_FREQUENCY_HEADER = "windowed_frequency.json"
+
+
+# Returns the full (upper case) sequence of a single chromosome from the genome's .2bit file.
+def readChromosomeBytes(genomeFastaFilePath, chromosome) -> bytes:
+    return getTwoBitGenome(genomeFastaFilePath).fetchBytes(chromosome, softMask = False)
+
+
+# Counts k-mers in a single chromosome of the given genome: the full histogram if kmerCodes is None, or the counts
+# for each of the given k-mer codes otherwise.
+def countChromosomeKmers(genomeFastaFilePath, chromosome, k, kmerCodes = None) -> np.ndarray:
+    chromosomeSequence = readChromosomeBytes(genomeFastaFilePath, chromosome)
+    if kmerCodes is None: return countKmers(chromosomeSequence, k)
+    else: return countSelectedKmers(chromosomeSequence, k, kmerCodes)
+
+
+automatonCache = dict()
+
+# Counts occurrences of each of the given motifs in a single chromosome of the given genome. If bedDirectory is
+# given, every match is also written to a bed file named for the chromosome within that directory.
+def countChromosomeMotifs(genomeFastaFilePath, chromosome, motifs: List[str], bedDirectory = None) -> np.ndarray:
+
+    # Build the automaton once per process.
+    if tuple(motifs) not in automatonCache: automatonCache[tuple(motifs)] = AhoCorasickAutomaton(motifs)
+    automaton: AhoCorasickAutomaton = automatonCache[tuple(motifs)]
+    chromosomeSequence = readChromosomeBytes(genomeFastaFilePath, chromosome)
+
+    if bedDirectory is None: return automaton.countMatches(chromosomeSequence)
+
+    motifCounts = np.zeros(len(motifs), np.int64)
+    outputLines = list()
+    with open(os.path.join(bedDirectory, f"{chromosome}.bed"), 'w') as bedFile:
+        for startPos, endPos, motifIndex in automaton.findMatches(chromosomeSequence):
+            motifCounts[motifIndex] += 1
+            outputLines.append(f"{chromosome}\t{startPos}\t{endPos}\t{motifs[motifIndex]}\t.\t+\n")
+            if len(outputLines) == 100000:
+                bedFile.write(''.join(outputLines))
+                outputLines.clear()
+        bedFile.write(''.join(outputLines))
+    return motifCounts
+
+
+# Runs countFunction(genomeFastaFilePath, chromosome, *args) for every chromosome in the given genome and sums the
+# resulting count arrays, which should all have the given length. If workers is greater than 1, chromosomes are
+# counted in a pool of that many processes, largest first.
+def sumChromosomeCounts(countFunction, genomeFastaFilePath, countsLength, workers, *args) -> np.ndarray:
+
+    genomeIndex = getGenomeIndex(genomeFastaFilePath)
+    chromosomes = sorted(genomeIndex.getChromosomes(), key = genomeIndex.getLength, reverse = True)
+    getTwoBitGenome(genomeFastaFilePath) # Converts the genome (if necessary) before any work is farmed out.
+    counts = np.zeros(countsLength, np.int64)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = [executor.submit(countFunction, genomeFastaFilePath, chromosome, *args)
+                       for chromosome in chromosomes]
+            for chromosome, future in zip(chromosomes, futures):
+                counts += future.result()
+                print(f"\tCounted {chromosome}.")
+    else:
+        for chromosome in chromosomes:
+            print(f"\tCounting in {chromosome}...")
+            counts += countFunction(genomeFastaFilePath, chromosome, *args)
+
+    return counts
+
+
+# Counts k-mers throughout the given genome (see countChromosomeKmers), summing the counts from each chromosome.
+def countGenomeKmers(genomeFastaFilePath, k, kmerCodes = None, workers = 1) -> np.ndarray:
+    return sumChromosomeCounts(countChromosomeKmers, genomeFastaFilePath,
+                               4**k if kmerCodes is None else len(kmerCodes), workers, k, kmerCodes)
+
+
+# Returns the genome-wide histogram of every k-mer, from the genome's persistent k-mer index if useKmerIndex is true
+# (see KmerCountIndex). If the index can't be written, the k-mers are counted directly instead.
+def getGenomeKmerHistogram(genomeFastaFilePath, k, workers = 1, useKmerIndex = True) -> np.ndarray:
+    if useKmerIndex:
+        try: return KmerCountIndex(genomeFastaFilePath, workers = workers).getCounts(k)
+        except OSError as error:
+            warnings.warn(f"Unable to use the k-mer index for {os.path.basename(genomeFastaFilePath)}: {error}")
+    return countGenomeKmers(genomeFastaFilePath, k, workers = workers)
+
+
+# Counts the given motifs throughout the given genome in a single scan of each chromosome. If bedOutputFilePath is
+# given, every match is also written there (ordered by chromosome as in the fasta file, then by match end position).
+def countGenomeMotifs(genomeFastaFilePath, motifs: List[str], workers = 1, bedOutputFilePath = None) -> np.ndarray:
+
+    AhoCorasickAutomaton(motifs) # Validates the motifs before any work is farmed out.
+    if bedOutputFilePath is None:
+        return sumChromosomeCounts(countChromosomeMotifs, genomeFastaFilePath, len(motifs), workers, motifs)
+
+    bedDirectory = tempfile.mkdtemp(prefix = "motif_matches_",
+                                    dir = os.path.dirname(os.path.abspath(bedOutputFilePath)))
+    try:
+        motifCounts = sumChromosomeCounts(countChromosomeMotifs, genomeFastaFilePath, len(motifs), workers,
+                                          motifs, bedDirectory)
+        concatenateFiles([os.path.join(bedDirectory, f"{chromosome}.bed")
+                          for chromosome in getGenomeIndex(genomeFastaFilePath).getChromosomes()], bedOutputFilePath)
+    finally:
+        shutil.rmtree(bedDirectory, ignore_errors = True)
+    return motifCounts
+
+
+# Counts the given sequences throughout the genome and prints each one's frequency relative to the number of genome
+# positions for sequences of its length. Sequences may be of mixed lengths and contain IUPAC ambiguity codes.
+# If bedOutputFilePath is given, every match is written there as well.
+# Short sequences of a single length are read from the genome's persistent k-mer index unless useKmerIndex is false.
+def getGenomicSequenceFrequency(genomeFastaFilePath, sequences: List[str], workers = 1, bedOutputFilePath = None,
+                                useKmerIndex = True):
 
     # Do we have multiple sequences?
     if len(sequences) == 0: raise UserInputError("No sequences given.")
 
-    # Make sure all given sequences are of the same length, otherwise things get messy.
-    sequenceLength = len(sequences[0])
-    if not all(len(sequence) == sequenceLength for sequence in sequences):
-        raise UserInputError("Not all sequences are of a uniform length.")
-
-    # Conver the sequences to upper case.
-    sequences = [sequence.upper() for sequence in sequences]
+    # Conver the sequences to upper case, removing any duplicates.
+    sequences = list(dict.fromkeys(sequence.upper() for sequence in sequences))
+    sequenceLengths = {len(sequence) for sequence in sequences}
 
     print(f"\nGiven sequences: {sequences}")
 
-    # Create a dictionary of counts for each sequence and an integer for counts of sequences not in the dictionary. 
-    sequenceCounts = dict()
-    for sequence in sequences: sequenceCounts[sequence] = 0
-    totalCounts = 0
-
-    # Iterate through the fasta file, counting sequences as you go.
     print("\nCounting sequences throughout the genome...")
-    with open(genomeFastaFilePath, 'r') as genomeFastaFile:
-        for fastaEntry in FastaFileIterator(genomeFastaFile, False):
-            print(f"\tCounting in {fastaEntry.sequenceName}...")
-            for i in range(len(fastaEntry.sequence)-sequenceLength+1):
-                sequence = fastaEntry.sequence[i:i+sequenceLength].upper()
-                if sequence in sequenceCounts: sequenceCounts[sequence] += 1
-                totalCounts += 1
+    genomeIndex = getGenomeIndex(genomeFastaFilePath)
+
+    # Plain sequences of a single length are counted with the k-mer engine. For short sequences, a histogram of every
+    # k-mer is counted (or read from the k-mer index) and the requested sequences are read off of it. Otherwise, only
+    # the requested sequences are counted. Anything else goes through the Aho-Corasick automaton.
+    if (len(sequenceLengths) == 1 and bedOutputFilePath is None
+        and all(set(sequence) <= set("ACGT") for sequence in sequences)):
+        sequenceLength = len(sequences[0])
+        kmerCodes = [encodeKmer(sequence) for sequence in sequences]
+        useHistogram = sequenceLength <= MAX_HISTOGRAM_K
+        if useHistogram: kmerCounts = getGenomeKmerHistogram(genomeFastaFilePath, sequenceLength, workers, useKmerIndex)
+        else: kmerCounts = countGenomeKmers(genomeFastaFilePath, sequenceLength, kmerCodes, workers)
+        sequenceCounts = {sequence: int(kmerCounts[kmerCode if useHistogram else i])
+                          for i, (sequence, kmerCode) in enumerate(zip(sequences, kmerCodes))}
+    else:
+        motifCounts = countGenomeMotifs(genomeFastaFilePath, sequences, workers, bedOutputFilePath)
+        sequenceCounts = {sequence: int(motifCount) for sequence, motifCount in zip(sequences, motifCounts)}
+
+    # Get the number of genome positions for each sequence length.
+    totalCountsByLength = {sequenceLength: sum(max(0, genomeIndex.getLength(chromosome)-sequenceLength+1)
+                                               for chromosome in genomeIndex.getChromosomes())
+                           for sequenceLength in sequenceLengths}
 
     # Print the results:
     print("Results:")
     for sequence in sequenceCounts:
+        totalCounts = totalCountsByLength[len(sequence)]
         print(f"\t{sequence} counts: {sequenceCounts[sequence]} ({sequenceCounts[sequence]/totalCounts*100}%)")
-    if len(sequenceCounts) > 1:
+    if len(sequenceCounts) > 1 and len(sequenceLengths) == 1:
         totalCounts = sum(count for count in sequenceCounts.values())
         print(f"\tTotal sequence counts: {totalCounts} ({totalCounts/totalCounts*100}%)")
 
 
+# Counts every k-mer of length k throughout the given genome and writes the counts to a TSV file, along with each
+# k-mer's frequency among all counted k-mers (those without any bases other than A, C, G, and T).
+# If collapseStrands is true, each k-mer is counted together with its reverse complement, and only the
+# lesser of the two (alphabetically) is written. Counts are read from the genome's persistent k-mer index unless
+# useKmerIndex is false. Returns the path to the TSV file.
+def getGenomicKmerSpectrum(genomeFastaFilePath, k, collapseStrands = False, workers = 1, outputFilePath = None,
+                           useKmerIndex = True):
+
+    if not 0 < k <= MAX_HISTOGRAM_K:
+        raise UserInputError(f"k-mer length must be between 1 and {MAX_HISTOGRAM_K}, but {k} was given.")
+    if outputFilePath is None:
+        outputFilePath = (genomeFastaFilePath.rsplit('.',1)[0] + f"_{k}-mer_counts" +
+                          ("_collapsed" if collapseStrands else "") + ".tsv")
+
+    print(f"\nCounting every {k}-mer throughout the genome...")
+    histogram = getGenomeKmerHistogram(genomeFastaFilePath, k, workers, useKmerIndex)
+    totalCounts = histogram.sum()
+
+    if collapseStrands:
+        kmerCodes, kmerCounts = collapseReverseComplements(histogram, k)
+        reverseComplementCodes = getReverseComplementCodes(k)
+    else: kmerCodes, kmerCounts = np.arange(4**k), histogram
+
+    print(f"Writing counts to {os.path.basename(outputFilePath)}...")
+    with open(outputFilePath, 'w') as outputFile:
+        if collapseStrands: outputFile.write("k-mer\treverse_complement\tcount\tfrequency\n")
+        else: outputFile.write("k-mer\tcount\tfrequency\n")
+        for kmerCode, kmerCount in zip(kmerCodes.tolist(), kmerCounts.tolist()):
+            frequency = kmerCount/totalCounts if totalCounts else 0
+            if collapseStrands:
+                reverseComplement = decodeKmer(int(reverseComplementCodes[kmerCode]), k)
+                outputFile.write(f"{decodeKmer(kmerCode, k)}\t{reverseComplement}\t{kmerCount}\t{frequency}\n")
+            else: outputFile.write(f"{decodeKmer(kmerCode, k)}\t{kmerCount}\t{frequency}\n")
+
+    return outputFilePath
+
+
+# Counts the given k-mer codes in consecutive windows along a single chromosome of the given genome, returning the
+# number of matches and valid k-mers in each window (see countKmersInWindows).
+def countChromosomeWindows(genomeFastaFilePath, chromosome, k, kmerCodes, windowSize):
+    chromosomeSequence = readChromosomeBytes(genomeFastaFilePath, chromosome)
+    return countKmersInWindows(chromosomeSequence, k, kmerCodes, windowSize)
+
+
+# Determines the frequency of the given sequences within consecutive windows of the given size along each chromosome:
+# the number of positions matching any of the sequences, divided by the number of positions with a valid k-mer (one
+# containing only A, C, G, and T). Sequences must all be the same length but may contain IUPAC ambiguity codes (e.g.
+# "S" for GC content or "YY" for dipyrimidines). Each position is assigned to the window containing its first base.
+# Chromosomes are counted (in a pool of worker processes if workers > 1) and written one at a time, as either:
+#   - a bedGraph file of frequencies, omitting windows without any valid k-mers, or
+#   - a directory with two coverage stores indexed by window rather than base ("matches" and "valid_kmers"), plus a
+#     JSON header giving the window size and sequences.
+# Returns the path to the output file or directory.
+def getWindowedSequenceFrequency(genomeFastaFilePath, sequences: List[str], windowSize, outputFormat = BEDGRAPH_FORMAT,
+                                 workers = 1, outputFilePath = None):
+
+    if len(sequences) == 0: raise UserInputError("No sequences given.")
+    sequences = list(dict.fromkeys(sequence.upper() for sequence in sequences))
+    if len({len(sequence) for sequence in sequences}) != 1:
+        raise UserInputError("Windowed frequencies require sequences of a uniform length.")
+    if windowSize <= 0: raise UserInputError(f"Window size must be positive, but {windowSize} was given.")
+    if outputFormat not in (BEDGRAPH_FORMAT, BINARY_FORMAT):
+        raise UserInputError(f"Unrecognized output format: {outputFormat}")
+
+    k = len(sequences[0])
+    kmerCodes = sorted({encodeKmer(expandedSequence) for sequence in sequences
+                        for expandedSequence in expandIUPACMotif(sequence)})
+    if outputFilePath is None:
+        outputFilePath = (genomeFastaFilePath.rsplit('.',1)[0] + f"_{'_'.join(sequences)}_{windowSize}bp_windows" +
+                          (".bedGraph" if outputFormat == BEDGRAPH_FORMAT else ""))
+
+    genomeIndex = getGenomeIndex(genomeFastaFilePath)
+    chromosomes = genomeIndex.getChromosomes()
+    getTwoBitGenome(genomeFastaFilePath) # Converts the genome (if necessary) before any work is farmed out.
+    print(f"\nCounting {sequences} in {windowSize} bp windows throughout the genome...")
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers = workers)
+        windowedCounts = executor.map(countChromosomeWindows, [genomeFastaFilePath]*len(chromosomes), chromosomes,
+                                      [k]*len(chromosomes), [kmerCodes]*len(chromosomes), [windowSize]*len(chromosomes))
+    else:
+        executor = None
+        windowedCounts = (countChromosomeWindows(genomeFastaFilePath, chromosome, k, kmerCodes, windowSize)
+                          for chromosome in chromosomes)
+
+    try:
+        if outputFormat == BEDGRAPH_FORMAT:
+            with open(outputFilePath, 'w') as outputFile:
+                for chromosome, (matchCounts, validCounts) in zip(chromosomes, windowedCounts):
+                    print(f"\tWriting {chromosome}...")
+                    windowStarts = np.flatnonzero(validCounts)
+                    windowEnds = np.minimum((windowStarts + 1) * windowSize, genomeIndex.getLength(chromosome))
+                    frequencies = matchCounts[windowStarts] / validCounts[windowStarts]
+                    outputFile.write(''.join(f"{chromosome}\t{windowStart*windowSize}\t{windowEnd}\t{frequency:.6g}\n"
+                                             for windowStart, windowEnd, frequency in
+                                             zip(windowStarts.tolist(), windowEnds.tolist(), frequencies.tolist())))
+        else:
+            windowCounts = {chromosome: -(-genomeIndex.getLength(chromosome) // windowSize)
+                            for chromosome in chromosomes}
+            with CoverageStoreWriter(os.path.join(outputFilePath, "matches"), windowCounts) as matchesWriter, \
+                 CoverageStoreWriter(os.path.join(outputFilePath, "valid_kmers"), windowCounts) as validWriter:
+                for chromosome, (matchCounts, validCounts) in zip(chromosomes, windowedCounts):
+                    print(f"\tWriting {chromosome}...")
+                    matchesWriter.writeCounts(chromosome, UNSTRANDED, matchCounts)
+                    validWriter.writeCounts(chromosome, UNSTRANDED, validCounts)
+            with open(os.path.join(outputFilePath, WINDOWED_FREQUENCY_HEADER), 'w') as headerFile:
+                json.dump({"windowSize": windowSize, "sequences": sequences,
+                           "chromSizes": genomeIndex.getChromSizes()}, headerFile, indent = 1)
+    finally:
+        if executor is not None: executor.shutdown(cancel_futures = True)
+
+    return outputFilePath
+
+
 def main():
 
     # Get the working directory from mutperiod if possible. Otherwise, just use this script's directory.
@@ -58,12 +306,37 @@ def main():
     # Get user input from a tkinter dialog.
     with TkinterDialog(workingDirectory = workingDirectory) as dialog:
         dialog.createFileSelector("Genome Fasta File:", 0, ("Fasta File", ".fa"))
-        dialog.createTextField("Sequence(s) to count:", 1, 0, defaultText = "CC, CT, TC, TT")
+        with dialog.createDynamicSelector(1, 0) as spectrumDynSel:
+            spectrumDynSel.initCheckboxController("Count every k-mer (full spectrum)")
+            sequencesDisplay = spectrumDynSel.initDisplay(False, "sequences")
+            sequencesDisplay.createTextField("Sequence(s) to count:", 0, 0, defaultText = "CC, CT, TC, TT")
+            sequencesDisplay.createCheckbox("Write matches to a bed file", 1, 0)
+            spectrumDisplay = spectrumDynSel.initDisplay(True, "spectrum")
+            spectrumDisplay.createTextField("k-mer length:", 0, 0, defaultText = "3")
+            spectrumDisplay.createCheckbox("Collapse reverse complements", 1, 0)
+        with dialog.createDynamicSelector(2, 0) as windowedDynSel:
+            windowedDynSel.initCheckboxController("Count sequences in windows")
+            windowedDisplay = windowedDynSel.initDisplay(True, "windowed")
+            windowedDisplay.createTextField("Window size (bp):", 0, 0, defaultText = "1000")
+            windowedDisplay.createCheckbox("Write binary arrays instead of a bedGraph file", 1, 0)
+        dialog.createTextField("Worker processes:", 3, 0, defaultText = "1")
 
     genomeFastaFilePath = dialog.selections.getIndividualFilePaths()[0]
-    sequences = parseToIterable(dialog.selections.getTextEntries()[0], castValuesToInt = False)
-
-    getGenomicSequenceFrequency(genomeFastaFilePath, sequences)
+    workers = checkForNumber(dialog.selections.getTextEntries()[0], True, lambda x: x > 0)
 
+    if spectrumDynSel.getControllerVar():
+        k = checkForNumber(dialog.selections.getTextEntries("spectrum")[0], True, lambda x: x > 0)
+        getGenomicKmerSpectrum(genomeFastaFilePath, k, dialog.selections.getToggleStates("spectrum")[0], workers)
+    else:
+        sequences = parseToIterable(dialog.selections.getTextEntries("sequences")[0], castValuesToInt = False)
+        if windowedDynSel.getControllerVar():
+            windowSize = checkForNumber(dialog.selections.getTextEntries("windowed")[0], True, lambda x: x > 0)
+            outputFormat = BINARY_FORMAT if dialog.selections.getToggleStates("windowed")[0] else BEDGRAPH_FORMAT
+            getWindowedSequenceFrequency(genomeFastaFilePath, sequences, windowSize, outputFormat, workers)
+            return
+        if dialog.selections.getToggleStates("sequences")[0]:
+            bedOutputFilePath = genomeFastaFilePath.rsplit('.',1)[0] + "_sequence_matches.bed"
+        else: bedOutputFilePath = None
+        getGenomicSequenceFrequency(genomeFastaFilePath, sequences, workers, bedOutputFilePath)
 
 if __name__ == "__main__": main()
\ No newline at end of file
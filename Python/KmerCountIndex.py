@@ -0,0 +1,293 @@
+# This script maintains a persistent, on-disk cache of per-chromosome k-mer histograms for a genome fasta file, so that
+# repeated k-mer queries against the same genome don't require rescanning it. The cache is a directory next to the
+# fasta containing one (chromosomes x 4^k) count array per cached k, plus a JSON header recording the fasta's size,
+# modification time, and SHA-1 hash. If the size or modification time changes, the hash is checked again, and the
+# cache is cleared if the fasta's contents have changed.
+# Counts for a shorter k are derived from any cached longer k by marginalization: each k-mer's count is the sum of the
+# counts of the longer k-mers it begins. The k-mers that don't begin any longer k-mer (those at the end of a chromosome
+# or next to an N) all fall within the last (longer k - 1) bases of each run of valid bases, so these "tails" are
+# stored alongside the counts and counted directly.
+# Histograms are written to disk one chromosome at a time. When one row per chromosome would make an entry too large
+# (e.g. k=12 on a genome with hundreds of contigs), only the genome-wide histogram is stored instead.
+# Once the cache grows beyond its maximum size, the least recently used histograms are evicted, and histograms that
+# would be larger than the cache itself are counted without being cached.
+import os, json, time, shutil, hashlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+from benbiohelpers.CustomErrors import UserInputError
+from GenomeIndex import getGenomeIndex
+from KmerCounting import BASE_ENCODING, INVALID_BASE, MAX_HISTOGRAM_K, countKmers, encodeKmer
+
+KMER_INDEX_EXTENSION = ".kmer_index"
+KMER_INDEX_HEADER = "kmer_index.json"
+
+COUNT_DTYPE = np.uint32
+GENOME_WIDE_COUNT_DTYPE = np.uint64
+
+# The largest entry (in bytes) stored with one histogram per chromosome. Larger entries are stored genome-wide.
+MAX_PER_CHROMOSOME_ENTRY_SIZE = 256*1024*1024
+
+# The default maximum size of a k-mer count index, in bytes.
+DEFAULT_MAX_CACHE_SIZE = 2*1024*1024*1024
+
+# The number of bytes to read at once when hashing a fasta file.
+HASH_BLOCK_SIZE = 16*1024*1024
+
+
+# Returns the SHA-1 hash of the given file's contents.
+def hashFile(filePath) -> str:
+    fileHash = hashlib.sha1()
+    with open(filePath, 'rb') as hashedFile:
+        for block in iter(lambda: hashedFile.read(HASH_BLOCK_SIZE), b''): fileHash.update(block)
+    return fileHash.hexdigest()
+
+
+# Returns the last (k - 1) bases of every run of valid (ACGT) bases in the given sequence (or the whole run if it's
+# shorter than that), joined by N's.
+def getRunTails(sequence: bytes, k) -> bytes:
+
+    if k == 1: return b''
+    isValid = BASE_ENCODING[np.frombuffer(sequence, np.uint8)] != INVALID_BASE
+    validityChanges = np.flatnonzero(np.diff(np.concatenate(((False,), isValid, (False,))).astype(np.int8)))
+    runStarts, runEnds = validityChanges[::2], validityChanges[1::2]
+    return b'N'.join(sequence[max(runStart, runEnd - k + 1):runEnd]
+                     for runStart, runEnd in zip(runStarts.tolist(), runEnds.tolist()))
+
+
+# Counts every k-mer in a single chromosome of the given genome, returning the histogram and the chromosome's run tails.
+def countChromosomeKmersWithTails(genomeFastaFilePath, chromosome, k) -> Tuple[np.ndarray, bytes]:
+    chromosomeSequence = getGenomeIndex(genomeFastaFilePath).readSequenceBytes(chromosome)
+    return countKmers(chromosomeSequence, k).astype(COUNT_DTYPE), getRunTails(chromosomeSequence, k)
+
+
+class KmerCountIndex:
+    """
+    A persistent cache of per-chromosome k-mer histograms for the given genome fasta file, stored in a
+    ".kmer_index" directory next to it (or in indexDirectory, if given). Histograms are counted (in a pool of the
+    given number of worker processes) the first time they can't be derived from the cache.
+    """
+
+    def __init__(self, genomeFastaFilePath, maxCacheSize = DEFAULT_MAX_CACHE_SIZE, workers = 1, indexDirectory = None):
+        self.genomeFastaFilePath = genomeFastaFilePath
+        self.maxCacheSize = maxCacheSize
+        self.workers = workers
+        if indexDirectory is None: indexDirectory = genomeFastaFilePath + KMER_INDEX_EXTENSION
+        self.indexDirectory = indexDirectory
+        self.header = self.readHeader()
+
+    def getFilePath(self, fileName): return os.path.join(self.indexDirectory, fileName)
+
+    def readHeader(self) -> Dict:
+        """
+        Reads the index's JSON header, making sure the index still matches the fasta file, and returns it.
+        If the index doesn't exist yet or no longer matches, a fresh (empty) header is returned.
+        """
+        fastaStat = os.stat(self.genomeFastaFilePath)
+        header = None
+        if os.path.exists(self.getFilePath(KMER_INDEX_HEADER)):
+            with open(self.getFilePath(KMER_INDEX_HEADER), 'r') as headerFile: header = json.load(headerFile)
+
+        if header is not None and (header["fastaSize"], header["fastaMtime"]) != (fastaStat.st_size,
+                                                                                   fastaStat.st_mtime_ns):
+            # The fasta may have just been touched or copied, so check whether its contents actually changed.
+            if header["fastaSize"] == fastaStat.st_size and header["fastaHash"] == hashFile(self.genomeFastaFilePath):
+                header["fastaMtime"] = fastaStat.st_mtime_ns
+                self.header = header
+                self.writeHeader()
+            else:
+                print(f"{os.path.basename(self.genomeFastaFilePath)} has changed. Clearing its k-mer index...")
+                self.header = header
+                self.invalidate()
+                header = None
+
+        if header is None:
+            header = {"fastaSize": fastaStat.st_size, "fastaMtime": fastaStat.st_mtime_ns, "fastaHash": None,
+                      "chromosomes": getGenomeIndex(self.genomeFastaFilePath).getChromosomes(), "entries": dict()}
+        return header
+
+    def writeHeader(self):
+        os.makedirs(self.indexDirectory, exist_ok = True)
+        with open(self.getFilePath(KMER_INDEX_HEADER + ".tmp"), 'w') as headerFile: json.dump(self.header, headerFile)
+        os.replace(self.getFilePath(KMER_INDEX_HEADER + ".tmp"), self.getFilePath(KMER_INDEX_HEADER))
+
+    def getCachedKs(self) -> List[int]:
+        return sorted(int(k) for k in self.header["entries"])
+
+    def getCacheSize(self) -> int:
+        return sum(entry["size"] for entry in self.header["entries"].values())
+
+    def invalidate(self, k = None):
+        """
+        Removes the cached histograms for the given k, or the entire index if k is None.
+        """
+        if k is None:
+            shutil.rmtree(self.indexDirectory, ignore_errors = True)
+            self.header["entries"] = dict()
+            return
+        if str(k) not in self.header["entries"]: return
+        for fileName in self.header["entries"].pop(str(k))["files"]:
+            if os.path.exists(self.getFilePath(fileName)): os.remove(self.getFilePath(fileName))
+        self.writeHeader()
+
+    def evict(self, keptK = None, reservedSize = 0):
+        """
+        Removes the least recently used histograms (other than those for keptK) until the index is no larger than
+        its maximum size, less reservedSize bytes (e.g. to make room for a new entry).
+        """
+        for k in sorted(self.getCachedKs(), key = lambda k: self.header["entries"][str(k)]["lastAccess"]):
+            if self.getCacheSize() + reservedSize <= self.maxCacheSize: break
+            if k != keptK:
+                print(f"Evicting {k}-mer counts from the k-mer index...")
+                self.invalidate(k)
+
+    def isStoredPerChromosome(self, k) -> bool:
+        """
+        Returns whether histograms for the given k are small enough to be stored with one row per chromosome.
+        """
+        return len(self.header["chromosomes"]) * 4**k * np.dtype(COUNT_DTYPE).itemsize <= MAX_PER_CHROMOSOME_ENTRY_SIZE
+
+    def getEntrySize(self, k) -> int:
+        """
+        Returns the approximate size (in bytes) of the stored histograms for the given k, allowing for one run tail
+        per chromosome and the .npy header.
+        """
+        tailsSize = len(self.header["chromosomes"]) * (k + 64) + 128
+        if self.isStoredPerChromosome(k):
+            return len(self.header["chromosomes"]) * 4**k * np.dtype(COUNT_DTYPE).itemsize + tailsSize
+        else: return 4**k * np.dtype(GENOME_WIDE_COUNT_DTYPE).itemsize + tailsSize
+
+    def countChromosomes(self, k) -> Iterator[Tuple[np.ndarray, bytes]]:
+        """
+        Yields each chromosome's histogram and run tails (see countChromosomeKmersWithTails) in fasta order, counting
+        them in a pool of worker processes if more than one worker was requested.
+        """
+        chromosomes = self.header["chromosomes"]
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers = self.workers) as executor:
+                yield from executor.map(countChromosomeKmersWithTails, [self.genomeFastaFilePath]*len(chromosomes),
+                                        chromosomes, [k]*len(chromosomes))
+        else:
+            for chromosome in chromosomes: yield countChromosomeKmersWithTails(self.genomeFastaFilePath, chromosome, k)
+
+    def countAndStore(self, k):
+        """
+        Counts every k-mer in each chromosome and stores the histograms (and run tails) in the index, writing one
+        chromosome at a time. Histograms are stored per chromosome if they're small enough, and genome-wide otherwise.
+        """
+        chromosomes = self.header["chromosomes"]
+        perChromosome = self.isStoredPerChromosome(k)
+        print(f"Counting every {k}-mer in {os.path.basename(self.genomeFastaFilePath)} for the k-mer index...")
+
+        # Make room for the new entry before writing it.
+        self.evict(k, self.getEntrySize(k))
+
+        if self.header["fastaHash"] is None: self.header["fastaHash"] = hashFile(self.genomeFastaFilePath)
+        os.makedirs(self.indexDirectory, exist_ok = True)
+        countsFileName, tailsFileName = f"k{k}_counts.npy", f"k{k}_tails.json"
+
+        storedCounts = np.lib.format.open_memmap(
+            self.getFilePath(countsFileName + ".tmp"), 'w+',
+            COUNT_DTYPE if perChromosome else GENOME_WIDE_COUNT_DTYPE, (len(chromosomes) if perChromosome else 1, 4**k)
+        )
+        tails = dict()
+        for i, (chromosome, (counts, chromosomeTails)) in enumerate(zip(chromosomes, self.countChromosomes(k))):
+            if perChromosome: storedCounts[i] = counts
+            else: storedCounts[0] += counts
+            tails[chromosome] = chromosomeTails.decode()
+        storedCounts.flush()
+        del storedCounts
+        os.replace(self.getFilePath(countsFileName + ".tmp"), self.getFilePath(countsFileName))
+        with open(self.getFilePath(tailsFileName), 'w') as tailsFile: json.dump(tails, tailsFile)
+
+        self.header["entries"][str(k)] = {
+            "files": [countsFileName, tailsFileName], "lastAccess": time.time(), "perChromosome": perChromosome,
+            "size": sum(os.path.getsize(self.getFilePath(fileName)) for fileName in (countsFileName, tailsFileName))
+        }
+        self.writeHeader()
+        self.evict(k)
+
+    def dropIfOversized(self, k):
+        """
+        Removes the histograms for the given k if they turned out to be larger than the index's maximum size.
+        (Entry sizes are estimated before counting, but the run tails can make them larger.)
+        """
+        if str(k) in self.header["entries"] and self.header["entries"][str(k)]["size"] > self.maxCacheSize:
+            print(f"{k}-mer counts are too large for the k-mer index. Removing them...")
+            self.invalidate(k)
+
+    def readEntry(self, k) -> np.ndarray:
+        """
+        Returns a memory map of the stored histograms for the given (cached) k, marking it as recently used.
+        """
+        entry = self.header["entries"][str(k)]
+        entry["lastAccess"] = time.time()
+        self.writeHeader()
+        return np.load(self.getFilePath(entry["files"][0]), mmap_mode = 'r')
+
+    def marginalize(self, counts: np.ndarray, cachedK, k) -> np.ndarray:
+        """
+        Derives k-mer counts from the given (chromosomes x 4^cachedK) or (1 x 4^cachedK) histograms for a longer
+        cachedK, returning an array with the same number of rows.
+        """
+        if cachedK == k: return counts
+        # Sum the longer k-mers down to their k-length prefixes, then add the k-mers within each run tail.
+        derivedCounts = counts.reshape(len(counts), 4**k, 4**(cachedK - k)).sum(axis = 2, dtype = np.int64)
+        with open(self.getFilePath(self.header["entries"][str(cachedK)]["files"][1]), 'r') as tailsFile:
+            tails = json.load(tailsFile)
+        for i, chromosome in enumerate(self.header["chromosomes"]):
+            countKmers(tails[chromosome].encode(), k, derivedCounts[i if len(derivedCounts) > 1 else 0])
+        return derivedCounts
+
+    def checkK(self, k):
+        if not 0 < k <= MAX_HISTOGRAM_K:
+            raise UserInputError(f"k-mer length must be between 1 and {MAX_HISTOGRAM_K}, but {k} was given.")
+
+    def getChromosomeCounts(self, k) -> np.ndarray:
+        """
+        Returns a (chromosomes x 4^k) array of k-mer counts, with rows ordered as in the fasta file. The counts are
+        derived from the smallest cached k no less than the given k that is stored per chromosome, or counted and
+        cached if there is no such k. Only available for k small enough to be stored per chromosome.
+        """
+        self.checkK(k)
+        if not self.isStoredPerChromosome(k):
+            raise UserInputError(f"Per-chromosome {k}-mer counts are too large for the k-mer index.")
+        cachedKs = [cachedK for cachedK in self.getCachedKs()
+                    if cachedK >= k and self.header["entries"][str(cachedK)].get("perChromosome", True)]
+        if not cachedKs:
+            self.countAndStore(k)
+            cachedKs = [k]
+        chromosomeCounts = np.array(self.marginalize(self.readEntry(cachedKs[0]), cachedKs[0], k))
+        self.dropIfOversized(k)
+        return chromosomeCounts
+
+    def getCounts(self, k) -> np.ndarray:
+        """
+        Returns the genome-wide count of every k-mer, indexed by k-mer code. The counts are derived from the smallest
+        cached k no less than the given k, or counted and cached if there is no such k. If the histograms would be
+        larger than the cache itself, they are counted without being cached.
+        """
+        self.checkK(k)
+        cachedKs = [cachedK for cachedK in self.getCachedKs() if cachedK >= k]
+        if not cachedKs:
+            if self.getEntrySize(k) > self.maxCacheSize:
+                print(f"{k}-mer counts are too large for the k-mer index. Counting without caching...")
+                genomeCounts = np.zeros(4**k, np.int64)
+                for counts, _ in self.countChromosomes(k): genomeCounts += counts
+                return genomeCounts
+            self.countAndStore(k)
+            cachedKs = [k]
+
+        # Summing the chromosomes first means only one row needs to be marginalized.
+        cachedCounts = self.readEntry(cachedKs[0]).sum(axis = 0, dtype = np.int64, keepdims = True)
+        self.dropIfOversized(k)
+        return self.marginalize(cachedCounts, cachedKs[0], k)[0]
+
+    def getSelectedCounts(self, kmers: List[str]) -> Dict[str, int]:
+        """
+        Returns the genome-wide count of each of the given k-mers, which must all be the same length.
+        """
+        kmerLengths = {len(kmer) for kmer in kmers}
+        if len(kmerLengths) != 1: raise UserInputError("Not all k-mers are of a uniform length.")
+        selectedCounts = self.getCounts(kmerLengths.pop())[[encodeKmer(kmer) for kmer in kmers]]
+        return {kmer: int(count) for kmer, count in zip(kmers, selectedCounts)}
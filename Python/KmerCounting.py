@@ -0,0 +1,151 @@
+# This script counts k-mers in DNA sequences using NumPy instead of slicing out and looking up every k-mer.
+# Each sequence is encoded with 2 bits per base (A=0, C=1, G=2, T=3), and the integer code for every k-mer is built
+# with k vectorized shift-and-OR passes over the encoded array. Windows containing any other character (e.g. N) are
+# excluded using a validity mask. For small k, every k-mer is counted at once with np.bincount into a histogram
+# indexed by k-mer code; for larger k, only the requested k-mers are counted.
+# Long sequences are processed in overlapping chunks to keep memory use bounded.
+# Histograms can also be collapsed so that each k-mer is counted together with its reverse complement.
+import numpy as np
+from typing import Iterable, Tuple
+from benbiohelpers.CustomErrors import UserInputError
+
+BASES = "ACGT"
+INVALID_BASE = 4
+
+# Maps byte values to 2-bit base codes, with INVALID_BASE for anything but an (upper or lower case) A, C, G, or T.
+BASE_ENCODING = np.full(256, INVALID_BASE, np.uint8)
+for baseCode, base in enumerate(BASES):
+    BASE_ENCODING[ord(base)] = baseCode
+    BASE_ENCODING[ord(base.lower())] = baseCode
+
+# The largest k for which a full histogram (4^k bins) is counted. (4^12 64-bit bins take 128 MB.)
+MAX_HISTOGRAM_K = 12
+
+# k-mer codes are built in 64-bit integers, which limits k.
+MAX_K = 32
+
+# The number of k-mers to encode at once.
+CHUNK_SIZE = 16*1024*1024
+
+
+# Returns the 2-bit code for the given k-mer.
+def encodeKmer(kmer: str) -> int:
+    kmerCode = 0
+    for base in kmer.upper():
+        if base not in BASES: raise UserInputError(f"Unable to encode {kmer}: only A, C, G, and T are allowed.")
+        kmerCode = kmerCode << 2 | BASES.index(base)
+    return kmerCode
+
+
+# Returns the k-mer for the given 2-bit code.
+def decodeKmer(kmerCode: int, k) -> str:
+    return ''.join(BASES[kmerCode >> 2*(k-1-i) & 3] for i in range(k))
+
+
+def checkK(k):
+    if not 0 < k <= MAX_K: raise UserInputError(f"k-mer length must be between 1 and {MAX_K}, but {k} was given.")
+
+
+# Yields (k-mer codes, validity mask) pairs for every window of length k in the given sequence, a chunk at a time.
+# (Every chunk but the last holds exactly chunkSize k-mers.)
+def getKmerCodes(sequence: bytes, k, chunkSize = CHUNK_SIZE) -> Iterable[Tuple[np.ndarray, np.ndarray]]:
+
+    checkK(k)
+    encodedSequence = BASE_ENCODING[np.frombuffer(sequence, np.uint8)]
+    kmerCount = len(encodedSequence) - k + 1
+
+    for chunkStart in range(0, max(kmerCount, 0), chunkSize):
+        chunkKmerCount = min(chunkSize, kmerCount - chunkStart)
+        encodedChunk = encodedSequence[chunkStart:chunkStart + chunkKmerCount + k - 1]
+
+        # A window is valid if it contains no invalid bases, which is checked with a running count of invalid bases.
+        invalidBases = np.concatenate(((0,), np.cumsum(encodedChunk == INVALID_BASE, dtype = np.int64)))
+        validKmers = invalidBases[k:] == invalidBases[:-k]
+
+        baseCodes = (encodedChunk & 3).astype(np.uint64)
+        kmerCodes = np.zeros(chunkKmerCount, np.uint64)
+        for i in range(k):
+            kmerCodes <<= np.uint64(2)
+            kmerCodes |= baseCodes[i:i + chunkKmerCount]
+
+        yield kmerCodes, validKmers
+
+
+# Returns a histogram of counts for every k-mer in the given sequence, indexed by k-mer code (see encodeKmer).
+# If a histogram is given, counts are added to it instead.
+def countKmers(sequence: bytes, k, histogram: np.ndarray = None) -> np.ndarray:
+
+    if k > MAX_HISTOGRAM_K:
+        raise UserInputError(f"Full k-mer histograms are limited to k <= {MAX_HISTOGRAM_K}, but {k} was given.")
+    if histogram is None: histogram = np.zeros(4**k, np.int64)
+
+    for kmerCodes, validKmers in getKmerCodes(sequence, k):
+        histogram += np.bincount(kmerCodes[validKmers].astype(np.int64), minlength = 4**k)
+    return histogram
+
+
+# Returns the counts for each of the given k-mer codes in the given sequence, without counting the full histogram.
+# If counts are given, they are added to instead.
+def countSelectedKmers(sequence: bytes, k, kmerCodes: Iterable[int], counts: np.ndarray = None) -> np.ndarray:
+
+    selectedCodes = np.array(list(kmerCodes), np.uint64)
+    if counts is None: counts = np.zeros(len(selectedCodes), np.int64)
+    sortOrder = np.argsort(selectedCodes)
+    sortedCodes = selectedCodes[sortOrder]
+
+    for chunkKmerCodes, validKmers in getKmerCodes(sequence, k):
+        chunkKmerCodes = chunkKmerCodes[validKmers]
+        positions = np.minimum(np.searchsorted(sortedCodes, chunkKmerCodes), len(sortedCodes) - 1)
+        matches = sortedCodes[positions] == chunkKmerCodes
+        counts[sortOrder] += np.bincount(positions[matches], minlength = len(sortedCodes))
+    return counts
+
+
+# Returns an array giving the code of each k-mer's reverse complement, indexed by k-mer code. (Complementing a base
+# code is the same as subtracting it from 3, so the bits are flipped and the 2-bit groups reversed.)
+def getReverseComplementCodes(k) -> np.ndarray:
+
+    complementCodes = np.arange(4**k, dtype = np.int64) ^ (4**k - 1)
+    reverseComplementCodes = np.zeros(4**k, np.int64)
+    for _ in range(k):
+        reverseComplementCodes = reverseComplementCodes << 2 | complementCodes & 3
+        complementCodes >>= 2
+    return reverseComplementCodes
+
+
+# Collapses the given k-mer histogram by adding each k-mer's count to its reverse complement's. Returns the codes of
+# the canonical k-mers (those whose codes are no greater than their reverse complements') and their collapsed counts.
+# Palindromic k-mers are only counted once.
+def collapseReverseComplements(histogram: np.ndarray, k) -> Tuple[np.ndarray, np.ndarray]:
+
+    kmerCodes = np.arange(4**k, dtype = np.int64)
+    reverseComplementCodes = getReverseComplementCodes(k)
+    canonicalCodes = kmerCodes[kmerCodes <= reverseComplementCodes]
+    collapsedCounts = histogram[canonicalCodes].copy()
+    isNotPalindrome = canonicalCodes != reverseComplementCodes[canonicalCodes]
+    collapsedCounts[isNotPalindrome] += histogram[reverseComplementCodes[canonicalCodes[isNotPalindrome]]]
+    return canonicalCodes, collapsedCounts
+
+
+# Counts occurrences of any of the given k-mer codes within consecutive windows of the given size along the sequence,
+# where each k-mer belongs to the window containing its first base. Returns the number of matches and the number of
+# valid k-mers (those with only A, C, G, and T) in each window. Windows are counted from a running (cumulative) sum of
+# match and validity indicators, a chunk of whole windows at a time.
+def countKmersInWindows(sequence: bytes, k, kmerCodes: Iterable[int], windowSize) -> Tuple[np.ndarray, np.ndarray]:
+
+    selectedCodes = np.array(sorted(set(kmerCodes)), np.uint64)
+    windowCount = -(-len(sequence) // windowSize)
+    matchCounts = np.zeros(windowCount, np.int64)
+    validCounts = np.zeros(windowCount, np.int64)
+
+    chunkSize = max(CHUNK_SIZE // windowSize, 1) * windowSize
+    for chunkIndex, (chunkKmerCodes, validKmers) in enumerate(getKmerCodes(sequence, k, chunkSize)):
+        isMatch = validKmers & np.isin(chunkKmerCodes, selectedCodes)
+        windowBoundaries = np.append(np.arange(0, len(chunkKmerCodes), windowSize), len(chunkKmerCodes))
+        firstWindow = chunkIndex * chunkSize // windowSize
+        chunkWindows = slice(firstWindow, firstWindow + len(windowBoundaries) - 1)
+        for windowedCounts, indicators in ((matchCounts, isMatch), (validCounts, validKmers)):
+            cumulativeCounts = np.concatenate(((0,), np.cumsum(indicators, dtype = np.int64)))
+            windowedCounts[chunkWindows] = np.diff(cumulativeCounts[windowBoundaries])
+
+    return matchCounts, validCounts
@@ -0,0 +1,114 @@
+# This script pairs up mates from paired-end data without requiring them to be adjacent to each other
+# (e.g. in coordinate-sorted files). Unmatched mates are held in a dictionary keyed on their read name stem until
+# their companion shows up. If too many mates are held at once, they are spilled to disk-backed partitions
+# (by read name stem), and each partition is paired separately once all the input has been seen.
+import os, pickle, shutil, tempfile, zlib
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+from benbiohelpers.CustomErrors import UserInputError
+
+DEFAULT_MAX_HELD_MATES = 5000000
+DEFAULT_SPILL_PARTITIONS = 64
+
+
+class MatePairer:
+    """
+    Pairs mates as they are added. getMateKey should return a (read name stem, mate number) tuple for a given mate.
+    If the mate number is None, mates are ordered by the order in which they were added. Otherwise, pairs are
+    returned ordered by mate number.
+    Once more than maxHeldMates unpaired mates are held in memory, all of them are written (pickled) to one of
+    spillPartitions partition files in a temporary directory within spillDirectory. Any pairs involving spilled mates
+    are returned by finish() instead of addMate(). Mates that never find a companion are counted in unpairedMates.
+    """
+
+    def __init__(self, getMateKey: Callable[[Any], Tuple[str, Optional[int]]], maxHeldMates = DEFAULT_MAX_HELD_MATES,
+                 spillDirectory = None, spillPartitions = DEFAULT_SPILL_PARTITIONS):
+        self.getMateKey = getMateKey
+        self.maxHeldMates = maxHeldMates
+        self.spillDirectory = spillDirectory
+        self.spillPartitions = spillPartitions
+        self.heldMates: Dict[str, Tuple[Optional[int], Any]] = dict()
+        self.partitionDirectory = None
+        self.unpairedMates = 0
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb): self.cleanUp()
+
+    def pairMates(self, stem, heldMateNumber, heldMate, mateNumber, mate) -> Tuple[Any, Any]:
+        """
+        Orders the two given mates, making sure they don't share a mate number.
+        """
+        if mateNumber is None: return (heldMate, mate)
+        if mateNumber == heldMateNumber:
+            raise UserInputError(f"Found multiple mates numbered {mateNumber} for read {stem}.")
+        if heldMateNumber < mateNumber: return (heldMate, mate)
+        else: return (mate, heldMate)
+
+    def addMate(self, mate) -> Optional[Tuple[Any, Any]]:
+        """
+        Adds the given mate, returning the completed pair if its companion is currently held in memory.
+        """
+        stem, mateNumber = self.getMateKey(mate)
+        if stem in self.heldMates:
+            heldMateNumber, heldMate = self.heldMates.pop(stem)
+            return self.pairMates(stem, heldMateNumber, heldMate, mateNumber, mate)
+
+        self.heldMates[stem] = (mateNumber, mate)
+        if len(self.heldMates) > self.maxHeldMates: self.spillHeldMates()
+        return None
+
+    def getPartitionFilePath(self, partition):
+        return os.path.join(self.partitionDirectory, f"partition_{partition}.pkl")
+
+    def spillHeldMates(self):
+        """
+        Appends all currently held mates to their partition files and clears them from memory.
+        """
+        if self.partitionDirectory is None:
+            if self.spillDirectory is not None: os.makedirs(self.spillDirectory, exist_ok = True)
+            self.partitionDirectory = tempfile.mkdtemp(prefix = "mate_pairing_", dir = self.spillDirectory)
+
+        partitionedMates = dict()
+        for stem, (mateNumber, mate) in self.heldMates.items():
+            partition = zlib.crc32(stem.encode()) % self.spillPartitions
+            partitionedMates.setdefault(partition, list()).append((stem, mateNumber, mate))
+        for partition, mates in partitionedMates.items():
+            with open(self.getPartitionFilePath(partition), 'ab') as partitionFile:
+                pickle.dump(mates, partitionFile, pickle.HIGHEST_PROTOCOL)
+        self.heldMates.clear()
+
+    def finish(self) -> Iterator[Tuple[Any, Any]]:
+        """
+        Yields all remaining pairs after the last mate has been added. If mates were spilled, the mates still in memory
+        are spilled as well, and each partition is then loaded and paired on its own.
+        """
+        if self.partitionDirectory is None:
+            self.unpairedMates += len(self.heldMates)
+            self.heldMates.clear()
+            return
+
+        if self.heldMates: self.spillHeldMates()
+        for partition in range(self.spillPartitions):
+            partitionFilePath = self.getPartitionFilePath(partition)
+            if not os.path.exists(partitionFilePath): continue
+
+            partitionMates: Dict[str, Tuple[Optional[int], Any]] = dict()
+            with open(partitionFilePath, 'rb') as partitionFile:
+                while True:
+                    try: mates = pickle.load(partitionFile)
+                    except EOFError: break
+                    for stem, mateNumber, mate in mates:
+                        if stem in partitionMates:
+                            heldMateNumber, heldMate = partitionMates.pop(stem)
+                            yield self.pairMates(stem, heldMateNumber, heldMate, mateNumber, mate)
+                        else: partitionMates[stem] = (mateNumber, mate)
+            self.unpairedMates += len(partitionMates)
+            os.remove(partitionFilePath)
+
+    def cleanUp(self):
+        """
+        Removes any spilled partition files.
+        """
+        if self.partitionDirectory is not None:
+            shutil.rmtree(self.partitionDirectory, ignore_errors = True)
+            self.partitionDirectory = None
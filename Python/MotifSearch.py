@@ -0,0 +1,139 @@
+# This script searches DNA sequences for any number of motifs at once using an Aho-Corasick automaton, so that motifs of
+# different lengths are all found in a single scan of each sequence. Motifs may contain IUPAC ambiguity codes, which
+# are expanded into every matching ACGT sequence when the automaton is built. Counting only tallies how many times
+# each automaton state is reached during the scan; these visits are then passed up the automaton's suffix links to
+# get the count for every motif, so the scan itself does no per-match work.
+import itertools
+import numpy as np
+from typing import Dict, Iterator, List, Tuple
+from benbiohelpers.CustomErrors import UserInputError
+
+IUPAC_CODES = {'A': "A", 'C': "C", 'G': "G", 'T': "T", 'U': "T", 'R': "AG", 'Y': "CT", 'S': "CG", 'W': "AT",
+               'K': "GT", 'M': "AC", 'B': "CGT", 'D': "AGT", 'H': "ACT", 'V': "ACG", 'N': "ACGT"}
+
+BASES = "ACGT"
+
+# Maps each byte to a base code (0-3 for A, C, G, and T in either case, 4 for anything else) for bytes.translate.
+BASE_TRANSLATION = bytes(BASES.index(chr(i).upper()) if chr(i).upper() in BASES else 4 for i in range(256))
+
+# The maximum number of sequences the motifs can expand to.
+MAX_EXPANDED_SEQUENCES = 1000000
+
+
+# Returns every ACGT sequence matched by the given motif (which may contain IUPAC ambiguity codes).
+def expandIUPACMotif(motif: str) -> List[str]:
+
+    expandedSequences = ['']
+    for code in motif.upper():
+        if code not in IUPAC_CODES: raise UserInputError(f"Unrecognized base \"{code}\" in motif {motif}.")
+        expandedSequences = [sequence + base for sequence in expandedSequences for base in IUPAC_CODES[code]]
+        if len(expandedSequences) > MAX_EXPANDED_SEQUENCES:
+            raise UserInputError(f"Motif {motif} expands to more than {MAX_EXPANDED_SEQUENCES} sequences.")
+    return expandedSequences
+
+
+class AhoCorasickAutomaton:
+    """
+    Finds all occurrences of the given motifs in a sequence with a single scan. Transitions are stored as a complete
+    table (one row of 5 next states per state, with the 5th column for non-ACGT bases, which return to the root), so
+    each base is a single table lookup. Motif counts and matches refer to motifs by their index in the given list.
+    """
+
+    def __init__(self, motifs: List[str]):
+
+        if len(motifs) == 0: raise UserInputError("No motifs given.")
+        self.motifs = motifs
+        self.motifLengths = [len(motif) for motif in motifs]
+
+        # Build a trie of the expanded sequences, recording which motifs end at each state.
+        children: List[Dict[int, int]] = [dict()]
+        self.stateMotifs: List[List[int]] = [list()]
+        expandedSequenceCount = 0
+        for motifIndex, motif in enumerate(motifs):
+            if not motif: raise UserInputError("Motifs cannot be empty.")
+            expandedSequences = expandIUPACMotif(motif)
+            expandedSequenceCount += len(expandedSequences)
+            if expandedSequenceCount > MAX_EXPANDED_SEQUENCES:
+                raise UserInputError(f"The given motifs expand to more than {MAX_EXPANDED_SEQUENCES} sequences.")
+            for sequence in expandedSequences:
+                state = 0
+                for base in sequence:
+                    baseCode = BASES.index(base)
+                    if baseCode not in children[state]:
+                        children[state][baseCode] = len(children)
+                        children.append(dict())
+                        self.stateMotifs.append(list())
+                    state = children[state][baseCode]
+                if motifIndex not in self.stateMotifs[state]: self.stateMotifs[state].append(motifIndex)
+
+        # Fill in the suffix links and the complete transition table breadth-first, so that each state's suffix link
+        # is finished before the state itself.
+        stateCount = len(children)
+        self.transitions = [0]*(stateCount*5)
+        self.suffixLinks = [0]*stateCount
+        self.breadthFirstOrder = [0]
+        for baseCode in range(4):
+            if baseCode in children[0]:
+                self.transitions[baseCode] = children[0][baseCode]
+                self.breadthFirstOrder.append(children[0][baseCode])
+
+        for state in itertools.islice(self.breadthFirstOrder, 1, None):
+            # Motifs ending at a state's suffix link also end at the state itself.
+            matchedMotifs = self.stateMotifs[state] + self.stateMotifs[self.suffixLinks[state]]
+            self.stateMotifs[state] = list(dict.fromkeys(matchedMotifs))
+            for baseCode in range(4):
+                fallbackState = self.transitions[self.suffixLinks[state]*5 + baseCode]
+                if baseCode in children[state]:
+                    child = children[state][baseCode]
+                    self.suffixLinks[child] = fallbackState
+                    self.transitions[state*5 + baseCode] = child
+                    self.breadthFirstOrder.append(child)
+                else: self.transitions[state*5 + baseCode] = fallbackState
+
+        # Note which states match any motif, so that scans for match positions only stop at those states.
+        self.hasMatches = [bool(matchedMotifs) for matchedMotifs in self.stateMotifs]
+
+    def scanStates(self, sequence: bytes) -> Iterator[Tuple[int, int]]:
+        """
+        Yields the (position, state) pair reached at each base of the given sequence that has any matches.
+        """
+        transitions = self.transitions
+        hasMatches = self.hasMatches
+        state = 0
+        for position, baseCode in enumerate(sequence.translate(BASE_TRANSLATION)):
+            state = transitions[state*5 + baseCode]
+            if hasMatches[state]: yield position, state
+
+    def countMatches(self, sequence: bytes) -> np.ndarray:
+        """
+        Returns the number of occurrences of each motif in the given sequence. Overlapping occurrences are counted.
+        """
+        transitions = self.transitions
+        stateVisits = [0]*len(self.suffixLinks)
+        state = 0
+        for baseCode in sequence.translate(BASE_TRANSLATION):
+            state = transitions[state*5 + baseCode]
+            stateVisits[state] += 1
+
+        # Every visit to a state is also a visit to the states along its suffix links. Passing visits up in reverse
+        # breadth-first order means each state's total is complete before it is added to its own suffix link.
+        for state in reversed(self.breadthFirstOrder[1:]):
+            stateVisits[self.suffixLinks[state]] += stateVisits[state]
+
+        # Only count states that are the end of an expanded sequence themselves; their suffix links (and the visits
+        # they were given) are counted separately, so that inherited matches aren't counted twice.
+        motifCounts = np.zeros(len(self.motifs), np.int64)
+        for state in range(1, len(self.suffixLinks)):
+            inheritedMotifs = self.stateMotifs[self.suffixLinks[state]]
+            for motifIndex in self.stateMotifs[state]:
+                if motifIndex not in inheritedMotifs: motifCounts[motifIndex] += stateVisits[state]
+        return motifCounts
+
+    def findMatches(self, sequence: bytes) -> Iterator[Tuple[int, int, int]]:
+        """
+        Yields (0-based start, end, motif index) for every occurrence of each motif in the given sequence, in order of
+        their end positions.
+        """
+        for position, state in self.scanStates(sequence):
+            for motifIndex in self.stateMotifs[state]:
+                yield position + 1 - self.motifLengths[motifIndex], position + 1, motifIndex
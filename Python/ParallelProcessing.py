@@ -0,0 +1,71 @@
+# This script contains helper functions for running file conversions in a pool of worker processes, either with
+# one task per input file or with a single bed file split up into one task per chromosome.
+import os, shutil, traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List
+from benbiohelpers.FileSystemHandling.DirectoryHandling import checkDirs
+
+# The buffer size used when concatenating files.
+COPY_BUFFER_SIZE = 16*1024*1024
+
+
+# Runs conversionFunction(filePath, *args) for each of the given file paths in a pool of the given number of worker
+# processes (or threads, if useThreads is true, e.g. for conversions that just wait on a subprocess). Results are
+# returned in the same order as the file paths. If the conversion of a file raises an exception, its traceback is
+# printed and its result is None, but the rest of the files are still processed.
+def mapFilesInPool(conversionFunction, filePaths: List[str], workers: int, *args, useThreads = False) -> List:
+
+    results = list()
+    with (ThreadPoolExecutor if useThreads else ProcessPoolExecutor)(max_workers = workers) as executor:
+        futures = [executor.submit(conversionFunction, filePath, *args) for filePath in filePaths]
+        for filePath, future in zip(filePaths, futures):
+            try:
+                results.append(future.result())
+            except Exception:
+                print(f"\nError encountered while processing {os.path.basename(filePath)}. Skipping.")
+                traceback.print_exc()
+                results.append(None)
+    return results
+
+
+# Splits the given bed file into one file per chromosome within the given directory, preserving the relative order
+# of all entries. Returns a dictionary of shard file paths keyed by chromosome, ordered by chromosome name.
+def splitBedByChromosome(bedFilePath, shardDirectory) -> Dict[str, str]:
+
+    checkDirs(shardDirectory)
+    basename = os.path.basename(bedFilePath).rsplit('.',1)[0]
+    shardFilePaths = dict()
+    shardFiles = dict()
+
+    try:
+        with open(bedFilePath, 'r') as bedFile:
+            for line in bedFile:
+                chromosome = line.split('\t', 1)[0]
+                if chromosome not in shardFiles:
+                    shardFilePaths[chromosome] = os.path.join(shardDirectory, f"{basename}_{chromosome}.bed")
+                    shardFiles[chromosome] = open(shardFilePaths[chromosome], 'w')
+                shardFiles[chromosome].write(line)
+    finally:
+        for shardFile in shardFiles.values(): shardFile.close()
+
+    return {chromosome: shardFilePaths[chromosome] for chromosome in sorted(shardFilePaths)}
+
+
+# Splits the given bed file by chromosome (see splitBedByChromosome) and runs conversionFunction(shardFilePath, *args)
+# on each shard in a pool of the given number of worker processes. Returns the shards' results in chromosome order.
+# Unlike mapFilesInPool, an exception in any shard is re-raised, since the results could not be merged.
+def mapChromosomeShardsInPool(conversionFunction, bedFilePath, shardDirectory, workers: int, *args) -> List:
+
+    shardFilePaths = list(splitBedByChromosome(bedFilePath, shardDirectory).values())
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(conversionFunction, shardFilePath, *args) for shardFilePath in shardFilePaths]
+        return [future.result() for future in futures]
+
+
+# Concatenates the given files, in order, into a single output file.
+def concatenateFiles(inputFilePaths: List[str], outputFilePath):
+
+    with open(outputFilePath, 'wb') as outputFile:
+        for inputFilePath in inputFilePaths:
+            with open(inputFilePath, 'rb') as inputFile:
+                shutil.copyfileobj(inputFile, outputFile, COPY_BUFFER_SIZE)
@@ -1,39 +1,84 @@
 from mutperiodpy.helper_scripts.UsefulFileSystemFunctions import getDataDirectory, getAcceptableChromosomes
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
-from typing import List
-import os
+from BedChromosomeRuns import rewriteBedChromosomes
+from GenomeIndex import getFastaStamp
+from typing import Dict, FrozenSet, List, Optional, Tuple
+import os, warnings
+
+ACCEPTABLE_CHROMOSOMES_EXTENSION = ".acceptable_chromosomes"
+
+
+# Reads the acceptable chromosomes saved next to the given genome file, returning None if there are none saved or
+# they were saved for a different version of the genome file (according to the stamp on the first line).
+def readCachedAcceptableChromosomes(genomeFilePath, stamp) -> Optional[FrozenSet[str]]:
+
+    cacheFilePath = genomeFilePath + ACCEPTABLE_CHROMOSOMES_EXTENSION
+    if not os.path.exists(cacheFilePath): return None
+
+    with open(cacheFilePath, 'r') as cacheFile:
+        if tuple(int(value) for value in cacheFile.readline().split()) != stamp: return None
+        return frozenset(line.rstrip('\n') for line in cacheFile)
+
+
+# Saves the acceptable chromosomes next to the genome file, warning (but continuing) if that isn't possible.
+def writeCachedAcceptableChromosomes(genomeFilePath, stamp, acceptableChromosomes: FrozenSet[str]):
+
+    cacheFilePath = genomeFilePath + ACCEPTABLE_CHROMOSOMES_EXTENSION
+    try:
+        with open(cacheFilePath + ".tmp", 'w') as cacheFile:
+            cacheFile.write(f"{stamp[0]}\t{stamp[1]}\n")
+            cacheFile.write(''.join(chromosome + '\n' for chromosome in sorted(acceptableChromosomes)))
+        os.replace(cacheFilePath + ".tmp", cacheFilePath)
+    except OSError as error:
+        warnings.warn(f"Unable to save the acceptable chromosomes for {os.path.basename(genomeFilePath)}: {error}")
+
+
+acceptableChromosomesCache: Dict[Tuple[str, int, int], FrozenSet[str]] = dict()
+
+# Returns the acceptable chromosomes for the given genome (see mutperiod's getAcceptableChromosomes) as a set, so that
+# each lookup is a hash check. Like the genome index (see GenomeIndex), the set is saved next to the genome file and
+# cached in memory, and both are reused for as long as the genome file's size and modification time are unchanged.
+def getAcceptableChromosomeSet(genomeFilePath) -> FrozenSet[str]:
+    stamp = getFastaStamp(genomeFilePath)
+    cacheKey = (os.path.abspath(genomeFilePath),) + stamp
+    if cacheKey not in acceptableChromosomesCache:
+        acceptableChromosomes = readCachedAcceptableChromosomes(genomeFilePath, stamp)
+        if acceptableChromosomes is None:
+            acceptableChromosomes = frozenset(getAcceptableChromosomes(genomeFilePath))
+            writeCachedAcceptableChromosomes(genomeFilePath, stamp, acceptableChromosomes)
+        acceptableChromosomesCache[cacheKey] = acceptableChromosomes
+    return acceptableChromosomesCache[cacheKey]
+
+
+# Returns a function that keeps acceptable chromosomes (as bytes) and drops the rest, letting the user know the first
+# time each invalid chromosome is found.
+def getChromosomeFilter(acceptableChromosomes):
+
+    def filterChromosome(chromosome: bytes):
+        if chromosome.decode() in acceptableChromosomes: return chromosome
+        print("Found invalid chromosome ", chromosome.decode(), ".  All associated entries will be removed.", sep = '')
+        return None
+
+    return filterChromosome
 
 
 # Takes a bed file and a genome file path and removes all entries with invalid chromosomes.
 def removeInvalidChromosomes(inputBedFilePaths: List[str], genomeFilePath, replaceOriginalFile):
 
     # Get the acceptable chromosomes
-    acceptableChromosomes = getAcceptableChromosomes(genomeFilePath)
+    acceptableChromosomes = getAcceptableChromosomeSet(genomeFilePath)
 
     for inputBedFilePath in inputBedFilePaths:
 
-        # Keep track of removed chromosomes to output this information to the user
-        invalidChromsomes = set()
-
         print("Working in",os.path.basename(inputBedFilePath))
 
         intermediateFilePath = inputBedFilePath.rsplit('.',1)[0] + "_valid_chromosomes.bed"
 
-        # Loop through the input file, copying every line with an acceptable chromosome to the new file.
-        # The first time an invalid chromosome is found, output it's name to the user.
-        with open(inputBedFilePath, 'r') as inputBedFile:
-            with open(intermediateFilePath, 'w') as intermediateFile:
-
-                for line in inputBedFile:
-
-                    chromosome = line.split()[0]
-
-                    if chromosome in acceptableChromosomes:
-                        intermediateFile.write(line)
-
-                    elif chromosome not in invalidChromsomes:
-                        invalidChromsomes.add(chromosome)
-                        print("Found invalid chromosome ", chromosome, ".  All associated entries will be removed.", sep = '')
+        # Copy every line with an acceptable chromosome to the new file, a whole run of lines at a time.
+        # The first time an invalid chromosome is found, output its name to the user.
+        with open(inputBedFilePath, 'rb') as inputBedFile:
+            with open(intermediateFilePath, 'wb') as intermediateFile:
+                rewriteBedChromosomes(inputBedFile, intermediateFile, getChromosomeFilter(acceptableChromosomes))
 
         # If requested, replace the original file.
         if replaceOriginalFile:
@@ -0,0 +1,134 @@
+# This script caches the sequences fetched from a genome (see TwoBitGenome), so that intervals repeated across bed
+# files (e.g. replicates) only need to be read from the genome once. Sequences are kept in an in-memory LRU cache,
+# bounded by its estimated size in bytes, and can also be saved to a persistent SQLite database so that they
+# carry over between runs. Cached sequences are keyed by interval and by the genome's identity, which is derived from
+# the genome file's size, modification time, and chromosome sizes, so a changed genome never returns stale sequences.
+import os, sys, json, sqlite3, hashlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+from TwoBitGenome import TwoBitGenome, getTwoBitGenome
+from GenomeIndex import getFastaStamp
+
+# The default maximum size of a sequence cache's in-memory LRU cache, in bytes.
+DEFAULT_MAX_CACHE_BYTES = 256*1024*1024
+
+# The estimated memory used by each cached sequence on top of its bases (for its key, string object, and place in the
+# cache), in bytes. This dominates for short intervals like reads, so it's counted towards the cache size.
+ENTRY_OVERHEAD_BYTES = 384
+
+# How long to wait for other processes writing to the same persistent cache, in seconds.
+DATABASE_TIMEOUT = 60
+
+
+# Returns a hash identifying the given genome file's current contents.
+def getGenomeIdentity(genomeFilePath, twoBitGenome: TwoBitGenome) -> str:
+    chromSizes = [(chromosome, twoBitGenome.getLength(chromosome)) for chromosome in twoBitGenome.getChromosomes()]
+    return hashlib.sha1(json.dumps([getFastaStamp(genomeFilePath), chromSizes]).encode()).hexdigest()
+
+
+class SequenceCache:
+    """
+    Fetches sequences from the given genome file through an in-memory LRU cache using up to about maxCacheBytes bytes,
+    backed by a persistent SQLite cache if databaseFilePath is given. Use getSequenceCache to get a (cached) instance.
+    """
+
+    def __init__(self, genomeFilePath, maxCacheBytes = DEFAULT_MAX_CACHE_BYTES, databaseFilePath = None):
+
+        self.twoBitGenome = getTwoBitGenome(genomeFilePath)
+        self.genomeIdentity = getGenomeIdentity(genomeFilePath, self.twoBitGenome)
+        self.maxCacheBytes = maxCacheBytes
+        self.cachedSequences: OrderedDict[Tuple[str, int, int, bool], str] = OrderedDict()
+        self.cacheBytes = 0
+        self.hits, self.misses = 0, 0
+
+        self.database = None
+        if databaseFilePath is not None:
+            self.database = sqlite3.connect(databaseFilePath, timeout = DATABASE_TIMEOUT)
+            self.database.execute("PRAGMA journal_mode=WAL")
+            self.database.execute("CREATE TABLE IF NOT EXISTS sequences (genome TEXT, chromosome TEXT, "
+                                  "start INTEGER, end INTEGER, minus INTEGER, sequence TEXT, "
+                                  "PRIMARY KEY (genome, chromosome, start, end, minus))")
+            self.database.commit()
+
+    def cacheSequence(self, key: Tuple[str, int, int, bool], sequence: str):
+        """
+        Adds the given sequence to the in-memory cache, evicting the least recently used sequences as necessary.
+        """
+        if key in self.cachedSequences: return
+        self.cachedSequences[key] = sequence
+        self.cacheBytes += len(sequence) + ENTRY_OVERHEAD_BYTES
+        self.trimCache()
+
+    def trimCache(self):
+        """
+        Evicts the least recently used sequences until the in-memory cache is within its size limit.
+        """
+        while self.cacheBytes > self.maxCacheBytes and self.cachedSequences:
+            self.cacheBytes -= len(self.cachedSequences.popitem(last = False)[1]) + ENTRY_OVERHEAD_BYTES
+
+    def readFromDatabase(self, keys: List[Tuple[str, int, int, bool]]) -> Dict[Tuple[str, int, int, bool], str]:
+        """
+        Returns the sequences for any of the given keys found in the persistent cache.
+        """
+        foundSequences = dict()
+        for key in keys:
+            row = self.database.execute("SELECT sequence FROM sequences WHERE genome = ? AND chromosome = ? AND "
+                                        "start = ? AND end = ? AND minus = ?", (self.genomeIdentity, *key)).fetchone()
+            if row is not None: foundSequences[key] = row[0]
+        return foundSequences
+
+    def fetchBatch(self, chromosomes: Iterable[str], starts: Iterable[int], ends: Iterable[int],
+                   strands: Iterable[str] = None) -> List[str]:
+        """
+        Returns the (soft-masked) sequences for the given arrays of intervals, in the order given, as in
+        TwoBitGenome.fetchBatch. Only intervals missing from both caches are read from the genome.
+        """
+        chromosomes = list(chromosomes)
+        if strands is None: strands = [None]*len(chromosomes)
+        keys = [(sys.intern(chromosome), int(start), int(end), strand == '-')
+                for chromosome, start, end, strand in zip(chromosomes, starts, ends, strands)]
+
+        sequences: Dict[Tuple[str, int, int, bool], str] = dict()
+        for key in dict.fromkeys(keys):
+            if key in self.cachedSequences:
+                self.cachedSequences.move_to_end(key)
+                sequences[key] = self.cachedSequences[key]
+        missingKeys = [key for key in dict.fromkeys(keys) if key not in sequences]
+
+        if self.database is not None and missingKeys:
+            sequences.update(self.readFromDatabase(missingKeys))
+            for key in missingKeys:
+                if key in sequences: self.cacheSequence(key, sequences[key])
+        fetchedKeys = [key for key in missingKeys if key not in sequences]
+
+        if fetchedKeys:
+            fetchedSequences = self.twoBitGenome.fetchBatch(*zip(*((chromosome, start, end, '-' if minus else '+')
+                                                                   for chromosome, start, end, minus in fetchedKeys)))
+            for key, sequence in zip(fetchedKeys, fetchedSequences):
+                sequences[key] = sequence
+                self.cacheSequence(key, sequence)
+            if self.database is not None:
+                self.database.executemany("INSERT OR IGNORE INTO sequences VALUES (?, ?, ?, ?, ?, ?)",
+                                          [(self.genomeIdentity, *key, sequence)
+                                           for key, sequence in zip(fetchedKeys, fetchedSequences)])
+                self.database.commit()
+
+        self.misses += len(fetchedKeys)
+        self.hits += len(keys) - len(fetchedKeys)
+        return [sequences[key] for key in keys]
+
+
+sequenceCacheCache: Dict[Tuple[str, str], SequenceCache] = dict()
+
+# Returns the sequence cache for the given genome file (and persistent cache file, if any), creating it the first
+# time it's requested in this process so that it's shared by every file the process converts.
+# The cache's in-memory size limit is set to maxCacheBytes.
+def getSequenceCache(genomeFilePath, databaseFilePath = None, maxCacheBytes = DEFAULT_MAX_CACHE_BYTES) -> SequenceCache:
+    cacheKey = (os.path.abspath(genomeFilePath), databaseFilePath and os.path.abspath(databaseFilePath))
+    if cacheKey not in sequenceCacheCache or (sequenceCacheCache[cacheKey].genomeIdentity !=
+                                              getGenomeIdentity(genomeFilePath, getTwoBitGenome(genomeFilePath))):
+        sequenceCacheCache[cacheKey] = SequenceCache(genomeFilePath, maxCacheBytes, databaseFilePath)
+    else:
+        sequenceCacheCache[cacheKey].maxCacheBytes = maxCacheBytes
+        sequenceCacheCache[cacheKey].trimCache()
+    return sequenceCacheCache[cacheKey]
@@ -0,0 +1,324 @@
+# This script converts genome fasta files to UCSC's .2bit format and reads sequences back out of them through a
+# memory map, so that any number of scripts (and worker processes) can fetch intervals from one shared, compact copy
+# of the genome instead of each reading the fasta or calling out to bedtools.
+# A .2bit file packs 4 bases into each byte (T=0, C=1, A=2, G=3), with runs of N's (any base other than A, C, G, or T)
+# and runs of lower case (soft-masked) bases stored as blocks alongside each sequence. The file is written next to
+# the fasta the first time it's needed, along with a stamp file recording the fasta's size and modification time, and
+# is rebuilt whenever the stamp no longer matches. If it can't be written, the .2bit data is kept in memory instead.
+import os, io, mmap, struct, warnings
+import numpy as np
+from typing import Dict, Iterable, List, Tuple
+from benbiohelpers.CustomErrors import UserInputError
+from GenomeIndex import getGenomeIndex, getFastaStamp
+
+TWO_BIT_EXTENSION = ".2bit"
+TWO_BIT_STAMP_EXTENSION = ".2bit.stamp"
+TWO_BIT_SIGNATURE = 0x1A412743
+
+# Maps byte values to .2bit base codes. Anything but an (upper or lower case) A, C, G, or T is stored as an N block.
+TWO_BIT_BASES = b"TCAG"
+NON_BASE = 4
+TWO_BIT_ENCODING = np.full(256, NON_BASE, np.uint8)
+for baseCode, base in enumerate(TWO_BIT_BASES):
+    TWO_BIT_ENCODING[base] = baseCode
+    TWO_BIT_ENCODING[ord(chr(base).lower())] = baseCode
+
+# Maps each packed byte to its 4 bases.
+UNPACKED_BASES = np.frombuffer(TWO_BIT_BASES, np.uint8)[(np.arange(256)[:, None] >> np.array((6, 4, 2, 0))) & 3]
+
+COMPLEMENT = bytes.maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+
+# The maximum number of bases gathered at once when fetching batches of intervals.
+BATCH_SIZE = 16*1024*1024
+
+
+# Returns the (start, size) pairs of every run of True values in the given boolean array.
+def getRuns(isInRun: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    runBoundaries = np.flatnonzero(np.diff(np.concatenate(((False,), isInRun, (False,))).astype(np.int8)))
+    return runBoundaries[::2], runBoundaries[1::2] - runBoundaries[::2]
+
+
+# Writes the .2bit record for a single sequence to the given file.
+def writeTwoBitRecord(twoBitFile, sequence: bytes):
+
+    sequenceArray = np.frombuffer(sequence, np.uint8)
+    baseCodes = TWO_BIT_ENCODING[sequenceArray]
+    nBlockStarts, nBlockSizes = getRuns(baseCodes == NON_BASE)
+    maskBlockStarts, maskBlockSizes = getRuns((sequenceArray >= ord('a')) & (sequenceArray <= ord('z')))
+
+    # N's are packed as T's (0), and the last byte is padded out with them.
+    baseCodes[baseCodes == NON_BASE] = 0
+    baseCodes = np.concatenate((baseCodes, np.zeros(-len(baseCodes) % 4, np.uint8)))
+    packedBases = baseCodes[0::4] << 6 | baseCodes[1::4] << 4 | baseCodes[2::4] << 2 | baseCodes[3::4]
+
+    twoBitFile.write(struct.pack("<II", len(sequence), len(nBlockStarts)))
+    twoBitFile.write(nBlockStarts.astype("<u4").tobytes() + nBlockSizes.astype("<u4").tobytes())
+    twoBitFile.write(struct.pack("<I", len(maskBlockStarts)))
+    twoBitFile.write(maskBlockStarts.astype("<u4").tobytes() + maskBlockSizes.astype("<u4").tobytes())
+    twoBitFile.write(struct.pack("<I", 0))
+    twoBitFile.write(packedBases.tobytes())
+
+
+# Converts the given fasta file to .2bit format, writing it to the given (seekable) binary file one sequence at a time.
+def writeTwoBitFile(fastaFilePath, twoBitFile):
+
+    genomeIndex = getGenomeIndex(fastaFilePath)
+    names = [chromosome.encode() for chromosome in genomeIndex.getChromosomes()]
+    for name in names:
+        if len(name) > 255: raise UserInputError(f"Sequence name {name.decode()} is too long for the .2bit format.")
+
+    # Each sequence's offset is only known once the sequences before it are written, so the index is written with
+    # placeholder offsets and filled in afterwards.
+    indexStart = 16
+    twoBitFile.write(struct.pack("<IIII", TWO_BIT_SIGNATURE, 0, len(names), 0))
+    twoBitFile.write(b''.join(struct.pack("<B", len(name)) + name + struct.pack("<I", 0) for name in names))
+
+    offsets = list()
+    for chromosome in genomeIndex.getChromosomes():
+        offsets.append(twoBitFile.tell())
+        if offsets[-1] >= 2**32:
+            raise UserInputError(f"{os.path.basename(fastaFilePath)} is too large for the .2bit format.")
+        writeTwoBitRecord(twoBitFile, genomeIndex.readSequenceBytes(chromosome))
+
+    twoBitFile.seek(indexStart)
+    twoBitFile.write(b''.join(struct.pack("<B", len(name)) + name + struct.pack("<I", offset)
+                              for name, offset in zip(names, offsets)))
+
+
+class TwoBitRecord:
+    """
+    The location of a single sequence's packed bases within a .2bit file, along with its N and mask blocks (as arrays
+    of 0-based, half-open block starts and ends).
+    """
+
+    __slots__ = ("length", "basesOffset", "nBlockStarts", "nBlockEnds", "maskBlockStarts", "maskBlockEnds")
+
+    def __init__(self, data: np.ndarray, offset, byteOrder):
+
+        uint32 = np.dtype(byteOrder + "u4")
+        self.length, nBlockCount = data[offset:offset + 8].view(uint32).tolist()
+        offset += 8
+        nBlocks = data[offset:offset + 8*nBlockCount].view(uint32).astype(np.int64)
+        self.nBlockStarts, self.nBlockEnds = nBlocks[:nBlockCount], nBlocks[:nBlockCount] + nBlocks[nBlockCount:]
+        offset += 8*nBlockCount
+        maskBlockCount = int(data[offset:offset + 4].view(uint32)[0])
+        offset += 4
+        maskBlocks = data[offset:offset + 8*maskBlockCount].view(uint32).astype(np.int64)
+        self.maskBlockStarts = maskBlocks[:maskBlockCount]
+        self.maskBlockEnds = maskBlocks[:maskBlockCount] + maskBlocks[maskBlockCount:]
+        self.basesOffset = offset + 8*maskBlockCount + 4
+
+
+# Returns a boolean array indicating which of the bases in [start, end) fall within any of the given blocks.
+def getBlockCoverage(blockStarts: np.ndarray, blockEnds: np.ndarray, start, end) -> np.ndarray:
+
+    firstBlock = np.searchsorted(blockEnds, start, "right")
+    lastBlock = np.searchsorted(blockStarts, end, "left")
+    coverageChanges = np.zeros(end - start + 1, np.int32)
+    np.add.at(coverageChanges, np.maximum(blockStarts[firstBlock:lastBlock], start) - start, 1)
+    np.add.at(coverageChanges, np.minimum(blockEnds[firstBlock:lastBlock], end) - start, -1)
+    return np.cumsum(coverageChanges[:-1]) > 0
+
+
+# Returns a boolean array indicating which of the given positions fall within any of the given blocks.
+def getPositionsInBlocks(blockStarts: np.ndarray, blockEnds: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    if len(blockStarts) == 0: return np.zeros(len(positions), bool)
+    blockIndices = np.searchsorted(blockStarts, positions, "right") - 1
+    return (blockIndices >= 0) & (positions < blockEnds[np.maximum(blockIndices, 0)])
+
+
+class TwoBitGenome:
+    """
+    Fetches sequences from a memory-mapped .2bit file (or from .2bit data already in memory, if given).
+    Use getTwoBitGenome to get a (cached) instance for a genome fasta file. Sequences are returned as they appear in
+    the fasta (with soft-masked bases in lower case) unless softMask is false, in which case they are all upper case.
+    """
+
+    def __init__(self, twoBitFilePath, data = None):
+
+        self.twoBitFilePath = twoBitFilePath
+        if data is None:
+            with open(twoBitFilePath, 'rb') as twoBitFile:
+                data = mmap.mmap(twoBitFile.fileno(), 0, access = mmap.ACCESS_READ)
+        self.data = np.frombuffer(data, np.uint8)
+
+        # The signature also gives the file's byte order.
+        if int(self.data[:4].view("<u4")[0]) == TWO_BIT_SIGNATURE: self.byteOrder = '<'
+        elif int(self.data[:4].view(">u4")[0]) == TWO_BIT_SIGNATURE: self.byteOrder = '>'
+        else: raise UserInputError(f"{os.path.basename(twoBitFilePath)} is not a .2bit file.")
+        version, sequenceCount = self.data[4:12].view(self.byteOrder + "u4").tolist()
+        offsetType = self.byteOrder + ("u8" if version == 1 else "u4")
+
+        # Read the index, but leave each sequence's record to be read the first time it's needed.
+        self.offsets: Dict[str, int] = dict()
+        position = 16
+        for _ in range(sequenceCount):
+            nameSize = int(self.data[position])
+            name = self.data[position + 1:position + 1 + nameSize].tobytes().decode()
+            position += 1 + nameSize
+            self.offsets[name] = int(self.data[position:position + np.dtype(offsetType).itemsize].view(offsetType)[0])
+            position += np.dtype(offsetType).itemsize
+        self.records: Dict[str, TwoBitRecord] = dict()
+
+    def __contains__(self, chromosome): return chromosome in self.offsets
+
+    def getChromosomes(self) -> List[str]:
+        """
+        Returns the chromosome names in the order they appear in the .2bit file.
+        """
+        return list(self.offsets)
+
+    def getRecord(self, chromosome) -> TwoBitRecord:
+        if chromosome not in self.records:
+            if chromosome not in self.offsets:
+                raise UserInputError(f"Chromosome {chromosome} not found in {os.path.basename(self.twoBitFilePath)}.")
+            self.records[chromosome] = TwoBitRecord(self.data, self.offsets[chromosome], self.byteOrder)
+        return self.records[chromosome]
+
+    def getLength(self, chromosome) -> int: return self.getRecord(chromosome).length
+
+    def fetchBytes(self, chromosome, start = 0, end = None, strand = '+', softMask = True) -> bytes:
+        """
+        Returns the bases in the 0-based, half-open region [start, end) of the given chromosome (the whole chromosome
+        by default), reverse complemented if the strand is '-'.
+        """
+        record = self.getRecord(chromosome)
+        if end is None: end = record.length
+        if not 0 <= start <= end <= record.length:
+            raise UserInputError(f"Region {chromosome}:{start}-{end} is outside of the chromosome's bounds "
+                                 f"(0-{record.length}).")
+
+        packedBases = self.data[record.basesOffset + start//4:record.basesOffset + (end + 3)//4]
+        bases = UNPACKED_BASES[packedBases].reshape(-1)[start % 4:start % 4 + end - start]
+        bases[getBlockCoverage(record.nBlockStarts, record.nBlockEnds, start, end)] = ord('N')
+        if softMask: bases[getBlockCoverage(record.maskBlockStarts, record.maskBlockEnds, start, end)] |= 0x20
+
+        if strand == '-': return bases.tobytes().translate(COMPLEMENT)[::-1]
+        else: return bases.tobytes()
+
+    def fetch(self, chromosome, start = 0, end = None, strand = '+', softMask = True) -> str:
+        """
+        Returns the bases in the 0-based, half-open region [start, end) of the given chromosome as a string.
+        (See fetchBytes.)
+        """
+        return self.fetchBytes(chromosome, start, end, strand, softMask).decode()
+
+    def fetchBatch(self, chromosomes: Iterable[str], starts: Iterable[int], ends: Iterable[int],
+                   strands: Iterable[str] = None, softMask = True) -> List[str]:
+        """
+        Returns the sequences for the given arrays of intervals (as in fetch), in the order given. Bases are gathered
+        for many intervals on the same chromosome at once, rather than unpacking each interval separately.
+        """
+        chromosomes = np.asarray(chromosomes)
+        starts, ends = np.asarray(starts, np.int64), np.asarray(ends, np.int64)
+        sequences: List[str] = [None]*len(chromosomes)
+
+        for chromosome in dict.fromkeys(chromosomes.tolist()):
+            record = self.getRecord(chromosome)
+            intervalIndices = np.flatnonzero(chromosomes == chromosome)
+            badIntervals = (starts[intervalIndices] < 0) | (starts[intervalIndices] > ends[intervalIndices]) | \
+                           (ends[intervalIndices] > record.length)
+            if badIntervals.any():
+                badInterval = intervalIndices[np.argmax(badIntervals)]
+                raise UserInputError(f"Region {chromosome}:{starts[badInterval]}-{ends[badInterval]} is outside of "
+                                     f"the chromosome's bounds (0-{record.length}).")
+
+            # Intervals larger than BATCH_SIZE are fetched on their own. The rest are split into groups of about
+            # BATCH_SIZE bases.
+            lengths = ends[intervalIndices] - starts[intervalIndices]
+            for intervalIndex in intervalIndices[lengths > BATCH_SIZE].tolist():
+                sequences[intervalIndex] = self.fetch(chromosome, int(starts[intervalIndex]), int(ends[intervalIndex]),
+                                                      strands[intervalIndex] if strands is not None else '+', softMask)
+            intervalIndices, lengths = intervalIndices[lengths <= BATCH_SIZE], lengths[lengths <= BATCH_SIZE]
+            groupNumbers = np.cumsum(lengths) // BATCH_SIZE
+            for groupNumber in np.unique(groupNumbers).tolist():
+                groupIndices = intervalIndices[groupNumbers == groupNumber]
+                groupStarts, groupLengths = starts[groupIndices], ends[groupIndices] - starts[groupIndices]
+                intervalOffsets = np.concatenate(((0,), np.cumsum(groupLengths)))
+                positions = np.arange(intervalOffsets[-1]) + np.repeat(groupStarts - intervalOffsets[:-1], groupLengths)
+
+                packedBases = self.data[record.basesOffset + positions//4]
+                bases = np.frombuffer(TWO_BIT_BASES, np.uint8)[packedBases >> (6 - 2*(positions % 4)) & 3]
+                bases[getPositionsInBlocks(record.nBlockStarts, record.nBlockEnds, positions)] = ord('N')
+                if softMask:
+                    bases[getPositionsInBlocks(record.maskBlockStarts, record.maskBlockEnds, positions)] |= 0x20
+
+                groupBases = bases.tobytes()
+                for i, intervalIndex in enumerate(groupIndices.tolist()):
+                    sequence = groupBases[intervalOffsets[i]:intervalOffsets[i + 1]]
+                    if strands is not None and strands[intervalIndex] == '-':
+                        sequence = sequence.translate(COMPLEMENT)[::-1]
+                    sequences[intervalIndex] = sequence.decode()
+
+        return sequences
+
+
+twoBitGenomeCache: Dict[Tuple[str, int, int], TwoBitGenome] = dict()
+
+# Returns the memory-mapped .2bit genome for the given genome file, which may be a .2bit file itself or a fasta file.
+# For fasta files, the .2bit file next to the fasta is used, and created (or rebuilt) if it's missing or out of date.
+# If it can't be written, the .2bit data is built in memory instead.
+def getTwoBitGenome(genomeFilePath) -> TwoBitGenome:
+
+    stamp = getFastaStamp(genomeFilePath)
+    cacheKey = (os.path.abspath(genomeFilePath),) + stamp
+    if cacheKey in twoBitGenomeCache: return twoBitGenomeCache[cacheKey]
+
+    if genomeFilePath.endswith(TWO_BIT_EXTENSION):
+        twoBitGenomeCache[cacheKey] = TwoBitGenome(genomeFilePath)
+        return twoBitGenomeCache[cacheKey]
+
+    twoBitFilePath, stampFilePath = genomeFilePath + TWO_BIT_EXTENSION, genomeFilePath + TWO_BIT_STAMP_EXTENSION
+    isCurrent = False
+    if os.path.exists(twoBitFilePath) and os.path.exists(stampFilePath):
+        with open(stampFilePath, 'r') as stampFile:
+            isCurrent = tuple(int(value) for value in stampFile.read().split()) == stamp
+
+    if isCurrent: twoBitGenome = TwoBitGenome(twoBitFilePath)
+    else:
+        print(f"Converting {os.path.basename(genomeFilePath)} to .2bit format...")
+        try:
+            with open(twoBitFilePath + ".tmp", 'wb') as twoBitFile: writeTwoBitFile(genomeFilePath, twoBitFile)
+            os.replace(twoBitFilePath + ".tmp", twoBitFilePath)
+            with open(stampFilePath, 'w') as stampFile: stampFile.write(f"{stamp[0]}\t{stamp[1]}\n")
+            twoBitGenome = TwoBitGenome(twoBitFilePath)
+        except OSError as error:
+            warnings.warn(f"Unable to save the .2bit file for {os.path.basename(genomeFilePath)}: {error} "
+                          "Keeping it in memory instead.")
+            twoBitBuffer = io.BytesIO()
+            writeTwoBitFile(genomeFilePath, twoBitBuffer)
+            twoBitGenome = TwoBitGenome(twoBitFilePath, twoBitBuffer.getbuffer())
+
+    twoBitGenomeCache[cacheKey] = twoBitGenome
+    return twoBitGenome
+
+
+# Writes the sequence for every interval in the given bed file to a fasta file, with headers of the form
+# ">chromosome:start-end(strand)" (or without the strand if includeStrand is false or the bed file has no strand
+# column), as given by "bedtools getfasta". Intervals on the '-' strand are reverse complemented if includeStrand
+# is true. If a sequence cache is given (see SequenceCache), sequences are fetched through it. Returns the number of
+# sequences written.
+def writeBedSequencesToFasta(bedFilePath, genomeFilePath, fastaOutputFilePath, includeStrand = True,
+                             sequenceCache = None) -> int:
+
+    sequenceSource = getTwoBitGenome(genomeFilePath) if sequenceCache is None else sequenceCache
+    sequenceCount = 0
+    with open(bedFilePath, 'r') as bedFile, open(fastaOutputFilePath, 'w') as fastaOutputFile:
+        for lines in iter(lambda: bedFile.readlines(BATCH_SIZE), []):
+            choppedUpLines = [line.split('\t') for line in lines
+                              if line.strip() and not line.startswith(("#", "track", "browser"))]
+
+            chromosomes = [choppedUpLine[0] for choppedUpLine in choppedUpLines]
+            starts = [int(choppedUpLine[1]) for choppedUpLine in choppedUpLines]
+            ends = [int(choppedUpLine[2]) for choppedUpLine in choppedUpLines]
+            strands = [choppedUpLine[5].strip() if includeStrand and len(choppedUpLine) > 5 else None
+                       for choppedUpLine in choppedUpLines]
+            sequences = sequenceSource.fetchBatch(chromosomes, starts, ends, strands)
+            sequenceCount += len(sequences)
+
+            fastaOutputFile.write(''.join(
+                f">{chromosome}:{start}-{end}" + (f"({strand})" if strand is not None else "") + f"\n{sequence}\n"
+                for chromosome, start, end, strand, sequence in zip(chromosomes, starts, ends, strands, sequences)
+            ))
+
+    return sequenceCount
@@ -1,12 +1,183 @@
 # This script takes a bed file that is the result of the wig2bed operation and converts it to the bed format expected by mutperiod.
-import math, os
+# Alternatively, the (base-adjusted) counts can be written to a binary coverage store (see CoverageStore), or to a
+# weighted custom bed file, which contains each interval once with its count in a 7th column instead of repeating it.
+# The input is only read once: records are buffered in a temporary binary file while the base value is found.
+import math, os, tempfile, weakref
+import numpy as np
 from mutperiodpy.helper_scripts.UsefulFileSystemFunctions import DataTypeStr, getDataDirectory
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
 from benbiohelpers.FileSystemHandling.DirectoryHandling import checkDirs
-from typing import List
-
-
-def wigBedToCustomBed(wigBedFilePaths: List[str], outputToIntermediateDirectory = False, strandDesignation = '.'):
+from benbiohelpers.CustomErrors import UserInputError
+from CoverageStore import CoverageStoreWriter, parseChromSizes
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+CUSTOM_BED = "Custom bed"
+BINARY_COVERAGE = "Binary coverage store"
+WEIGHTED_BED = "Weighted custom bed"
+
+# The layout of buffered records, and the number of records buffered (or replayed) at a time.
+RECORD_DTYPE = np.dtype([("chromosome", np.uint32), ("start", np.int64), ("end", np.int64), ("value", np.float64)])
+RECORD_BUFFER_SIZE = 1000000
+
+
+# Yields (chromosome, start, end, value) records from the given wig-bed lines.
+def parseWigBedLines(lines: Iterable[str]) -> Iterator[Tuple[str, int, int, float]]:
+    for line in lines:
+        chromosome, startPos, endPos, _, counts = line.split()
+        yield chromosome, int(startPos), int(endPos), float(counts)
+
+
+# Yields (chromosome, start, end, value) records from the given wig-bed file.
+def readWigBedRecords(wigBedFilePath) -> Iterator[Tuple[str, int, int, float]]:
+    with open(wigBedFilePath, 'r') as wigBedFile:
+        yield from parseWigBedLines(wigBedFile)
+
+
+# Returns the custom bed file path (or coverage store directory, for BINARY_COVERAGE output) for the given input file,
+# making sure the outputToIntermediateDirectory parameter is satisfied.
+def getCustomBedFilePath(inputFilePath, outputToIntermediateDirectory = False, outputFormat = CUSTOM_BED):
+
+    customBedFileName = os.path.basename(inputFilePath.rsplit('.',1)[0] + '_')
+    if customBedFileName.endswith("from_wig_"): customBedFileName = customBedFileName.rsplit("from_wig_",1)[0]
+    customBedFileName += DataTypeStr.customInput + ".bed"
+
+    if outputToIntermediateDirectory and not os.path.dirname(inputFilePath).endswith("intermediate_files"):
+        checkDirs(os.path.join(os.path.dirname(inputFilePath), "intermediate_files"))
+        customBedFilePath = os.path.join(os.path.dirname(inputFilePath), "intermediate_files", customBedFileName)
+    elif outputToIntermediateDirectory or not os.path.dirname(inputFilePath).endswith("intermediate_files"):
+        customBedFilePath = os.path.join(os.path.dirname(inputFilePath), customBedFileName)
+    else:
+        customBedFilePath = os.path.join(os.path.dirname(os.path.dirname(inputFilePath)), customBedFileName)
+    if outputFormat == BINARY_COVERAGE: customBedFilePath = customBedFilePath.rsplit(".bed",1)[0] + "_coverage"
+    elif outputFormat == WEIGHTED_BED: customBedFilePath = customBedFilePath.rsplit(".bed",1)[0] + "_weighted.bed"
+    return customBedFilePath
+
+
+# Reads through the given records once, writing them to a temporary binary file in the given directory while keeping
+# track of the minimum value. Returns the minimum value and a generator that replays the records from the binary file.
+# (The temporary file is removed once the generator is exhausted, closed, or garbage collected.)
+def bufferRecords(records: Iterable[Tuple[str, int, int, float]],
+                  tempDirectory) -> Tuple[float, Iterator[Tuple[str, int, int, float]]]:
+
+    checkDirs(tempDirectory)
+    bufferFileDescriptor, bufferFilePath = tempfile.mkstemp(".records", dir = tempDirectory)
+    chromosomeIDs: Dict[str, int] = dict()
+    minCount = math.inf
+    recordCount = 0
+
+    try:
+        with os.fdopen(bufferFileDescriptor, 'wb') as bufferFile:
+            recordBuffer = np.empty(RECORD_BUFFER_SIZE, RECORD_DTYPE)
+            bufferedRecords = 0
+            for chromosome, startPos, endPos, counts in records:
+                recordBuffer[bufferedRecords] = (chromosomeIDs.setdefault(chromosome, len(chromosomeIDs)),
+                                                 startPos, endPos, counts)
+                if counts < minCount: minCount = counts
+                bufferedRecords += 1
+                if bufferedRecords == RECORD_BUFFER_SIZE:
+                    recordBuffer.tofile(bufferFile)
+                    recordCount += bufferedRecords
+                    bufferedRecords = 0
+            recordBuffer[:bufferedRecords].tofile(bufferFile)
+            recordCount += bufferedRecords
+    except BaseException:
+        os.remove(bufferFilePath)
+        raise
+
+    chromosomes = list(chromosomeIDs)
+
+    def replayRecords():
+        try:
+            if recordCount == 0: return
+            bufferedRecords = np.memmap(bufferFilePath, RECORD_DTYPE, 'r', shape = recordCount)
+            for i in range(0, recordCount, RECORD_BUFFER_SIZE):
+                chunk = bufferedRecords[i:i+RECORD_BUFFER_SIZE]
+                for chromosomeID, startPos, endPos, counts in zip(chunk["chromosome"].tolist(), chunk["start"].tolist(),
+                                                                  chunk["end"].tolist(), chunk["value"].tolist()):
+                    yield chromosomes[chromosomeID], startPos, endPos, counts
+            del bufferedRecords
+        finally:
+            removeBufferFile()
+
+    bufferedRecordsReplay = replayRecords()
+    removeBufferFile = weakref.finalize(bufferedRecordsReplay, os.remove, bufferFilePath)
+    return minCount, bufferedRecordsReplay
+
+
+# Writes the given (chromosome, start, end, value) records to a custom bed file, to a weighted custom bed file if
+# the output format is WEIGHTED_BED, or, if the output format is BINARY_COVERAGE, to a coverage store directory
+# (which requires chromSizes).
+# The values may be non-integers, so each one is divided by minCount, the base (minimum) value, and the result must
+# be a whole number (or close to it).
+def writeCustomBedFromRecords(records: Iterable[Tuple[str, int, int, float]], minCount, customBedFilePath,
+                              strandDesignation = '.', outputFormat = CUSTOM_BED, chromSizes: Dict[str, int] = None):
+
+    # If requested, write the adjusted counts over each entry's positions in a binary coverage store.
+    if outputFormat == BINARY_COVERAGE:
+        with CoverageStoreWriter(customBedFilePath, chromSizes) as coverageStoreWriter:
+
+            for chromosome, startPos, endPos, counts in records:
+
+                adjustedCounts = counts/minCount
+                if abs(adjustedCounts - round(adjustedCounts)) > 0.05:
+                    raise ValueError(f"Counts value {counts} is not a derivative of base counts value {minCount}.")
+
+                coverageStoreWriter.getCounts(chromosome, strandDesignation)[startPos:endPos] += round(adjustedCounts)
+
+        return
+
+    with open(customBedFilePath, 'w') as customBedFile:
+
+        for chromosome, startPos, endPos, counts in records:
+
+            # Add the line "counts" number of times, taking into account the "base" value
+            # and ensuring that the resulting value is actually a whole number (or close to it). 
+            adjustedCounts = counts/minCount
+            if abs(adjustedCounts - round(adjustedCounts)) > 0.05:
+                raise ValueError(f"Counts value {counts} is not a derivative of base counts value {minCount}.")
+
+            # For weighted output, write the line once, with the number of times it would have been repeated.
+            if outputFormat == WEIGHTED_BED:
+                if round(adjustedCounts) > 0:
+                    customBedFile.write('\t'.join((chromosome, str(startPos), str(endPos), '.', "OTHER",
+                                                   strandDesignation, str(round(adjustedCounts)))) + '\n')
+                continue
+
+            for _ in range(round(adjustedCounts)):
+                customBedFile.write('\t'.join((chromosome, str(startPos), str(endPos), '.', 
+                                               "OTHER", strandDesignation)) + '\n')
+
+
+# Yields the lines of a regular custom bed file from the given weighted custom bed file, repeating each entry
+# according to its weight (7th column), for consumers that expect one line per count.
+def readExpandedCustomBed(weightedBedFilePath) -> Iterator[str]:
+    with open(weightedBedFilePath, 'r') as weightedBedFile:
+        for line in weightedBedFile:
+            entry, weight = line.rstrip('\n').rsplit('\t', 1)
+            entry += '\n'
+            for _ in range(int(weight)): yield entry
+
+
+# Expands the given weighted custom bed file into a regular custom bed file. Returns the path to the new file.
+def expandWeightedCustomBed(weightedBedFilePath, customBedFilePath = None):
+
+    if customBedFilePath is None: customBedFilePath = weightedBedFilePath.rsplit("_weighted.bed",1)[0] + ".bed"
+    with open(customBedFilePath, 'w') as customBedFile:
+        customBedFile.writelines(readExpandedCustomBed(weightedBedFilePath))
+    return customBedFilePath
+
+
+# Converts each given wig-bed file to a custom bed file for mutperiod, or, if the output format is BINARY_COVERAGE,
+# to a coverage store directory with the given strand designation. (The latter requires a chrom.sizes file.)
+# If the output format is WEIGHTED_BED, each interval is written once with its count (see readExpandedCustomBed).
+# Returns the paths to the custom bed files or coverage store directories.
+def wigBedToCustomBed(wigBedFilePaths: List[str], outputToIntermediateDirectory = False, strandDesignation = '.',
+                      outputFormat = CUSTOM_BED, chromSizesFilePath = None):
+
+    if outputFormat == BINARY_COVERAGE:
+        if chromSizesFilePath is None: raise UserInputError("Binary coverage store output requires a chrom.sizes file.")
+        chromSizes = parseChromSizes(chromSizesFilePath)
+    else: chromSizes = None
 
     customBedFilePaths = list()
 
@@ -14,49 +185,15 @@ def wigBedToCustomBed(wigBedFilePaths: List[str], outputToIntermediateDirectory
 
         print("Converting",os.path.basename(wigBedFilePath),"to custom bed format.")
 
-        customBedFilePath = wigBedFilePath.rsplit('.',1)[0] + '_'
-        if customBedFilePath.endswith("from_wig_"): customBedFilePath = customBedFilePath.rsplit("from_wig_",1)[0]
-        customBedFilePath += DataTypeStr.customInput + ".bed"
-
-        # Create the output file path, making sure the outputToIntermediateDirectory parameter is satisfied.
-        customBedFileName = os.path.basename(wigBedFilePath.rsplit('.',1)[0] + '_')
-        if customBedFileName.endswith("from_wig_"): customBedFileName = customBedFileName.rsplit("from_wig_",1)[0]
-        customBedFileName += DataTypeStr.customInput + ".bed"
-
-        if outputToIntermediateDirectory and not os.path.dirname(wigBedFilePath).endswith("intermediate_files"):
-            checkDirs(os.path.join(os.path.dirname(wigBedFilePath), "intermediate_files"))
-            customBedFilePath = os.path.join(os.path.dirname(wigBedFilePath), "intermediate_files", customBedFileName)
-        elif outputToIntermediateDirectory or not os.path.dirname(wigBedFilePath).endswith("intermediate_files"):
-            customBedFilePath = os.path.join(os.path.dirname(wigBedFilePath), customBedFileName)
-        else:
-            customBedFilePath = os.path.join(os.path.dirname(os.path.dirname(wigBedFilePath)), customBedFileName)
+        customBedFilePath = getCustomBedFilePath(wigBedFilePath, outputToIntermediateDirectory, outputFormat)
         customBedFilePaths.append(customBedFilePath)
 
         # The counts column may be a non-integer value.  Find out what the base (minimum) value is to
-        # divide all other values by.
-        minCount = math.inf
-        with open(wigBedFilePath, 'r') as wigBedFile:
-            for line in wigBedFile:
-                counts = float(line.split()[4])
-                if counts < minCount: minCount = counts
-
-        # Read out of the first file and write to the second to convert to the custom bed file.
-        with open(wigBedFilePath, 'r') as wigBedFile:
-            with open(customBedFilePath, 'w') as customBedFile:
+        # divide all other values by, buffering the records so that the file only needs to be read once.
+        minCount, records = bufferRecords(readWigBedRecords(wigBedFilePath),
+                                          os.path.join(os.path.dirname(customBedFilePath), ".tmp"))
 
-                for line in wigBedFile:
-
-                    chromosome, startPos, endPos, _, counts = line.split()
-
-                    # Add the line "counts" number of times, taking into account the "base" value
-                    # and ensuring that the resulting value is actually a whole number (or close to it). 
-                    adjustedCounts = float(counts)/minCount
-                    if abs(adjustedCounts - round(adjustedCounts)) > 0.05:
-                        raise ValueError(f"Counts value {counts} is not a derivative of base counts value {minCount}.")
-
-                    for _ in range(round(adjustedCounts)):
-                        customBedFile.write('\t'.join((chromosome, startPos, endPos, '.', 
-                                                       "OTHER", strandDesignation)) + '\n')
+        writeCustomBedFromRecords(records, minCount, customBedFilePath, strandDesignation, outputFormat, chromSizes)
 
     return customBedFilePaths
 
@@ -66,6 +203,11 @@ def main():
     #Create the Tkinter UI
     dialog = TkinterDialog(workingDirectory=getDataDirectory())
     dialog.createMultipleFileSelector("Bed Files (From wig2bed):",0, "from_wig.bed",("Bed Files",".bed"))
+    with dialog.createDynamicSelector(1, 0) as outputFormatDynSel:
+        outputFormatDynSel.initDropdownController("Output format:", (CUSTOM_BED, WEIGHTED_BED, BINARY_COVERAGE))
+        outputFormatDynSel.initDisplay(BINARY_COVERAGE, BINARY_COVERAGE).createFileSelector(
+            "chrom.sizes File:", 0, ("chrom.sizes File", ".chrom.sizes")
+        )
 
     # Run the UI
     dialog.mainloop()
@@ -73,6 +215,11 @@ def main():
     # If no input was received (i.e. the UI was terminated prematurely), then quit!
     if dialog.selections is None: quit()
 
-    wigBedToCustomBed(dialog.selections.getFilePathGroups()[0])
+    outputFormat = outputFormatDynSel.getControllerVar()
+    if outputFormat == BINARY_COVERAGE: chromSizesFilePath = dialog.selections.getIndividualFilePaths(BINARY_COVERAGE)[0]
+    else: chromSizesFilePath = None
+
+    wigBedToCustomBed(dialog.selections.getFilePathGroups()[0], outputFormat = outputFormat,
+                      chromSizesFilePath = chromSizesFilePath)
 
 if __name__ == "__main__": main()
\ No newline at end of file
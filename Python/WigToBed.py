@@ -1,34 +1,177 @@
-# Convert bigwig files to wig format using the bigWigToWig program from:
-# http://hgdownload.soe.ucsc.edu/admin/exe/linux.x86_64/
-import subprocess, os
+# Convert wig files to bed format, equivalent to BEDOPS' "wig2bed -x" (zero-indexed), but without any external programs.
+# fixedStep, variableStep, and bedGraph data are parsed as the file is streamed, and each data point is written as a
+# bed entry with an ID in the 4th column and the original value in the 5th. Like wig2bed, the output is sorted.
+import subprocess, os, sys
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
 from benbiohelpers.FileSystemHandling.DirectoryHandling import checkDirs
-from typing import List
-friendlyWig2BedPath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-                                   "Bash","subprocess_friendly_wig2bed.sh")
+from benbiohelpers.CustomErrors import UserInputError, checkForNumber
+from ParallelProcessing import mapFilesInPool
+from typing import Iterator, List, Tuple
 
+# The number of bed entries to write at once.
+WRITE_BLOCK_SIZE = 100000
 
-def wigToBed(inputFilePaths: List[str], outputToIntermediateDirectory = False):
+FIXED_STEP = "fixedStep"
+VARIABLE_STEP = "variableStep"
+BEDGRAPH = "bedGraph"
 
-    outputFilePaths = list()
 
-    for inputFilePath in inputFilePaths:
-        print("Converting",os.path.basename(inputFilePath),"from wig to bed.")
+# Parses the key=value pairs in a wig declaration line (or track line) into a dictionary.
+def parseDeclaration(splitLine: List[str]):
+    return dict(item.split('=', 1) for item in splitLine[1:] if '=' in item)
 
-        # Create the output file path, making sure the outputToIntermediateDirectory parameter is satisfied.
-        outputFileName = os.path.basename(inputFilePath.rsplit('.',1)[0] + ".bed")
-        if outputToIntermediateDirectory and not os.path.dirname(inputFilePath).endswith("intermediate_files"):
-            checkDirs(os.path.join(os.path.dirname(inputFilePath), "intermediate_files"))
-            outputFilePath = os.path.join(os.path.dirname(inputFilePath), "intermediate_files", outputFileName)
-        elif outputToIntermediateDirectory or not os.path.dirname(inputFilePath).endswith("intermediate_files"):
-            outputFilePath = os.path.join(os.path.dirname(inputFilePath), outputFileName)
+
+# Yields (chromosome, start, end, value) records from the given wig file, where the value is kept as its original text.
+# fixedStep and variableStep positions are assumed to be 0-based if zeroIndexed is true and 1-based otherwise.
+# bedGraph data (following a "track type=bedGraph" line or bigWigToWig's "#bedGraph section" comments, or any
+# 4-column "chrom start end value" line) is always 0-based.
+def readWigRecords(wigFile, zeroIndexed = True) -> Iterator[Tuple[str, int, int, str]]:
+
+    dataFormat = None
+    indexOffset = 0 if zeroIndexed else 1
+
+    for lineNumber, line in enumerate(wigFile, 1):
+
+        splitLine = line.split()
+        if splitLine[:2] == ["#bedGraph", "section"]:
+            dataFormat = BEDGRAPH
+            continue
+        if not splitLine or splitLine[0] == "browser" or splitLine[0].startswith('#'): continue
+
+        if splitLine[0] == "track":
+            if parseDeclaration(splitLine).get("type") == BEDGRAPH: dataFormat = BEDGRAPH
+            continue
+
+        if splitLine[0] in (FIXED_STEP, VARIABLE_STEP):
+            dataFormat = splitLine[0]
+            declaration = parseDeclaration(splitLine)
+            chromosome = declaration["chrom"]
+            span = int(declaration.get("span", 1))
+            if dataFormat == FIXED_STEP:
+                position = int(declaration["start"]) - indexOffset
+                step = int(declaration.get("step", 1))
+            continue
+
+        # Step data lines have one or two columns, so a 4-column line can only be bedGraph data.
+        if len(splitLine) == 4: dataFormat = BEDGRAPH
+
+        if dataFormat == FIXED_STEP:
+            yield chromosome, position, position + span, splitLine[0]
+            position += step
+        elif dataFormat == VARIABLE_STEP:
+            position = int(splitLine[0]) - indexOffset
+            yield chromosome, position, position + span, splitLine[1]
+        elif dataFormat == BEDGRAPH:
+            yield splitLine[0], int(splitLine[1]), int(splitLine[2]), splitLine[3]
+        else: raise UserInputError(f"Data line encountered before any wig declaration on line {lineNumber}: {line}")
+
+
+# Merges consecutive records on the same chromosome that are directly adjacent and share the same value.
+def mergeAdjacentRecords(records: Iterator[Tuple[str, int, int, str]]) -> Iterator[Tuple[str, int, int, str]]:
+
+    lastRecord = None
+    for record in records:
+        if (lastRecord is not None and record[0] == lastRecord[0] and record[1] == lastRecord[2]
+            and float(record[3]) == float(lastRecord[3])):
+            lastRecord = (lastRecord[0], lastRecord[1], record[2], lastRecord[3])
         else:
-            outputFilePath = os.path.join(os.path.dirname(os.path.dirname(inputFilePath)), outputFileName)
-        outputFilePaths.append(outputFilePath)
+            if lastRecord is not None: yield lastRecord
+            lastRecord = record
+    if lastRecord is not None: yield lastRecord
+
+
+# Yields the given lines, writing a copy of each to the given file along the way.
+def teeLines(lines: Iterator[str], copyFile) -> Iterator[str]:
+    for line in lines:
+        copyFile.write(line)
+        yield line
+
+
+# Parses the given wig file object and writes the resulting bed entries to the given bed file object.
+# Returns whether or not the entries were written in sorted order.
+def writeBedFromWig(wigFile, bedFile, mergeAdjacentSpans = False, zeroIndexed = True):
+
+    records = readWigRecords(wigFile, zeroIndexed)
+    if mergeAdjacentSpans: records = mergeAdjacentRecords(records)
+
+    isSorted = True
+    lastSortKey = None
+    outputLines = list()
+    for elementID, (chromosome, start, end, value) in enumerate(records, 1):
+        sortKey = (chromosome.encode(), start, end)
+        if lastSortKey is not None and sortKey < lastSortKey: isSorted = False
+        lastSortKey = sortKey
+
+        outputLines.append(f"{chromosome}\t{start}\t{end}\tid-{elementID}\t{value}\n")
+        if len(outputLines) == WRITE_BLOCK_SIZE:
+            bedFile.write(''.join(outputLines))
+            outputLines.clear()
+    bedFile.write(''.join(outputLines))
+
+    return isSorted
+
+
+# Converts wig data from stdin to bed entries on stdout so that the conversion can run as its own process between
+# two pipes. (Unlike convertWigFileToBed, the output is never re-sorted.) If wigCopyFilePath is given, the
+# incoming wig data is also written there.
+def streamWigToBed(wigCopyFilePath = None, mergeAdjacentSpans = False, zeroIndexed = True):
+
+    if wigCopyFilePath is None:
+        writeBedFromWig(sys.stdin, sys.stdout, mergeAdjacentSpans, zeroIndexed)
+    else:
+        with open(wigCopyFilePath, 'w') as wigCopyFile:
+            writeBedFromWig(teeLines(sys.stdin, wigCopyFile), sys.stdout, mergeAdjacentSpans, zeroIndexed)
+    sys.stdout.flush()
+
+
+# Converts a single wig file to bed at the given output file path. (See wigToBed for details.)
+# Entries are written as they are parsed. If they turn out not to be in sorted order, the output is sorted afterwards.
+def convertWigFileToBed(inputFilePath, outputFilePath, mergeAdjacentSpans = False, zeroIndexed = True):
+
+    with open(inputFilePath, 'r') as wigFile:
+        with open(outputFilePath, 'w') as bedFile:
+            isSorted = writeBedFromWig(wigFile, bedFile, mergeAdjacentSpans, zeroIndexed)
+
+    if not isSorted:
+        subprocess.check_call(("sort", "-k1,1", "-k2,2n", "-k3,3n", "-s", "-o", outputFilePath, outputFilePath),
+                              env = {**os.environ, "LC_ALL": "C"})
+
+    return outputFilePath
+
+
+# Creates the output file path for the given wig file, making sure the outputToIntermediateDirectory parameter is
+# satisfied, and converts the file.
+def wigFileToBed(inputFilePath, outputToIntermediateDirectory = False, mergeAdjacentSpans = False, zeroIndexed = True):
+
+    print("Converting",os.path.basename(inputFilePath),"from wig to bed.")
+
+    outputFileName = os.path.basename(inputFilePath.rsplit('.',1)[0] + ".bed")
+    if outputToIntermediateDirectory and not os.path.dirname(inputFilePath).endswith("intermediate_files"):
+        checkDirs(os.path.join(os.path.dirname(inputFilePath), "intermediate_files"))
+        outputFilePath = os.path.join(os.path.dirname(inputFilePath), "intermediate_files", outputFileName)
+    elif outputToIntermediateDirectory or not os.path.dirname(inputFilePath).endswith("intermediate_files"):
+        outputFilePath = os.path.join(os.path.dirname(inputFilePath), outputFileName)
+    else:
+        outputFilePath = os.path.join(os.path.dirname(os.path.dirname(inputFilePath)), outputFileName)
+
+    return convertWigFileToBed(inputFilePath, outputFilePath, mergeAdjacentSpans, zeroIndexed)
+
+
+# Converts each given wig file to bed format. If mergeAdjacentSpans is true, adjacent entries with equal values
+# are merged into a single entry (which differs from wig2bed's output).
+# If workers is greater than 1, files are converted concurrently in a pool of that many processes. In this case,
+# an error in one file is reported without stopping the others, and that file is left out of the results.
+def wigToBed(inputFilePaths: List[str], outputToIntermediateDirectory = False, workers = 1,
+             mergeAdjacentSpans = False, zeroIndexed = True):
 
-        subprocess.check_call(("sh", friendlyWig2BedPath, inputFilePath, outputFilePath))
+    if workers > 1:
+        return [outputFilePath for outputFilePath in mapFilesInPool(wigFileToBed, inputFilePaths, workers,
+                                                                    outputToIntermediateDirectory, mergeAdjacentSpans,
+                                                                    zeroIndexed)
+                if outputFilePath is not None]
 
-    return outputFilePaths
+    return [wigFileToBed(inputFilePath, outputToIntermediateDirectory, mergeAdjacentSpans, zeroIndexed)
+            for inputFilePath in inputFilePaths]
 
 
 def main():
@@ -36,6 +179,8 @@ def main():
     # Create the Tkinter UI
     dialog = TkinterDialog(workingDirectory=os.path.dirname(__file__))
     dialog.createMultipleFileSelector("wig Files:", 0, ".wig", ("wig files", ".wig"))
+    dialog.createTextField("Worker processes:", 1, 0, defaultText = "1")
+    dialog.createCheckbox("Merge adjacent entries with equal values", 2, 0)
 
     # Run the UI
     dialog.mainloop()
@@ -43,6 +188,8 @@ def main():
     # If no input was received (i.e. the UI was terminated prematurely), then quit!
     if dialog.selections is None: quit()
 
-    wigToBed(dialog.selections.getFilePathGroups()[0])
+    workers = checkForNumber(dialog.selections.getTextEntries()[0], True, lambda x: x > 0)
+    wigToBed(dialog.selections.getFilePathGroups()[0], workers = workers,
+             mergeAdjacentSpans = dialog.selections.getToggleStates()[0])
 
-if __name__ == "__main__": main()
\ No newline at end of file
+if __name__ == "__main__": main()
@@ -6,17 +6,17 @@
 # NOTE: Make sure that no '$' characters are present in the gene annotations file. (These are
 # used as separators for peaks that span multiple loci)
 
-import os
+import os, sys
 from typing import List
 from benbiohelpers.CountThisInThat.Counter import ThisInThatCounter, CounterOutputDataHandler
 from benbiohelpers.CountThisInThat.CounterOutputDataHandler import OutputDataWriter
 from benbiohelpers.CountThisInThat.InputDataStructures import EncompassingData, ENCOMPASSED_DATA, ENCOMPASSING_DATA
 from benbiohelpers.CountThisInThat.OutputDataStratifiers import AmbiguityHandling
 from benbiohelpers.CountThisInThat.SupplementalInformation import SimpleColumnSupInfoHandler
-from benbiohelpers.FileSystemHandling.BedToFasta import bedToFasta
-from benbiohelpers.FileSystemHandling.FastaFileIterator import FastaFileIterator
 from benbiohelpers.FileSystemHandling.DirectoryHandling import checkDirs, filterTempFiles
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from TwoBitGenome import getTwoBitGenome
 
 class GeneAnnotationData(EncompassingData):
 
@@ -119,7 +119,6 @@ def annotatePeaks(narrowPeakFilePaths: List[str], annotatedGenesFilePath: str,
 
         geneAnnotatedOutputFilePath = os.path.join(tempDirectory, basename + "_gene_annotation.bed")
         exonAnnotatedFilePath = os.path.join(tempDirectory, basename + "_gene_and_exon_annotated.bed")
-        peakSequencesFilePath = os.path.join(tempDirectory, basename + "_peak_sequences.fa")
         finalAnnotatedFilePath = os.path.join(mainDirectory, basename + "_full_annotation.bed")
 
         if filterInsignificantPeaks:
@@ -142,17 +141,21 @@ def annotatePeaks(narrowPeakFilePaths: List[str], annotatedGenesFilePath: str,
         exonChecker.count()
 
         print("Adding peak sequences...")
-        bedToFasta(narrowPeakFilePath, genomeFastaFilePath, peakSequencesFilePath)
-        with open(peakSequencesFilePath, 'r') as peakSequencesFile:
-            with open(exonAnnotatedFilePath, 'r') as exonAnnotatedFile:
-                with open(finalAnnotatedFilePath, 'w') as finalAnnotatedFile:
-                    for fastaEntry in FastaFileIterator(peakSequencesFile):
-                        choppedUpLine = exonAnnotatedFile.readline().strip().split('\t')
-                        # Adjust the exon indicator if this is not actually a genic region.
-                        if choppedUpLine[8] == "NONE" and choppedUpLine[9] == "NONE":
-                            choppedUpLine[10] = "NA"
-                        choppedUpLine.append(fastaEntry.sequence)
-                        finalAnnotatedFile.write('\t'.join(choppedUpLine) + '\n')
+        with open(narrowPeakFilePath, 'r') as narrowPeakFile:
+            peaks = [line.split('\t') for line in narrowPeakFile if line.strip()]
+        peakSequences = getTwoBitGenome(genomeFastaFilePath).fetchBatch(
+            [peak[0] for peak in peaks], [int(peak[1]) for peak in peaks], [int(peak[2]) for peak in peaks],
+            [peak[5].strip() for peak in peaks]
+        )
+        with open(exonAnnotatedFilePath, 'r') as exonAnnotatedFile:
+            with open(finalAnnotatedFilePath, 'w') as finalAnnotatedFile:
+                for peakSequence in peakSequences:
+                    choppedUpLine = exonAnnotatedFile.readline().strip().split('\t')
+                    # Adjust the exon indicator if this is not actually a genic region.
+                    if choppedUpLine[8] == "NONE" and choppedUpLine[9] == "NONE":
+                        choppedUpLine[10] = "NA"
+                    choppedUpLine.append(peakSequence)
+                    finalAnnotatedFile.write('\t'.join(choppedUpLine) + '\n')
 
 
 def main():
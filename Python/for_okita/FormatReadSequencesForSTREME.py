@@ -2,19 +2,22 @@
 # for use in STREME.
 # Can filter using a common loci file along with a minimum number of files that a locus must be present in.
 # Can also filter on sequence length or expand smaller sequences to hit a minimum sequence length.
-import os, math
+import os, sys, math
 from typing import List
 from benbiohelpers.TkWrappers.TkinterDialog import TkinterDialog
 from benbiohelpers.CustomErrors import checkForNumber
 from benbiohelpers.FileSystemHandling.DirectoryHandling import getTempDir
-from benbiohelpers.FileSystemHandling.BedToFasta import bedToFasta
 from benbiohelpers.CustomErrors import InvalidPathError
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from TwoBitGenome import writeBedSequencesToFasta
+from SequenceCache import getSequenceCache
 
 
 def formatReadSequencesForSTREME(fullAnnotationFilePaths: List[str], outputFilePath: str, genomeFastaFilePath: str,
                                  commonLociFilePath = None, minCommonLociFiles = None,
                                  maxSequenceLength: int = None, minSequenceLength: int = 3,
-                                 callFromThreePrimeEnd = True, fivePrimeExtension = 0, threePrimeExtension = 0):
+                                 callFromThreePrimeEnd = True, fivePrimeExtension = 0, threePrimeExtension = 0,
+                                 sequenceCacheFilePath = None):
 
     if not outputFilePath.endswith(".fa"):
         raise InvalidPathError(outputFilePath, "Given output path does not appear to be a fasta file.")
@@ -77,7 +80,10 @@ def formatReadSequencesForSTREME(fullAnnotationFilePaths: List[str], outputFileP
                                                                    '.','.',splitLine[5]))+'\n')
                     writtenSequences += 1
 
-    bedToFasta(intermediatePositionsFilePath, genomeFastaFilePath, outputFilePath)
+    # Peaks recur across annotation files and runs, so sequences are fetched through a sequence cache (which is also
+    # persistent if a cache file is given).
+    writeBedSequencesToFasta(intermediatePositionsFilePath, genomeFastaFilePath, outputFilePath,
+                             sequenceCache = getSequenceCache(genomeFastaFilePath, sequenceCacheFilePath))
 
     print(f"Finished writitng {writtenSequences} sequences!")
 